@@ -1,7 +1,11 @@
 from pytmx import *
-from tmxloader import load_pygame, load_tmx
+from tmxloader import load_pygame, load_tmx, load_many, PygameImageLoader
+from tmxloader import load_pygame_async, AsyncLoader
+from imageloader import ImageLoader, NumpyImageLoader, LazyImages
+from renderer import ChunkRenderer, ViewportRenderer
+from cache import tileset_cache
 
-__version__ = '2.16.6'
+__version__ = '2.17.0'
 __author__ = 'bitcraft'
 __author_email__ = 'leif.theden@gmail.com'
 __description__ = 'Map loader for TMX Files - Python 2.7'
@@ -0,0 +1,126 @@
+"""
+Process-wide cache of external tilesets (TSX files).
+
+Many maps usually share a few tilesets.  The cache keeps each TSX file
+parsed, along with the properties of its tiles, so every map that uses it
+only has to register its own gids.  Image loaders also keep the tileset
+image and converted tiles here, so they are not loaded again for each map.
+
+Entries are keyed by the absolute path of the TSX file, and are reloaded if
+the file's mtime changes.  The least recently used tilesets are dropped when
+there are more than maxsize of them.
+
+The images of a tileset, and which of their tiles are opaque, are dropped
+with the tileset, and when an image file changes.
+
+Images kept in the cache are shared by all maps using the tileset, so do not
+draw on them.  If the display mode is changed, call tileset_cache.invalidate()
+so the tiles are converted again for the new display.
+"""
+import os
+import threading
+from collections import OrderedDict
+from .utils import parse_tile_properties
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+__all__ = ['TilesetCache', 'tileset_cache']
+
+# which tiles of each tileset image are opaque, by (absolute path, mtime)
+opacity_cache = {}
+
+
+class TilesetEntry(object):
+    """
+    a parsed TSX file and the data that loaders keep for it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self.node = ElementTree.parse(path).getroot()
+        self.tiles = parse_tile_properties(self.node)
+        self.data = {}  # (loader key, absolute path, mtime): dict, by image
+
+    def image_data(self, key, path):
+        """
+        return the dict that a loader keeps for an image of the tileset, with
+        the options in key.  what was kept for older versions of the image is
+        dropped.
+        """
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        for old in self.data.keys():
+            if old[:2] == (key, path) and old[2] != mtime:
+                self.drop_image(old)
+
+        return self.data.setdefault((key, path, mtime), {})
+
+    def drop_image(self, image_key):
+        """
+        drop what is kept for an image, and which of its tiles are opaque
+        """
+        key, path, mtime = image_key
+        del self.data[image_key]
+        opacity_cache.pop((path, mtime), None)
+
+    def drop_images(self):
+        for image_key in self.data.keys():
+            self.drop_image(image_key)
+
+
+class TilesetCache(object):
+    """
+    LRU cache of external tilesets.  see the module docstring.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, path):
+        """
+        return the cache entry for a TSX file, loading it if needed
+
+        entry.node is the root element of the TSX file, entry.tiles is a list
+        of (tile id, properties) and loaders keep images in the dicts of
+        entry.image_data.
+        """
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None and entry.mtime != mtime:
+                entry.drop_images()
+                entry = None
+            if entry is None:
+                entry = TilesetEntry(path)
+
+            # the most recently used entries are at the end
+            self.entries[path] = entry
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)[1].drop_images()
+
+            return entry
+
+    def invalidate(self, path=None):
+        """
+        drop a tileset from the cache, or all of them if path is None
+        """
+        with self.lock:
+            if path is None:
+                entries = self.entries.values()
+                self.entries.clear()
+            else:
+                entries = filter(None, [self.entries.pop(os.path.abspath(path), None)])
+
+            for entry in entries:
+                entry.drop_images()
+
+
+tileset_cache = TilesetCache()
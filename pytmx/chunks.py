@@ -0,0 +1,235 @@
+"""
+Sparse tile data for the layers of infinite maps.
+
+Tiled saves the layers of infinite maps as chunks, blocks of tiles that are
+usually 16x16, each with its own position.  Only the parts of the world that
+have tiles are saved, and they can be anywhere, even at negative positions.
+
+TileChunks keeps the chunks of a layer in a dict, keyed by the (column, row)
+of the chunk.  The gids of each chunk are registered when the map is loaded,
+like the gids of other layers, but each chunk is only turned into tile data
+the first time it is used.  Chunks that are never used stay encoded.
+
+When only a region of a map is loaded, its layers are stored in chunks too,
+so that only the tiles of the region are kept.
+
+The data of a chunked layer still works as layer.data[y][x].  Tiles outside
+of the chunks are empty, and setting them makes a new chunk.
+"""
+import array
+from .utils import numpy, GID_TYPECODE, GID_DTYPES
+
+__all__ = ['TileChunks', 'CHUNK_SIZE']
+
+# width and height of the chunks made for the layers of a region of a map
+CHUNK_SIZE = 16
+
+
+class TileRow(object):
+    """
+    one row of tiles of a TileChunks, so that data[y][x] works
+    """
+    __slots__ = ('chunks', 'y')
+
+    def __init__(self, chunks, y):
+        self.chunks = chunks
+        self.y = y
+
+    def __getitem__(self, x):
+        return self.chunks.get(x, self.y)
+
+    def __setitem__(self, x, gid):
+        self.chunks.set(x, self.y, gid)
+
+
+class TileChunks(object):
+    """
+    Chunks of a tile layer.  see the module docstring.
+
+    the data of each chunk is stored like the data of the other layers: a
+    list of array.array rows, or a 2d numpy array.
+    """
+
+    def __init__(self, layer, chunk_width, chunk_height):
+        self.layer = layer
+        self.chunk_width = chunk_width
+        self.chunk_height = chunk_height
+        self.chunks = {}    # (column, row): data of the chunk
+        self.payloads = {}  # (column, row): (payload, compression), if encoded
+
+    def __len__(self):
+        return len(self.chunks) + len(self.payloads)
+
+    def __getitem__(self, y):
+        return TileRow(self, y)
+
+    def __iter__(self):
+        return self.iter_tiles()
+
+    def add_payload(self, x, y, payload, compression):
+        """
+        add an encoded chunk at tile x, y.  it is decoded when it is used.
+        """
+        key = self.chunk_key(x, y)
+        self.payloads[key] = payload, compression
+        self.chunks.pop(key, None)
+
+    def chunk_key(self, x, y):
+        """
+        return the key of the chunk that starts at tile x, y
+        """
+        column, px = divmod(x, self.chunk_width)
+        row, py = divmod(y, self.chunk_height)
+        if px or py:
+            msg = "Chunk at ({0},{1}) of layer \"{2}\" is not aligned to the chunk size."
+            raise Exception, msg.format(x, y, self.layer.name)
+
+        return column, row
+
+    def keys(self):
+        """
+        return the (column, row) of all the chunks, sorted by row
+        """
+        keys = set(self.chunks)
+        keys.update(self.payloads)
+        return sorted(keys, key=lambda (column, row): (row, column))
+
+    def get_chunk(self, column, row):
+        """
+        return the data of a chunk, decoding it if needed, or None if there
+        is no chunk there
+        """
+        key = column, row
+        try:
+            return self.chunks[key]
+        except KeyError:
+            pass
+
+        try:
+            payload, compression = self.payloads.pop(key)
+        except KeyError:
+            return None
+
+        size = self.chunk_width * self.chunk_height
+        raw_gids = self.layer.read_gids(payload, compression, size)
+        data = self.layer.build_data(raw_gids, self.chunk_width, self.chunk_height)
+        self.chunks[key] = data
+        return data
+
+    def decode(self):
+        """
+        decode all the chunks
+        """
+        for column, row in self.payloads.keys():
+            self.get_chunk(column, row)
+
+    def get(self, x, y):
+        """
+        return the gid of a tile, or 0 if it is not in a chunk
+        """
+        column, px = divmod(x, self.chunk_width)
+        row, py = divmod(y, self.chunk_height)
+        data = self.get_chunk(column, row)
+        if data is None:
+            return 0
+        return data[py][px]
+
+    def set(self, x, y, gid):
+        """
+        set the gid of a tile, making a new chunk if it is not in one
+        """
+        column, px = divmod(x, self.chunk_width)
+        row, py = divmod(y, self.chunk_height)
+        data = self.get_chunk(column, row)
+        if data is None:
+            if not gid:
+                return
+            size = self.chunk_width * self.chunk_height
+            empty = array.array(GID_TYPECODE, [0]) * size
+            data = self.layer.build_data(empty, self.chunk_width, self.chunk_height)
+            self.chunks[column, row] = data
+
+        data[py][px] = gid
+
+    def bounds(self):
+        """
+        return the (x, y, width, height) of the area covered by the chunks,
+        in tiles, or None if there are no chunks
+        """
+        keys = self.keys()
+        if not keys:
+            return None
+
+        columns = [column for column, row in keys]
+        rows = [row for column, row in keys]
+        cw, ch = self.chunk_width, self.chunk_height
+        return (min(columns) * cw, min(rows) * ch,
+                (max(columns) - min(columns) + 1) * cw,
+                (max(rows) - min(rows) + 1) * ch)
+
+    def iter_tiles(self):
+        """
+        yield x, y, gid of every tile of every chunk, including empty tiles
+        """
+        for column, row in self.keys():
+            x0, y0 = column * self.chunk_width, row * self.chunk_height
+            data = self.get_chunk(column, row)
+            for y, data_row in enumerate(data, y0):
+                for x, gid in enumerate(data_row, x0):
+                    yield x, y, gid
+
+    def iter_region(self, x, y, width, height):
+        """
+        yield x, y, gid of the tiles that are not empty in an area of tiles,
+        one row after another.  only the chunks in the area are visited, and
+        only those are decoded.
+        """
+        cw, ch = self.chunk_width, self.chunk_height
+        x1, y1 = x + width, y + height
+        if width <= 0 or height <= 0:
+            return
+
+        columns = xrange(x // cw, (x1 - 1) // cw + 1)
+        rows = xrange(y // ch, (y1 - 1) // ch + 1)
+
+        # a big area has more chunks than there are chunks with tiles.
+        # compare against the bounds, as "in" would scan the xranges.
+        if len(columns) * len(rows) > len(self):
+            left, right = columns[0], columns[-1]
+            top, bottom = rows[0], rows[-1]
+            keys = [(column, row) for column, row in self.keys()
+                    if left <= column <= right and top <= row <= bottom]
+        else:
+            keys = [(column, row) for row in rows for column in columns
+                    if (column, row) in self.chunks or
+                    (column, row) in self.payloads]
+
+        # the chunks of each row of chunks, left to right
+        bands = []
+        for column, row in keys:
+            if not bands or bands[-1][0] != row:
+                bands.append((row, []))
+            bands[-1][1].append(column)
+
+        for row, columns in bands:
+            chunks = [(column * cw, self.get_chunk(column, row)) for column in columns]
+            for ty in xrange(max(y, row * ch), min(y1, (row + 1) * ch)):
+                py = ty - row * ch
+                for cx, data in chunks:
+                    px0, px1 = max(x - cx, 0), min(x1 - cx, cw)
+                    data_row = data[py][px0:px1]
+                    if hasattr(data_row, 'tolist'):
+                        data_row = data_row.tolist()
+                    for tx, gid in enumerate(data_row, cx + px0):
+                        if gid:
+                            yield tx, ty, gid
+
+    def convert(self, typecode, layer_storage):
+        """
+        change the typecode or storage of the decoded chunks
+        """
+        for key, data in self.chunks.items():
+            if layer_storage == "numpy":
+                self.chunks[key] = numpy.asarray(data, dtype=GID_DTYPES[typecode])
+            else:
+                self.chunks[key] = [array.array(typecode, row) for row in data]
@@ -0,0 +1,314 @@
+"""
+Compiled maps: a TiledMap saved in a compact binary file that loads much
+faster than parsing the TMX file again.
+
+Layout of a compiled file:
+    prefix:  magic, format version, size of the sources and map headers
+    sources: pickled list of the TMX and TSX files the map was made from
+    map:     pickled TiledMap, without the layer data or images
+    layers:  raw gids of each tile layer as little-endian unsigned ints,
+             each layer aligned to 16 bytes so it can be memory-mapped
+
+The chunks of the layers of infinite maps are kept in the pickled map, as
+they are sparse.  Chunks that were not decoded stay encoded.
+
+The sources are checked when loading.  If the TMX file or any external TSX
+file has changed since the map was compiled, the compiled map is not used.
+
+With memory_map=True, the layers are numpy arrays that are views of the
+memory-mapped file, rather than copies.  Processes that load the same
+compiled map share its pages in the OS page cache.  The mapping is
+copy-on-write, so tiles can still be changed; changed pages are private to
+the process and are never written back to the file.
+"""
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import cPickle as pickle
+from .utils import numpy, GID_TYPECODE, GID_DTYPES, remove_file, replace_file
+from .chunks import TileChunks
+
+__all__ = ['save_compiled', 'load_compiled', 'dumps_compiled',
+           'loads_compiled', 'compiled_path']
+
+MAGIC = 'PYTMXC'
+FORMAT_VERSION = 9
+ALIGN = 16
+
+# bytes used to store a gid, by array typecode of the layers
+ITEMSIZE = {'B': 1, 'H': 2, 'L': 4}
+
+prefix = struct.Struct('<6sHII')
+
+
+def file_signature(path):
+    """
+    return (path, mtime, size, sha1) of a file
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with open(path, 'rb') as fh:
+        digest = hashlib.sha1(fh.read()).hexdigest()
+    return path, st.st_mtime, st.st_size, digest
+
+
+def is_current(signature):
+    """
+    check if a file is the same as it was when the signature was taken.
+    the file is only hashed if the mtime or size has changed.
+    """
+    path, mtime, size, digest = signature
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+
+    if st.st_mtime == mtime and st.st_size == size:
+        return True
+
+    return st.st_size == size and file_signature(path)[3] == digest
+
+
+def compiled_path(filename, cache_dir, region=None):
+    """
+    return the path of the compiled file for a TMX file in cache_dir, or for
+    a region of it
+    """
+    filename = os.path.abspath(filename)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    if region is not None:
+        key = hashlib.sha1("{0}:{1}".format(filename, region)).hexdigest()[:12]
+    else:
+        key = hashlib.sha1(filename).hexdigest()[:12]
+    return os.path.join(cache_dir, "{0}-{1}.tmxc".format(name, key))
+
+
+def layer_to_string(tmxdata, layer):
+    """
+    return the data of a tile layer as a string of little-endian ints
+    """
+    typecode = tmxdata.layer_typecode
+
+    # chunks are saved with the map
+    if isinstance(layer.data, TileChunks):
+        return ""
+
+    if tmxdata._layer_storage == "numpy":
+        data = numpy.asarray(layer.data, dtype=GID_DTYPES[typecode])
+        return data.astype('<u{0}'.format(ITEMSIZE[typecode])).tostring()
+
+    if typecode == 'L':
+        rows = [array.array(GID_TYPECODE, row) for row in layer.data]
+    elif sys.byteorder == 'big':
+        rows = [array.array(typecode, row) for row in layer.data]
+    else:
+        rows = layer.data
+
+    if sys.byteorder == 'big':
+        [row.byteswap() for row in rows]
+
+    return "".join(row.tostring() for row in rows)
+
+
+def layer_from_buffer(buf, offset, width, height, typecode, layer_storage,
+                      memory_map=False):
+    """
+    read the data of a tile layer from a compiled file
+
+    if memory_map is True, the data is a numpy array that is a view of buf
+    """
+    itemsize = ITEMSIZE[typecode]
+    size = width * height
+
+    if layer_storage == "numpy":
+        dtype = '<u{0}'.format(itemsize)
+        data = numpy.frombuffer(buf, dtype=dtype, count=size, offset=offset)
+        if not memory_map:
+            data = data.astype(GID_DTYPES[typecode])
+        return data.reshape(height, width)
+
+    rowtype = GID_TYPECODE if typecode == 'L' else typecode
+    step = width * itemsize
+    rows = []
+    for y in xrange(height):
+        row = array.array(rowtype)
+        row.fromstring(buf[offset + y * step:offset + (y + 1) * step])
+        if sys.byteorder == 'big':
+            row.byteswap()
+        if rowtype != typecode:
+            row = array.array(typecode, row)
+        rows.append(row)
+
+    return rows
+
+
+def dumps_compiled(tmxdata):
+    """
+    return a TiledMap as a compiled string
+
+    images are not saved; load them with the loader, as with a TMX file.
+    """
+    filenames = [tmxdata.filename]
+    filenames.extend(ts._filename for ts in tmxdata.tilesets if ts._filename)
+    sources = pickle.dumps([file_signature(i) for i in filenames],
+                           pickle.HIGHEST_PROTOCOL)
+
+    layers = [layer_to_string(tmxdata, layer) for layer in tmxdata.tilelayers]
+
+    # the layer data is stored separately, and images can't be pickled
+    saved = [layer.data for layer in tmxdata.tilelayers]
+    saved_attrs = (tmxdata.images, tmxdata.tile_atlas, tmxdata.gid_locations,
+                   tmxdata.layer_gids, tmxdata.object_index)
+    saved_indexes = [group.object_index for group in tmxdata.objectgroups]
+    try:
+        for layer in tmxdata.tilelayers:
+            if not isinstance(layer.data, TileChunks):
+                layer.data = None
+        for group in tmxdata.objectgroups:
+            group.object_index = None
+        tmxdata.images = []
+        tmxdata.tile_atlas = []
+        tmxdata.gid_locations = tmxdata.layer_gids = None
+        tmxdata.object_index = None
+        mapdata = pickle.dumps(tmxdata, pickle.HIGHEST_PROTOCOL)
+    finally:
+        for layer, data in zip(tmxdata.tilelayers, saved):
+            layer.data = data
+        for group, index in zip(tmxdata.objectgroups, saved_indexes):
+            group.object_index = index
+        (tmxdata.images, tmxdata.tile_atlas, tmxdata.gid_locations,
+         tmxdata.layer_gids, tmxdata.object_index) = saved_attrs
+
+    chunks = [prefix.pack(MAGIC, FORMAT_VERSION, len(sources), len(mapdata)),
+              sources, mapdata]
+    size = sum(len(i) for i in chunks)
+    for data in layers:
+        chunks.append('\0' * (-size % ALIGN))
+        chunks.append(data)
+        size += len(chunks[-2]) + len(data)
+
+    return "".join(chunks)
+
+
+def save_compiled(tmxdata, path):
+    """
+    save a TiledMap to a compiled file
+
+    images are not saved; load them with the loader, as with a TMX file.
+    """
+    data = dumps_compiled(tmxdata)
+
+    # write to a temporary file first, so other processes never see a
+    # partially written map
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(temp, 'wb') as fh:
+            fh.write(data)
+        replace_file(temp, path)
+    except EnvironmentError:
+        remove_file(temp)
+        raise
+
+
+def read_headers(buf, check):
+    """
+    return the sources, map and offset of the first layer of a compiled file.
+    returns None if check is True and the sources have changed.
+    """
+    try:
+        magic, version, sources_size, map_size = prefix.unpack_from(buf)
+    except struct.error:
+        magic = version = None
+
+    if magic != MAGIC:
+        msg = "Not a compiled map."
+        raise ValueError, msg
+
+    # compiled with a different version of pytmx
+    if version != FORMAT_VERSION:
+        return None
+
+    offset = prefix.size
+    sources = pickle.loads(buf[offset:offset + sources_size])
+    if check and not all(is_current(i) for i in sources):
+        return None
+
+    offset += sources_size
+    tmxdata = pickle.loads(buf[offset:offset + map_size])
+    return sources, tmxdata, offset + map_size
+
+
+def load_compiled(path, layer_storage="array", check=True, memory_map=False):
+    """
+    load a TiledMap from a compiled file
+
+    if check is True, None is returned when the TMX or TSX files the map was
+    compiled from have changed.
+
+    if memory_map is True, the layers are views of the memory-mapped file,
+    instead of copies.  this requires numpy, and the layers will be stored as
+    numpy arrays, whatever the layer_storage.
+    """
+    if memory_map:
+        layer_storage = "numpy"
+
+    if layer_storage == "numpy" and numpy is None:
+        msg = "Layer storage \"numpy\" requires numpy to be installed."
+        raise ValueError, msg
+
+    # copy-on-write, so that the layers are writable
+    access = mmap.ACCESS_COPY if memory_map else mmap.ACCESS_READ
+    with open(path, 'rb') as fh:
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=access)
+        except (ValueError, EnvironmentError):
+            msg = "Not a compiled map."
+            raise ValueError, msg
+
+    try:
+        tmxdata = read_compiled(buf, layer_storage, check, memory_map)
+    finally:
+        # the layers keep the mapping open while they use it
+        if not memory_map:
+            buf.close()
+
+    return tmxdata
+
+
+def loads_compiled(data, layer_storage="array"):
+    """
+    load a TiledMap from a compiled string.  the sources are not checked.
+    """
+    if layer_storage == "numpy" and numpy is None:
+        msg = "Layer storage \"numpy\" requires numpy to be installed."
+        raise ValueError, msg
+
+    return read_compiled(data, layer_storage, False, False)
+
+
+def read_compiled(buf, layer_storage, check, memory_map):
+    """
+    read a TiledMap from the buffer of a compiled file or string
+    """
+    headers = read_headers(buf, check)
+    if headers is None:
+        return None
+
+    sources, tmxdata, offset = headers
+    tmxdata._layer_storage = layer_storage
+    typecode = tmxdata.layer_typecode
+
+    for layer in tmxdata.tilelayers:
+        if isinstance(layer.data, TileChunks):
+            layer.data.convert(typecode, layer_storage)
+            continue
+
+        offset += -offset % ALIGN
+        layer.data = layer_from_buffer(buf, offset, layer.width, layer.height,
+                                       typecode, layer_storage, memory_map)
+        offset += layer.width * layer.height * ITEMSIZE[typecode]
+
+    return tmxdata
@@ -0,0 +1,521 @@
+"""
+Image loaders: make the tile images of a map for a renderer.
+
+load_images does the work that is the same for every renderer.  it cuts the
+tileset images into tiles, following the margin, spacing and firstgid of each
+tileset, and finds the flipped and rotated versions of each tile that the map
+uses.  an ImageLoader does the rest: it reads image files, cuts out the tiles
+and flips, rotates and converts them.
+
+    tmxdata = pytmx.load_tmx(filename)
+    tmxdata.loadTileImages(NumpyImageLoader())
+
+NumpyImageLoader does not need a display, so it can be used on servers and in
+offline tools.  the pygame loader is in tmxloader.
+
+in atlas mode, the tiles of each tileset that the map uses, with their flipped
+and rotated versions, are packed into one image that is converted only once.
+tmxdata.tile_atlas[gid] is the (atlas image, rect) of each tile.  maps that
+use the same external tileset share one atlas of all its tiles.
+
+in lazy mode, tmxdata.images is a LazyImages, which only makes each tile the
+first time it is used.  with a budget, the tiles that have not been used for
+the longest time are dropped when the tiles take more memory than that.
+"""
+import math
+import os
+import pytmx
+from .cache import tileset_cache
+from .constants import *
+from .utils import numpy
+
+__all__ = ['ImageLoader', 'NumpyImageLoader', 'LazyImages', 'load_images',
+           'iter_load_images']
+
+
+class ImageLoader(object):
+    """
+    Base class for image loaders.
+
+    colorkeys are passed as they are in the TMX file: a hex string such as
+    "ff00ff", or None.
+    """
+
+    def cache_key(self):
+        """
+        return a key for the images made by this loader, or None.
+
+        images of external tilesets are kept in the tileset cache under this
+        key, so loaders that make the same images must return the same key.
+        if None, images are not cached.
+        """
+        return None
+
+    def load(self, path, colorkey=None):
+        """
+        read an image file
+        """
+        raise NotImplementedError
+
+    def get_size(self, image):
+        """
+        return the (width, height) of an image, in pixels
+        """
+        raise NotImplementedError
+
+    def get_nbytes(self, image):
+        """
+        return about how many bytes of memory an image uses
+        """
+        width, height = self.get_size(image)
+        return width * height * 4
+
+    def subimage(self, image, rect):
+        """
+        return the area (x, y, width, height) of an image
+        """
+        raise NotImplementedError
+
+    def transform(self, tile, flags):
+        """
+        return a tile flipped and rotated by the TRANS_ flags of map_gid
+        """
+        raise NotImplementedError
+
+    def get_opacity(self, path, image, rects):
+        """
+        return a dict of which areas (x, y, width, height) of an image have no
+        transparent pixels.  flipping and rotating a tile does not change its
+        transparency, so this is done once for each tile and passed to
+        convert.  loaders that do not need to know return an empty dict.
+        """
+        return {}
+
+    def convert(self, tile, colorkey=None, opaque=None):
+        """
+        return a tile ready to be used by the renderer
+
+        opaque is True if the tile has no transparent pixels, False if it has
+        some, or None if it is not known.
+        """
+        return tile
+
+    def pack(self, tiles, colorkey=None):
+        """
+        pack a list of transformed tiles into one image, ready to be used by
+        the renderer.  return the image and the (x, y, width, height) of each
+        tile in it.  see pack_rects.
+        """
+        raise NotImplementedError
+
+
+class NumpyImageLoader(ImageLoader):
+    """
+    Loads tiles as numpy arrays of RGBA pixels, with shape (height, width, 4)
+    and dtype uint8.  does not need a display.
+
+    each tileset image is read into one array, and the tiles are views of it,
+    as are the flipped and rotated tiles.  pass copy=True to give each tile
+    its own contiguous array instead.
+
+    pixels of the tileset's colorkey are made transparent.
+
+    images are read with PIL if it is installed, otherwise with pygame.
+    """
+
+    def __init__(self, copy=False):
+        if numpy is None:
+            msg = "NumpyImageLoader requires numpy to be installed."
+            raise ValueError, msg
+
+        self.copy = copy
+
+    def cache_key(self):
+        return 'numpy', self.copy
+
+    def load(self, path, colorkey=None):
+        try:
+            from PIL import Image
+        except ImportError:
+            import pygame
+            surface = pygame.image.load(path)
+            width, height = surface.get_size()
+            data = pygame.image.tostring(surface, 'RGBA')
+        else:
+            image = Image.open(path).convert('RGBA')
+            width, height = image.size
+            data = image.tobytes()
+
+        image = numpy.frombuffer(bytearray(data), dtype=numpy.uint8)
+        image = image.reshape(height, width, 4)
+
+        if colorkey:
+            rgb = [int(colorkey[i:i + 2], 16) for i in (0, 2, 4)]
+            image[(image[:, :, :3] == rgb).all(axis=2), 3] = 0
+
+        return image
+
+    def get_size(self, image):
+        return image.shape[1], image.shape[0]
+
+    def get_nbytes(self, image):
+        return image.nbytes
+
+    def subimage(self, image, rect):
+        x, y, w, h = rect
+        return image[y:y + h, x:x + w]
+
+    def transform(self, tile, flags):
+        # a rotated tile is also flipped; see tmxloader.handle_transformation
+        if flags & TRANS_ROT:
+            tile = tile.transpose(1, 0, 2)
+        if flags & TRANS_FLIPX:
+            tile = tile[:, ::-1]
+        if flags & TRANS_FLIPY:
+            tile = tile[::-1]
+        return tile
+
+    def convert(self, tile, colorkey=None, opaque=None):
+        if self.copy:
+            return numpy.ascontiguousarray(tile)
+        return tile
+
+    def pack(self, tiles, colorkey=None):
+        size, rects = pack_rects([self.get_size(tile) for tile in tiles])
+        atlas = numpy.zeros((size[1], size[0], 4), dtype=numpy.uint8)
+        for tile, (x, y, w, h) in zip(tiles, rects):
+            atlas[y:y + h, x:x + w] = tile
+        return atlas, rects
+
+
+class LazyImages(object):
+    """
+    The images of a map, which are made from the tileset images the first time
+    they are used.  works like the list of images made by load_images.
+
+    budget is the most bytes of memory that the tiles should use, or None for
+    no limit.  when the budget is exceeded, the least recently used tiles are
+    dropped until a quarter of the budget is free.  a dropped tile is made
+    again if it is used again.  images that are set or appended, such as the
+    images of image layers, are never dropped.
+    """
+
+    def __init__(self, loader, size, budget=None):
+        self.loader = loader
+        self.budget = budget
+        self.images = [0] * size   # images that are set, not made
+        self.sources = [None] * size
+        self.tiles = {}
+        self.last_used = {}
+        self.clock = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        for gid in xrange(len(self.images)):
+            yield self[gid]
+
+    def __getitem__(self, gid):
+        if gid < 0:
+            gid += len(self.images)
+
+        self.clock += 1
+        tile = self.tiles.get(gid)
+        if tile is None:
+            source = self.sources[gid]
+            if source is None:
+                return self.images[gid]
+            tile = self.make(source)
+            self.tiles[gid] = tile
+            self.nbytes += self.loader.get_nbytes(tile)
+            self.last_used[gid] = self.clock
+            if self.budget is not None and self.nbytes > self.budget:
+                self.evict(self.budget * 3 / 4)
+        else:
+            self.last_used[gid] = self.clock
+
+        return tile
+
+    def __setitem__(self, gid, image):
+        if gid < 0:
+            gid += len(self.images)
+
+        self.images[gid] = image
+        self.sources[gid] = None
+        self.drop(gid)
+
+    def append(self, image):
+        self.images.append(image)
+        self.sources.append(None)
+
+    def set_source(self, gid, image, rect, flags, colorkey=None, opaque=None):
+        """
+        set the tileset image and area that a tile is made from
+        """
+        self.sources[gid] = image, rect, flags, colorkey, opaque
+        self.drop(gid)
+
+    def make(self, (image, rect, flags, colorkey, opaque)):
+        """
+        make a tile from its source
+        """
+        loader = self.loader
+        tile = loader.transform(loader.subimage(image, rect), flags)
+        return loader.convert(tile, colorkey, opaque)
+
+    def drop(self, gid):
+        """
+        drop a tile that has been made, if it has been
+        """
+        tile = self.tiles.pop(gid, None)
+        if tile is not None:
+            del self.last_used[gid]
+            self.nbytes -= self.loader.get_nbytes(tile)
+
+    def evict(self, nbytes):
+        """
+        drop the least recently used tiles until at most nbytes are used
+        """
+        for gid in sorted(self.last_used, key=self.last_used.get):
+            if self.nbytes <= nbytes or self.last_used[gid] == self.clock:
+                break
+            self.drop(gid)
+
+    def clear(self):
+        """
+        drop all the tiles that have been made
+        """
+        self.tiles.clear()
+        self.last_used.clear()
+        self.nbytes = 0
+
+
+def pack_rects(sizes):
+    """
+    arrange images of the given (width, height) sizes in rows, to fit into a
+    roughly square atlas.  the tallest images are placed first.
+
+    return the (width, height) of the atlas and the (x, y, width, height) of
+    each image, in the same order as the sizes
+    """
+    tile_width = max(w for w, h in sizes)
+    area = sum(w * h for w, h in sizes)
+    columns = int(math.ceil(math.sqrt(area) / tile_width))
+    width = columns * tile_width
+
+    rects = [None] * len(sizes)
+    x = y = row_height = 0
+    for i in sorted(xrange(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[i]
+        if x + w > width:
+            x = 0
+            y += row_height
+            row_height = 0
+        rects[i] = (x, y, w, h)
+        row_height = max(row_height, h)
+        x += w
+
+    return (width, y + row_height), rects
+
+
+def tileset_tiles(ts, size):
+    """
+    return a list of (real gid, (x, y, width, height)) for the tiles in the
+    image of a tileset, where size is the size of the image
+    """
+    w, h = size
+
+    # margins and spacing
+    tilewidth = ts.tilewidth + ts.spacing
+    tileheight = ts.tileheight + ts.spacing
+
+    # some tileset images may be slightly larger than the tile area
+    # ie: may include a banner, copyright, ect.  this compensates for that
+    width = int((((w - ts.margin * 2 + ts.spacing) / tilewidth) * tilewidth) - ts.spacing)
+    height = int((((h - ts.margin * 2 + ts.spacing) / tileheight) * tileheight) - ts.spacing)
+
+    # trim off any pixels on the right side that isn't a tile
+    # this happens if extra graphics are included on the left, but they are not actually part of the tileset
+    width -= (w - ts.margin) % tilewidth
+
+    tiles = []
+    real_gid = ts.firstgid
+    for y in xrange(ts.margin, height + ts.margin, tileheight):
+        for x in xrange(ts.margin, width + ts.margin, tilewidth):
+            if x + ts.tilewidth - ts.spacing <= width:
+                tiles.append((real_gid, (x, y, ts.tilewidth, ts.tileheight)))
+            real_gid += 1
+
+    return tiles
+
+
+def pack_tileset(tmxdata, loader, ts, image, cached, colorkey, shared=False):
+    """
+    pack the tiles of a tileset that the map uses into an atlas.  return the
+    number of images that were set.
+
+    if shared is True, the atlas is kept in cached for other maps to use.  it
+    has every tile of the tileset, and the flipped and rotated tiles that the
+    maps have used so far.  it is only packed again when a map uses a flipped
+    or rotated tile that is not in it, so there is one atlas for each tileset.
+    """
+    rects = {}
+    variants = []
+    for real_gid, rect in tileset_tiles(ts, loader.get_size(image)):
+        tile_id = real_gid - ts.firstgid
+        rects[tile_id] = rect
+        for gid, flags in tmxdata.map_gid(real_gid):
+            variants.append((gid, (tile_id, flags)))
+
+    if not variants:
+        return 0
+
+    keys = set(key for gid, key in variants)
+    packed = cached.get('atlas')
+    if packed is None or not keys.issubset(packed[1]):
+        if shared:
+            keys.update((tile_id, 0) for tile_id in rects)
+            if packed is not None:
+                keys.update(packed[1])
+
+        keys = sorted(keys)
+        tiles = [loader.transform(loader.subimage(image, rects[tile_id]), flags)
+                 for tile_id, flags in keys]
+        atlas_image, atlas_rects = loader.pack(tiles, colorkey)
+        packed = atlas_image, dict(zip(keys, atlas_rects))
+        cached['atlas'] = packed
+
+    atlas_image, atlas_rects = packed
+    for gid, key in variants:
+        rect = atlas_rects[key]
+        tmxdata.tile_atlas[gid] = atlas_image, rect
+        tmxdata.images[gid] = loader.subimage(atlas_image, rect)
+
+    return len(variants)
+
+
+def load_images(tmxdata, loader, atlas=False, lazy=False, budget=None):
+    """
+    load the images of a map's tilesets and image layers with an ImageLoader
+
+    tmxdata.images[gid] is set to the image of each gid used by the map.  if
+    atlas is True, the tilesets are packed into atlases, tmxdata.tile_atlas is
+    set as well, and the images are areas of the atlases.
+
+    if lazy is True, tmxdata.images is a LazyImages with the given budget, and
+    only the tileset images are loaded now.
+    """
+    for done, total in iter_load_images(tmxdata, loader, atlas, lazy, budget):
+        pass
+
+
+def iter_load_images(tmxdata, loader, atlas=False, lazy=False, budget=None):
+    """
+    load the images of a map like load_images, a few at a time
+
+    this is a generator.  it yields (done, total) after each tile is made,
+    where done is the number of images set so far and total is about how
+    many there are to set.  the images are ready when it is exhausted.
+    """
+    if atlas and lazy:
+        msg = "Lazy images cannot be packed into atlases."
+        raise ValueError, msg
+
+    if lazy:
+        tmxdata.images = LazyImages(loader, tmxdata.maxgid, budget)
+    else:
+        tmxdata.images = [0] * tmxdata.maxgid
+    tmxdata.tile_atlas = [None] * tmxdata.maxgid if atlas else []
+    key = loader.cache_key()
+
+    done = 0
+    total = tmxdata.maxgid - 1
+    total += len([layer for layer in tmxdata.imagelayers
+                  if getattr(layer, 'source', None)])
+
+    for ts in tmxdata.tilesets:
+        # the image of an external tileset is relative to the TSX file
+        dirname = os.path.dirname(ts._filename or tmxdata.filename)
+        path = os.path.join(dirname, ts.source)
+        colorkey = getattr(ts, 'trans', None)
+
+        # the image and tiles of external tilesets are kept in the tileset
+        # cache, so they are only loaded and converted once for all maps
+        shared = bool(ts._filename and key is not None)
+        if shared:
+            cached = tileset_cache.get(ts._filename).image_data(key, path)
+        else:
+            cached = {}
+
+        image = cached.get('image')
+        if image is None:
+            image = cached['image'] = loader.load(path, colorkey)
+        tiles = cached.setdefault('tiles', {})
+
+        if atlas:
+            done += pack_tileset(tmxdata, loader, ts, image, cached, colorkey,
+                                 shared)
+            yield done, total
+            continue
+
+        # the tiles that have to be converted
+        used = []
+        for real_gid, rect in tileset_tiles(ts, loader.get_size(image)):
+            gids = tmxdata.map_gid(real_gid)
+            if gids:
+                used.append((real_gid, rect, gids))
+
+        rects = [rect for real_gid, rect, gids in used
+                 if lazy or any((real_gid - ts.firstgid, flags) not in tiles
+                                for gid, flags in gids)]
+        opacity = loader.get_opacity(path, image, rects) if rects else {}
+
+        if lazy:
+            for real_gid, rect, gids in used:
+                for gid, flags in gids:
+                    tmxdata.images.set_source(gid, image, rect, flags,
+                                              colorkey, opacity.get(rect))
+                    done += 1
+            yield done, total
+            continue
+
+        for real_gid, rect, gids in used:
+            original = None
+
+            for gid, flags in gids:
+                tile = tiles.get((real_gid - ts.firstgid, flags))
+                if tile is None:
+                    if original is None:
+                        original = loader.subimage(image, rect)
+                    tile = loader.transform(original, flags)
+                    tile = loader.convert(tile, colorkey, opacity.get(rect))
+                    tiles[(real_gid - ts.firstgid, flags)] = tile
+                    tmxdata.images[gid] = tile
+                    done += 1
+                    yield done, total
+                else:
+                    tmxdata.images[gid] = tile
+                    done += 1
+
+        yield done, total
+
+    # load image layer images
+    for layer in tmxdata.all_layers:
+        if isinstance(layer, pytmx.TiledImageLayer):
+            source = getattr(layer, 'source', None)
+            if source:
+                colorkey = getattr(layer, 'trans', None)
+                real_gid = len(tmxdata.images)
+                gid = tmxdata.register_gid(real_gid)
+                layer.gid = gid
+                path = os.path.join(os.path.dirname(tmxdata.filename), source)
+                image = loader.load(path, colorkey)
+                image = loader.convert(image, colorkey)
+                tmxdata.images.append(image)
+                if atlas:
+                    width, height = loader.get_size(image)
+                    tmxdata.tile_atlas.append((image, (0, 0, width, height)))
+                done += 1
+                yield done, total
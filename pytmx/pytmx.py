@@ -1,12 +1,26 @@
-from itertools import chain, product
-from xml.etree import ElementTree
+from itertools import chain, product, izip
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from .utils import decode_gid, types, parse_properties, read_points
+from .utils import parse_tile_properties
+from .utils import unpack_gids, read_csv_gids, gid_typecode, numpy, GID_TYPECODE, GID_DTYPES
+import array
 from .constants import *
+from .spatial import ObjectIndex, rect_bounds
+from .chunks import TileChunks, CHUNK_SIZE
 
-__all__ = ['TiledMap', 'TiledTileset', 'TiledLayer', 'TiledObject', 'TiledObjectGroup', 'TiledImageLayer']
+__all__ = ['TiledMap', 'TiledTileset', 'TiledLayer', 'TiledObject', 'CompactTiledObject', 'TiledObjectGroup', 'TiledImageLayer']
+
+# number of tiles that register_gids looks at together
+GID_BLOCK = 0x10000
 
 
 class TiledElement(object):
+    # so that subclasses can use __slots__
+    __slots__ = ()
+
     def set_properties(self, node):
         """
         read the xml attributes and tiled "properties" from a xml node and fill
@@ -37,10 +51,63 @@ class TiledMap(TiledElement):
 
     reserved = "visible version orientation width height tilewidth tileheight properties tileset layer objectgroup".split()
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, layer_storage="array", lazy_layers=False,
+                 progress=None, compact_objects=False, region=None):
+        """
+        layer_storage determines how the tile layer data is stored:
+            "array": list of array.array rows (default)
+            "numpy": 2d numpy array; requires numpy
+
+        either way, tiles are accessed with layer.data[y][x]
+
+        if lazy_layers is True, the data of each tile layer is kept as it was
+        read, and is only decoded the first time it is used.  compressed data
+        stays compressed; other data is kept as raw gids, 4 bytes a tile.  the
+        gids are still registered when the map is loaded, so they are the
+        same either way.
+
+        the layers of infinite maps are always stored in chunks, which are
+        decoded when they are used; see pytmx.chunks.
+
+        progress is called as progress(kind, item) when each part of the map
+        has been loaded; see load.
+
+        if compact_objects is True, objects are CompactTiledObjects, which use
+        much less memory than TiledObjects.
+
+        if region is set to an (x, y, width, height) in tiles, only that part
+        of the map is loaded: the tiles of each layer in the region, and the
+        objects that overlap it.  only the gids of those tiles and objects are
+        registered.  positions are still those of the whole map, and tiles
+        outside of the region are empty.  the layers are stored in chunks;
+        see pytmx.chunks.
+        """
         from collections import defaultdict
 
+        if layer_storage not in ("array", "numpy"):
+            msg = "Layer storage must be \"array\" or \"numpy\".  Got {0} instead."
+            raise ValueError, msg.format(layer_storage)
+
+        if layer_storage == "numpy" and numpy is None:
+            msg = "Layer storage \"numpy\" requires numpy to be installed."
+            raise ValueError, msg
+
+        if region is not None:
+            try:
+                region = tuple(map(int, region))
+                assert len(region) == 4
+            except (TypeError, ValueError, AssertionError):
+                msg = "Region must be a rect-like (x, y, width, height).  Got {0} instead."
+                raise ValueError, msg.format(region)
+
         TiledElement.__init__(self)
+
+        # the options are private, so map properties with the same names
+        # don't replace them
+        self._layer_storage = layer_storage
+        self._lazy_layers = lazy_layers
+        self._region = region
+        self._compact_objects = compact_objects
         self.tilesets = []  # list of TiledTileset objects
         self.tilelayers = []  # list of TiledLayer objects
         self.imagelayers = []  # list of TiledImageLayer objects
@@ -59,6 +126,9 @@ class TiledMap(TiledElement):
         # should be filled in by a loader function
         self.images = []
 
+        # (atlas image, rect) of each gid; filled in by loaders in atlas mode
+        self.tile_atlas = []
+
         # defaults from the TMX specification
         self.version = 0.0
         self.orientation = None
@@ -66,13 +136,24 @@ class TiledMap(TiledElement):
         self.height = 0      # height of map in tiles
         self.tilewidth = 0   # width of a tile in pixels
         self.tileheight = 0  # height of a tile in pixels
+        self.infinite = False  # layers are stored in chunks; see TileChunks
         self.background_color = None
 
         self.imagemap = {}  # mapping of gid and trans flags to real gids
         self.maxgid = 1
 
+        # tile layers use the narrowest typecode that fits the internal gids
+        self.layer_typecode = gid_typecode(self.maxgid)
+
+        # index of gid locations; built when needed.  see build_gid_index
+        self.gid_locations = None
+        self.layer_gids = None
+
+        # spatial index of the objects; built when needed
+        self.object_index = None
+
         if filename:
-            self.load()
+            self.load(progress)
 
     def __repr__(self):
         return "<{0}: \"{1}\">".format(self.__class__.__name__, self.filename)
@@ -92,8 +173,9 @@ class TiledMap(TiledElement):
             print msg
             raise TypeError
 
+        # infinite maps can have tiles at negative positions
         try:
-            assert (x >= 0 and y >= 0)
+            assert (x >= 0 and y >= 0) or self.infinite
         except AssertionError:
             raise ValueError
 
@@ -119,6 +201,25 @@ class TiledMap(TiledElement):
             print msg.format(gid)
             raise TypeError
 
+    def getTileAtlasByGid(self, gid):
+        """
+        return the (atlas image, rect) of a gid, when the images were loaded
+        in atlas mode.  the tile is drawn with surface.blit(atlas, pos, rect)
+
+        return value will be None if the gid has no image.
+        """
+        try:
+            assert (gid >= 0)
+            return self.tile_atlas[gid]
+        except (IndexError, ValueError, AssertionError):
+            msg = "Invalid GID specified: {}"
+            print msg.format(gid)
+            raise ValueError
+        except TypeError:
+            msg = "GID must be specified as integer: {}"
+            print msg.format(gid)
+            raise TypeError
+
     def getTileGID(self, x, y, layer):
         """
         return GID of a tile in this location
@@ -146,12 +247,56 @@ class TiledMap(TiledElement):
     def getTileImages(self, r, layer):
         """
         return a group of tiles in an area
-        expects a pygame rect or rect-like list/tuple
+        expects a pygame rect or rect-like list/tuple, in tile coordinates,
+        and a layer number or a list of layer numbers
+
+        returns a generator of (x, y, layer, image) tuples, one layer after
+        another.  the area is clipped to the map and empty tiles are skipped.
+        on infinite maps, only the chunks in the area are visited.
 
         useful if you don't want to repeatedly call getTileImage
         """
 
-        raise NotImplementedError
+        try:
+            x, y, w, h = map(int, r)
+        except (TypeError, ValueError):
+            msg = "Area must be a rect-like (x, y, width, height).  Got {0} instead."
+            raise ValueError, msg.format(r)
+
+        try:
+            layers = [int(layer)]
+        except TypeError:
+            layers = map(int, layer)
+
+        try:
+            layer_data = [(l, self.tilelayers[l].data) for l in layers]
+        except IndexError:
+            msg = "Layers {0} are not valid."
+            raise ValueError, msg.format(layers)
+
+        # bounds are only checked once, not once per tile
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+
+        def get_tiles():
+            images = self.images
+            for l, data in layer_data:
+                if isinstance(data, TileChunks):
+                    for tx, ty, gid in data.iter_region(x, y, w, h):
+                        yield tx, ty, l, images[gid]
+                    continue
+
+                if self._layer_storage == "numpy":
+                    rows = data[y0:y1, x0:x1].tolist()
+                else:
+                    rows = (row[x0:x1] for row in data[y0:y1])
+
+                for ty, row in enumerate(rows, y0):
+                    for tx, gid in enumerate(row, x0):
+                        if gid:
+                            yield tx, ty, l, images[gid]
+
+        return get_tiles()
 
     def getObjects(self):
         """
@@ -160,6 +305,93 @@ class TiledMap(TiledElement):
 
         return chain(*(i for i in self.objectgroups))
 
+    def object_cell_size(self):
+        """
+        return the default cell size of object indexes: four tiles
+        """
+        return max(self.tilewidth, self.tileheight) * 4 or 64
+
+    def build_object_index(self, cell_size=None):
+        """
+        build the spatial index of all the objects of the map, which is used
+        by query_rect, query_point and nearest.  see pytmx.spatial.
+
+        it is built the first time it is needed, but cell_size, in pixels,
+        can only be chosen here.
+        """
+        cell_size = cell_size or self.object_cell_size()
+        self.object_index = ObjectIndex(self.objects, cell_size)
+        return self.object_index
+
+    def query_rect(self, rect):
+        """
+        return the objects that overlap a rect (x, y, width, height), in pixels
+        """
+        if self.object_index is None:
+            self.build_object_index()
+        return self.object_index.query_rect(rect)
+
+    def query_point(self, x, y):
+        """
+        return the objects that contain a point, in pixels
+        """
+        if self.object_index is None:
+            self.build_object_index()
+        return self.object_index.query_point(x, y)
+
+    def nearest(self, x, y, count=1, max_distance=None):
+        """
+        return up to count objects nearest to a point, nearest first
+        """
+        if self.object_index is None:
+            self.build_object_index()
+        return self.object_index.nearest(x, y, count, max_distance)
+
+    def update_object(self, obj):
+        """
+        update the object indexes of the map and of the object groups after
+        an object has been moved or resized
+        """
+        if self.object_index is not None:
+            self.object_index.update(obj)
+
+        for group in self.objectgroups:
+            if group.object_index is not None and obj in group.object_index:
+                group.object_index.update(obj)
+
+    def object_in_region(self, node):
+        """
+        check if the bounds of an object element overlap the region of the
+        map.  objects on the right or bottom edge belong to the next region.
+
+        tile objects are anchored at their bottom left corner.  the tilesets
+        are not loaded yet, so tile objects without a size are taken to be
+        as big as the tiles of the map.
+        """
+        x, y = float(node.get('x', 0)), float(node.get('y', 0))
+        tile = bool(node.get('gid'))
+        if tile:
+            width = float(node.get('width', self.tilewidth))
+            height = float(node.get('height', self.tileheight))
+        else:
+            width = float(node.get('width', 0))
+            height = float(node.get('height', 0))
+
+        points = None
+        for tag in ('polygon', 'polyline'):
+            child = node.find(tag)
+            if child is not None:
+                points = [(x + px, y + py) for px, py in read_points(child.get('points'))]
+
+        left, top, right, bottom = rect_bounds(x, y, width, height,
+                                               float(node.get('rotation', 0)),
+                                               points, tile)
+
+        rx, ry, rw, rh = self._region
+        tw, th = self.tilewidth, self.tileheight
+        return (left < (rx + rw) * tw and right >= rx * tw and
+                top < (ry + rh) * th and bottom >= ry * th)
+
     def getTileProperties(self, (x, y, layer)):
         """
         return the properties for the tile, if any
@@ -203,12 +435,147 @@ class TiledMap(TiledElement):
     def getTileLocation(self, gid):
         # experimental way to find locations of a tile by the GID
 
-        p = product(xrange(self.width),
-                    xrange(self.height),
-                    xrange(len(self.tilelayers)))
+        # empty tiles are not in the index
+        if not gid:
+            p = product(xrange(self.width),
+                        xrange(self.height),
+                        xrange(len(self.tilelayers)))
+
+            return [(x, y, l) for (x, y, l) in p
+                    if self.tilelayers[l].data[y][x] == gid]
+
+        self.build_gid_index()
+
+        w = self.width
+        found = []
+        for l, indexes in self.gid_locations.get(gid, {}).items():
+            if isinstance(self.tilelayers[l].data, TileChunks):
+                found.extend((x, y, l) for x, y in indexes)
+            else:
+                found.extend((i % w, i // w, l) for i in indexes)
+
+        return sorted(found)
+
+    def setTileGID(self, x, y, layer, gid):
+        """
+        set the GID of a tile in this location
+        x and y must be integers and are in tile coordinates, not pixel
+
+        the gid must be a gid used internally; see register_gid
+        """
+
+        try:
+            x, y, layer, gid = map(int, (x, y, layer, gid))
+        except TypeError:
+            msg = "Tile indexes/layers/gids must be specified as integers."
+            raise TypeError, msg
+
+        if not 0 <= gid < self.maxgid:
+            msg = "Invalid GID specified: {0}"
+            raise ValueError, msg.format(gid)
+
+        try:
+            assert ((x >= 0 and y >= 0) or self.infinite) and layer >= 0
+            data = self.tilelayers[layer].data
+            old_gid = data[y][x]
+            data[y][x] = gid
+        except (IndexError, AssertionError):
+            msg = "Coords: ({0},{1}) in layer {2} is invalid."
+            raise ValueError, msg.format(x, y, layer)
+
+        # keep the gid index up to date, if the layer is in it
+        if (self.gid_locations is not None and old_gid != gid and
+                self.layer_gids[layer] is not None):
+            if isinstance(data, TileChunks):
+                i = x, y
+            else:
+                i = y * self.width + x
+            # empty tiles of chunked layers are not counted, as the tiles
+            # outside of the chunks are empty too
+            counts = self.layer_gids[layer]
+            if old_gid in counts:
+                counts[old_gid] -= 1
+                if not counts[old_gid]:
+                    del counts[old_gid]
+            if gid or not isinstance(data, TileChunks):
+                counts[gid] = counts.get(gid, 0) + 1
+
+            if old_gid:
+                locations = self.gid_locations[old_gid]
+                locations[layer].discard(i)
+                if not locations[layer]:
+                    del locations[layer]
+                if not locations:
+                    del self.gid_locations[old_gid]
+
+            if gid:
+                self.gid_locations.setdefault(gid, {}).setdefault(layer, set()).add(i)
+
+    def build_gid_index(self, layers=None):
+        """
+        build an index of the locations of each gid, and of the gids used
+        in each tile layer.  lookups will then only visit the matching tiles.
+
+        layers is a list of the tile layers to index, by index, or None for
+        all of them.  layers that are already in the index are skipped, and
+        layers that are not indexed are not decoded.
+
+        the index is built the first time getTileLocation or
+        getTilePropertiesByLayer need it, and setTileGID keeps it up to date.
+        """
+
+        if self.gid_locations is None:
+            # gid: {layer: set of y * width + x, or (x, y) if chunked}
+            self.gid_locations = {}
+            # for each layer, {gid: number of tiles}, or None if not indexed
+            self.layer_gids = [None] * len(self.tilelayers)
+
+        if layers is None:
+            layers = xrange(len(self.tilelayers))
 
-        return [(x, y, l) for (x, y, l) in p
-                if self.tilelayers[l].data[y][x] == gid]
+        for l in layers:
+            if self.layer_gids[l] is None:
+                self.index_layer(l)
+
+    def index_layer(self, l):
+        """
+        add a tile layer to the gid index, by index
+        """
+
+        layer = self.tilelayers[l]
+        counts = self.layer_gids[l] = {}
+
+        if isinstance(layer.data, TileChunks):
+            indexes = {}
+            for x, y, gid in layer.data.iter_tiles():
+                if not gid:
+                    continue
+                try:
+                    indexes[gid].append((x, y))
+                except KeyError:
+                    indexes[gid] = [(x, y)]
+        elif self._layer_storage == "numpy":
+            flat = layer.data.ravel()
+            order = numpy.argsort(flat, kind='mergesort')
+            gids, starts, sizes = numpy.unique(flat[order],
+                                               return_index=True,
+                                               return_counts=True)
+            indexes = dict((gid, order[start:start + size].tolist())
+                           for gid, start, size in izip(gids.tolist(),
+                                                        starts.tolist(),
+                                                        sizes.tolist()))
+        else:
+            indexes = {}
+            for i, gid in enumerate(chain.from_iterable(layer.data)):
+                try:
+                    indexes[gid].append(i)
+                except KeyError:
+                    indexes[gid] = [i]
+
+        for gid, i in indexes.items():
+            counts[gid] = len(i)
+            if gid:
+                self.gid_locations.setdefault(gid, {})[l] = set(i)
 
     def getTilePropertiesByGID(self, gid):
         try:
@@ -239,8 +606,14 @@ class TiledMap(TiledElement):
             msg = "Layer must be an integer.  Got {0} instead."
             raise ValueError, msg.format(type(layer))
 
-        p = product(range(self.width), range(self.height))
-        layergids = set(self.tilelayers[layer].data[y][x] for x, y in p)
+        if not -len(self.tilelayers) <= layer < len(self.tilelayers):
+            msg = "Layer {0} does not exist."
+            raise ValueError, msg.format(layer)
+
+        # only this layer is indexed, so other lazy layers stay encoded
+        layer %= len(self.tilelayers)
+        self.build_gid_index([layer])
+        layergids = self.layer_gids[layer]
 
         props = []
         for gid in layergids:
@@ -269,57 +642,189 @@ class TiledMap(TiledElement):
                 self.maxgid += 1
                 self.imagemap[(real_gid, flags)] = (gid, flags)
                 self.gidmap[real_gid].append((gid, flags))
+
+                # the new gid may not fit into the layers anymore
+                typecode = gid_typecode(gid)
+                if typecode != self.layer_typecode:
+                    self.widen_layers(typecode)
+
                 return gid
         else:
             return 0
 
+    def widen_layers(self, typecode):
+        """
+        convert the data of all tile layers to a wider array typecode.
+        this is done automatically by register_gid when needed.
+        """
+
+        self.layer_typecode = typecode
+        for layer in self.tilelayers:
+            # lazy layers will use the new typecode when they are decoded
+            if layer.payload is not None:
+                continue
+
+            if isinstance(layer.data, TileChunks):
+                layer.data.convert(typecode, self._layer_storage)
+            elif self._layer_storage == "numpy":
+                layer.data = layer.data.astype(GID_DTYPES[typecode])
+            else:
+                layer.data = [array.array(typecode, row) for row in layer.data]
+
+    def register_gids(self, raw_gids, remap=True):
+        """
+        register a sequence of raw gids read from a TMX file's data in bulk.
+        flags are decoded and each unique raw gid is registered only once.
+
+        unique gids are registered in the order they first appear, so the
+        internal gids are the same as calling register_gid for every tile.
+
+        returns a sequence of the internal gids, or None if remap is False
+        """
+
+        if numpy is not None:
+            raw_gids = numpy.asarray(raw_gids, dtype=numpy.uint32).ravel()
+
+            # one pass over the tiles, a block at a time.  each block is
+            # looked up in the few raw gids seen so far, and only the tiles
+            # with new gids are sorted to find their first appearance.
+            known = numpy.empty(0, dtype=numpy.uint32)  # sorted raw gids
+            lut = numpy.empty(0, dtype=numpy.uint32)    # their internal gids
+            for start in xrange(0, len(raw_gids), GID_BLOCK):
+                block = raw_gids[start:start + GID_BLOCK]
+                if len(known):
+                    i = numpy.minimum(known.searchsorted(block), len(known) - 1)
+                    block = block[known[i] != block]
+                    if not len(block):
+                        continue
+
+                unique, first = numpy.unique(block, return_index=True)
+                unique = unique[first.argsort()]
+                gids = [self.register_gid(*decode_gid(int(raw_gid)))
+                        for raw_gid in unique]
+
+                known = numpy.concatenate((known, unique))
+                lut = numpy.concatenate((lut, numpy.asarray(gids, dtype=numpy.uint32)))
+                order = known.argsort()
+                known, lut = known[order], lut[order]
+
+            return lut[known.searchsorted(raw_gids)] if remap else None
+
+        # index of the first appearance of each raw gid.  reversed, so that
+        # the first appearance is the one that is kept.
+        first = dict(izip(reversed(raw_gids), xrange(len(raw_gids) - 1, -1, -1)))
+
+        lut = {}
+        for raw_gid in sorted(first, key=first.get):
+            lut[raw_gid] = self.register_gid(*decode_gid(raw_gid))
+
+        return map(lut.__getitem__, raw_gids) if remap else None
+
     def map_gid(self, real_gid):
         """
         used to lookup a GID read from a TMX file's data
+
+        returns a list of (gid, flags), which is empty if the gid has not
+        been registered.  looking up a gid does not register it.
         """
 
         try:
-            return self.gidmap[int(real_gid)]
-        except KeyError:
-            return None
+            return self.gidmap.get(int(real_gid), [])
         except TypeError:
             msg = "GIDs must be an integer"
             raise TypeError, msg
 
-    def loadTileImages(self, filename):
-        raise NotImplementedError
+    def save_compiled(self, path):
+        """
+        save the map to a compiled file, which loads much faster than the TMX
+        file.  see load_tmx and compiled.load_compiled.
+        """
+        from .compiled import save_compiled
 
-    def load(self):
+        save_compiled(self, path)
+
+    def loadTileImages(self, loader, atlas=False, lazy=False, budget=None):
+        """
+        load the images of the tiles and image layers with an ImageLoader
+
+        if atlas is True, each tileset is packed into one image; see
+        getTileAtlasByGid.
+
+        if lazy is True, each tile image is only made when it is first used,
+        and budget limits the bytes used by the tile images; see LazyImages.
+
+        see pytmx.imageloader.  pygame users can use load_pygame instead.
+        """
+        from .imageloader import load_images
+        load_images(self, loader, atlas, lazy, budget)
+
+    def load(self, progress=None):
         """
         parse a map node from a tiled tmx file
+
+        the file is parsed incrementally.  each tile layer is loaded as soon
+        as it has been read and is then removed from the document, so only
+        one layer is held as xml at a time.
+
+        if progress is set, it is called as progress(kind, item) after each
+        part of the map is loaded, where kind is "layer", "imagelayer",
+        "objectgroup" or "tileset" and item is the part.
         """
-        etree = ElementTree.parse(self.filename).getroot()
-        self.set_properties(etree)
+        etree = None
+        depth = 0
 
         # initialize the gid mapping
         self.imagemap[(0, 0)] = 0
 
-        self.background_color = etree.get('backgroundcolor', self.background_color)
-
         # *** do not change this load order!  gid mapping errors will occur if changed ***
-        for node in etree.findall('layer'):
-            self.addTileLayer(TiledLayer(self, node))
+        # tile layers are loaded first, in the order they are read.  image
+        # layers, object groups and tilesets are small, so they are kept and
+        # loaded after the whole map has been read.
+        for event, node in ElementTree.iterparse(self.filename, ('start', 'end')):
+            if event == 'start':
+                if etree is None:
+                    # the map's properties haven't been read yet
+                    etree = node
+                    self.set_properties(etree)
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1 and node.tag == 'layer':
+                self.addTileLayer(TiledLayer(self, node))
+                etree.remove(node)
+                node.clear()
+                if progress:
+                    progress("layer", self.tilelayers[-1])
+
+        self.set_properties(etree)
+
+        self.background_color = etree.get('backgroundcolor', self.background_color)
 
         for node in etree.findall('imagelayer'):
             self.addImageLayer(TiledImageLayer(self, node))
+            if progress:
+                progress("imagelayer", self.imagelayers[-1])
 
         for node in etree.findall('objectgroup'):
             self.objectgroups.append(TiledObjectGroup(self, node))
+            if progress:
+                progress("objectgroup", self.objectgroups[-1])
 
         for node in etree.findall('tileset'):
             self.tilesets.append(TiledTileset(self, node))
+            if progress:
+                progress("tileset", self.tilesets[-1])
 
         # "tile objects", objects with a GID, have need to have their
         # attributes set after the tileset is loaded, so this step must be performed last
         for o in self.objects:
             p = self.getTilePropertiesByGID(o.gid)
             if p:
-                o.__dict__.update(p)
+                if self._compact_objects:
+                    o.set_tile_properties(p)
+                else:
+                    o.__dict__.update(p)
 
     def addTileLayer(self, layer):
         """
@@ -334,6 +839,10 @@ class TiledMap(TiledElement):
         self.all_layers.append(layer)
         self.layernames[layer.name] = layer
 
+        # the new layer is indexed when it is needed
+        if self.gid_locations is not None:
+            self.layer_gids.append(None)
+
     def addImageLayer(self, layer):
         """
         Add a TiledImageLayer layer object to the map.
@@ -414,6 +923,10 @@ class TiledTileset(TiledElement):
         self.width = 0
         self.height = 0
 
+        # path of the external TSX file, if the tileset is not in the map.  it
+        # is private, so a tileset property named filename does not replace it
+        self._filename = None
+
         self.parse(node)
 
     def __repr__(self):
@@ -427,6 +940,7 @@ class TiledTileset(TiledElement):
         a bit of mangling is done here so that tilesets that have external
         TSX files appear the same as those that don't
         """
+        from .cache import tileset_cache
         import os
 
         # if true, then node references an external tileset
@@ -440,26 +954,36 @@ class TiledTileset(TiledElement):
                 # we need to mangle the path - tiled stores relative paths
                 dirname = os.path.dirname(self.parent.filename)
                 path = os.path.abspath(os.path.join(dirname, source))
+                self._filename = path
+
+                # external tilesets are shared by maps, so they are cached
                 try:
-                    node = ElementTree.parse(path).getroot()
-                except IOError:
+                    entry = tileset_cache.get(path)
+                except EnvironmentError:
                     msg = "Cannot load external tileset: {0}"
                     raise Exception, msg.format(path)
 
+                node, tiles = entry.node, entry.tiles
+
             else:
                 msg = "Found external tileset, but cannot handle type: {0}"
                 raise Exception, msg.format(self.source)
 
+        else:
+            tiles = parse_tile_properties(node)
+
         self.set_properties(node)
 
         # since tile objects [probably] don't have a lot of metadata,
         # we store it separately in the parent (a TiledMap instance)
-        for child in node.getiterator('tile'):
-            real_gid = int(child.get("id"))
-            p = parse_properties(child)
+        for real_gid, p in tiles:
+            p = dict(p)
             p['width'] = self.tilewidth
             p['height'] = self.tileheight
-            self.parent.register_gid(real_gid + self.firstgid)
+
+            # when loading a region, only the tiles used in it are registered
+            if self.parent._region is None:
+                self.parent.register_gid(real_gid + self.firstgid)
             for gid, flags in self.parent.map_gid(real_gid + self.firstgid):
                 self.parent.setTileProperties(gid, p)
 
@@ -476,6 +1000,9 @@ class TiledLayer(TiledElement):
         self.parent = parent
         self.data = []
 
+        # encoded data of a lazy layer, until it is decoded
+        self.payload = None
+
         # defaults from the specification
         self.name = None
         self.opacity = 1.0
@@ -487,83 +1014,267 @@ class TiledLayer(TiledElement):
         return self.iter_tiles()
 
     def iter_tiles(self):
+        # only the tiles of the chunks of infinite maps
+        if isinstance(self.data, TileChunks):
+            for tile in self.data:
+                yield tile
+            return
+
         for y, x in product(range(self.height), range(self.width)):
             yield x, y, self.data[y][x]
 
     def __repr__(self):
         return "<{0}: \"{1}\">".format(self.__class__.__name__, self.name)
 
+    def __getattr__(self, name):
+        # lazy layers are decoded the first time the data is used
+        if name == "data" and self.__dict__.get("payload") is not None:
+            self.decode()
+            return self.data
+
+        raise AttributeError, name
+
     def parse(self, node):
         """
         parse a layer element
         """
-        from utils import group
-        from itertools import product, imap
-        from struct import unpack
-        import array
-
         self.set_properties(node)
 
-        data = None
-        next_gid = None
-
         data_node = node.find('data')
 
         encoding = data_node.get("encoding", None)
+        if encoding not in (None, "base64", "csv"):
+            msg = "TMX encoding type: {0} is not supported."
+            raise Exception, msg.format(encoding)
+
+        compression = data_node.get("compression", None)
+        if compression not in (None, "gzip", "zlib"):
+            msg = "TMX compression type: {0} is not supported."
+            raise Exception, msg.format(compression)
+
+        chunk_nodes = data_node.findall('chunk')
+        if chunk_nodes:
+            self.parse_chunks(chunk_nodes, encoding, compression)
+            return
+
+        payload = self.read_payload(data_node, encoding, self.width * self.height)
+
+        if self.parent._region is not None:
+            self.parse_window(self.read_gids(payload, compression))
+            return
+
+        if self.parent._lazy_layers:
+            # the gids are registered now, in the same order as when loading
+            # eagerly, so the internal gids don't depend on when, or if, the
+            # layer is decoded.  compressed data is decompressed again when
+            # used; other data is kept as the raw gids already read.
+            raw_gids = self.read_gids(payload, compression)
+            self.parent.register_gids(raw_gids, remap=False)
+
+            if compression is None:
+                payload = raw_gids
+
+            self.payload = payload, compression
+            del self.data
+        else:
+            self.data = self.build_data(self.read_gids(payload, compression))
+
+    def parse_chunks(self, chunk_nodes, encoding, compression):
+        """
+        parse the chunks of a layer of an infinite map.  the gids of every
+        chunk are registered now, but the chunks are decoded when used.
+        """
+        chunks = None
+        for chunk_node in chunk_nodes:
+            width = int(chunk_node.get('width'))
+            height = int(chunk_node.get('height'))
+            if chunks is None:
+                chunks = TileChunks(self, width, height)
+            elif (width, height) != (chunks.chunk_width, chunks.chunk_height):
+                msg = "Chunks of layer \"{0}\" are not all the same size."
+                raise Exception, msg.format(self.name)
+
+            x, y = int(chunk_node.get('x')), int(chunk_node.get('y'))
+            payload = self.read_payload(chunk_node, encoding, width * height)
+            raw_gids = self.read_gids(payload, compression, width * height)
+
+            # only the tiles in the region of the map are kept
+            if self.parent._region is not None:
+                raw_gids = self.clip_chunk(raw_gids, x, y, width, height)
+                if raw_gids is None:
+                    continue
+                self.parent.register_gids(raw_gids, remap=False)
+                chunks.add_payload(x, y, raw_gids, None)
+                continue
+
+            self.parent.register_gids(raw_gids, remap=False)
+            chunks.add_payload(x, y, payload, compression)
+
+        self.data = chunks
+
+    def window(self):
+        """
+        return the (left, top, right, bottom) of the tiles of the layer in the
+        region of the map
+        """
+        x, y, w, h = self.parent._region
+        if self.parent.infinite:
+            return x, y, x + w, y + h
+
+        return (max(x, 0), max(y, 0),
+                min(x + w, self.width), min(y + h, self.height))
+
+    def clip_chunk(self, raw_gids, x, y, width, height):
+        """
+        return the raw gids of a chunk at x, y, with the tiles outside of the
+        region of the map emptied, or None if none are left
+        """
+        x0, y0, x1, y1 = self.window()
+        left, right = max(x0, x), min(x1, x + width)
+        if left >= right or max(y0, y) >= min(y1, y + height):
+            return None
+
+        clipped = array.array(GID_TYPECODE, [0]) * (width * height)
+        for ty in xrange(max(y0, y), min(y1, y + height)):
+            i = (ty - y) * width + left - x
+            clipped[i:i + right - left] = array.array(GID_TYPECODE, raw_gids[i:i + right - left])
+
+        if not any(clipped):
+            return None
+
+        return clipped
+
+    def parse_window(self, raw_gids):
+        """
+        keep only the tiles of the layer in the region of the map, in chunks.
+        the gids of the other tiles are not registered.
+        """
+        x0, y0, x1, y1 = self.window()
+        size = CHUNK_SIZE
+        chunks = TileChunks(self, size, size)
+        self.data = chunks
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # the tiles of the region are registered at once, one row after
+        # another, in the order they appear
+        if numpy is not None:
+            rows = numpy.asarray(raw_gids, dtype=numpy.uint32)
+            rows = rows.reshape(self.height, self.width)[y0:y1, x0:x1]
+            window = rows.ravel()
+        else:
+            rows = [raw_gids[y * self.width + x0:y * self.width + x1]
+                    for y in xrange(y0, y1)]
+            window = array.array(GID_TYPECODE)
+            for row in rows:
+                window.extend(row)
+        self.parent.register_gids(window, remap=False)
+
+        for cy in xrange(y0 // size, (y1 - 1) // size + 1):
+            top, bottom = max(y0, cy * size), min(y1, (cy + 1) * size)
+            for cx in xrange(x0 // size, (x1 - 1) // size + 1):
+                left, right = max(x0, cx * size), min(x1, (cx + 1) * size)
+                gids = array.array(GID_TYPECODE, [0]) * (size * size)
+                for y in xrange(top, bottom):
+                    i = (y - cy * size) * size + left - cx * size
+                    gids[i:i + right - left] = array.array(GID_TYPECODE,
+                                                           rows[y - y0][left - x0:right - x0])
+
+                if any(gids):
+                    chunks.add_payload(cx * size, cy * size, gids, None)
+
+    def read_payload(self, node, encoding, size=None):
+        """
+        return the encoded data of a data or chunk element.  csv data is
+        checked to have size gids, if size is set.
+        """
         if encoding == "base64":
             from base64 import decodestring
 
-            data = decodestring(data_node.text.strip())
+            return decodestring(node.text.strip())
 
         elif encoding == "csv":
-            next_gid = imap(int, "".join(
-                line.strip() for line in data_node.text.strip()
-            ).split(","))
+            return read_csv_gids(node.text, size)
 
-        elif encoding:
-            msg = "TMX encoding type: {0} is not supported."
-            raise Exception, msg.format(encoding)
+        # if there is no encoding, we assume here that it is going to be a
+        # bunch of tile elements
+        return array.array(GID_TYPECODE, (int(child.get('gid'))
+                           for child in node.findall('tile')))
+
+    def decode(self):
+        """
+        decode the data of a lazy layer.  this is done automatically the first
+        time the data is used.
+        """
+
+        payload, compression = self.payload
+        self.data = self.build_data(self.read_gids(payload, compression))
+        self.payload = None
+
+    def read_gids(self, payload, compression, size=None):
+        """
+        return the raw gids of the layer, or of size tiles of a chunk, from
+        the (compressed) payload
+        """
 
-        compression = data_node.get("compression", None)
         if compression == "gzip":
             from StringIO import StringIO
             import gzip
 
-            fh = gzip.GzipFile(fileobj=StringIO(data))
-            data = fh.read()
+            fh = gzip.GzipFile(fileobj=StringIO(payload))
+            payload = fh.read()
             fh.close()
 
         elif compression == "zlib":
             import zlib
 
-            data = zlib.decompress(data)
+            payload = zlib.decompress(payload)
 
-        elif compression:
-            msg = "TMX compression type: {0} is not supported."
-            raise Exception, msg.format(str(attr["compression"]))
-
-        # if data is None, then it was not decoded or decompressed, so
-        # we assume here that it is going to be a bunch of tile elements
-        # TODO: this will probably raise an exception if there are no tiles
-        if encoding == next_gid is None:
-            def get_children(parent):
-                for child in parent.findall('tile'):
-                    yield int(child.get('gid'))
+        if isinstance(payload, str):
+            # data is a list of gids. cast as 32-bit ints to format properly
+            raw_gids = unpack_gids(payload)
+        else:
+            raw_gids = payload
 
-            next_gid = get_children(data_node)
+        if size is None:
+            size = self.width * self.height
+        if len(raw_gids) < size:
+            msg = "Layer \"{0}\" has {1} tiles, expected {2}."
+            raise Exception, msg.format(self.name, len(raw_gids), size)
 
-        elif data:
-            # data is a list of gids. cast as 32-bit ints to format properly
-            # create iterator to efficiently parse data
-            next_gid = imap(lambda i: unpack("<L", "".join(i))[0], group(data, 4))
+        return raw_gids[:size]
 
-        # using bytes here limits the layer to 256 unique tiles
-        # may be a limitation for very detailed maps, but most maps are not
-        # so detailed.
-        [self.data.append(array.array("H")) for i in xrange(self.height)]
+    def build_data(self, raw_gids, width=None, height=None):
+        """
+        register the raw gids and return them as the internal gids, in the
+        storage used by the map.  width and height are the size of the data,
+        if it is a chunk and not the whole layer.
+        """
+        width = width or self.width
+        height = height or self.height
+
+        # flags and gids are mapped once for each unique gid, not each tile
+        gids = self.parent.register_gids(raw_gids)
+
+        # the narrowest type that holds all the internal gids is used: bytes
+        # for maps with less than 256 unique tiles, then shorts, then longs.
+        # the map will widen the layers if more gids are registered later.
+        typecode = self.parent.layer_typecode
+
+        if self.parent._layer_storage == "numpy":
+            # a single, contiguous 2d array.  data[y][x] still works.
+            gids = numpy.asarray(gids, dtype=GID_DTYPES[typecode])
+            return gids.reshape(height, width)
+
+        if numpy is not None:
+            gids = gids.astype(typecode).tostring()
+            step = width * array.array(typecode).itemsize
+            rows = (gids[i:i + step] for i in xrange(0, len(gids), step))
+        else:
+            rows = (gids[i:i + width]
+                    for i in xrange(0, len(gids), width))
 
-        for (y, x) in product(xrange(self.height), xrange(self.width)):
-            self.data[y].append(self.parent.register_gid(*decode_gid(next(next_gid))))
+        return [array.array(typecode, row) for row in rows]
 
 
 class TiledObjectGroup(TiledElement, list):
@@ -581,6 +1292,10 @@ class TiledObjectGroup(TiledElement, list):
         self.color = None
         self.opacity = 1
         self.visible = 1
+
+        # spatial index of the objects; built when needed
+        self.object_index = None
+
         self.parse(node)
 
     def __repr__(self):
@@ -593,10 +1308,58 @@ class TiledObjectGroup(TiledElement, list):
 
         self.set_properties(node)
 
-        for child in node.findall('object'):
+        children = node.findall('object')
+        if self.parent._region is not None:
+            children = [child for child in children
+                        if self.parent.object_in_region(child)]
+
+        if self.parent._compact_objects:
+            # objects with the same properties share them
+            interned = {}
+            for child in children:
+                o = CompactTiledObject(self.parent, child)
+                key = tuple(sorted(o.properties.items()))
+                o.properties = interned.setdefault(key, o.properties)
+                self.append(o)
+            return
+
+        for child in children:
             o = TiledObject(self.parent, child)
             self.append(o)
 
+    def build_object_index(self, cell_size=None):
+        """
+        build the spatial index of the objects in this group, which is used
+        by query_rect, query_point and nearest.  see TiledMap.update_object.
+        """
+        cell_size = cell_size or self.parent.object_cell_size()
+        self.object_index = ObjectIndex(self, cell_size)
+        return self.object_index
+
+    def query_rect(self, rect):
+        """
+        return the objects that overlap a rect (x, y, width, height), in pixels
+        """
+        if self.object_index is None:
+            self.build_object_index()
+        return self.object_index.query_rect(rect)
+
+    def query_point(self, x, y):
+        """
+        return the objects that contain a point, in pixels
+        """
+        if self.object_index is None:
+            self.build_object_index()
+        return self.object_index.query_point(x, y)
+
+    def nearest(self, x, y, count=1, max_distance=None):
+        """
+        return up to count objects nearest to a point, nearest first
+        """
+        if self.object_index is None:
+            self.build_object_index()
+        return self.object_index.nearest(x, y, count, max_distance)
+
 
 class TiledObject(TiledElement):
     reserved = "visible name type x y width height gid properties polygon polyline image".split()
@@ -651,6 +1414,94 @@ class TiledObject(TiledElement):
             self.height = abs(y1) + abs(y2)
             self.points = tuple([(i[0] + self.x, i[1] + self.y) for i in points])
 
+
+class CompactTiledObject(TiledElement):
+    """
+    A TiledObject that uses much less memory, for maps with many objects.
+    see TiledMap(compact_objects=True)
+
+    the TMX attributes are kept in slots.  other attributes, such as custom
+    properties, are kept in the properties dict, which is shared by objects
+    with the same properties; setting one gives the object its own copy.  the
+    properties of the tile of a tile object are looked up in the map's
+    tile_properties, instead of being copied to each object.
+
+    all of them can be read and set as attributes, as with TiledObject.
+    """
+    __slots__ = ('parent', 'id', 'name', 'type', 'x', 'y', 'width', 'height',
+                 'rotation', 'gid', 'visible', 'points', 'closed',
+                 'properties')
+    slot_names = frozenset(__slots__)
+    reserved = TiledObject.reserved
+
+    def __init__(self, parent, node):
+        # the object is read as a TiledObject, then its attributes are moved
+        # into the slots.  this is faster than setting them through __setattr__
+        obj = TiledObject(parent, node)
+        setslot = object.__setattr__
+        properties = {}
+        for k, v in obj.__dict__.iteritems():
+            if k in self.slot_names:
+                setslot(self, k, v)
+            else:
+                properties[k] = v
+        setslot(self, 'properties', properties)
+
+    __repr__ = TiledObject.__dict__['__repr__']
+
+    def set_tile_properties(self, p):
+        """
+        apply the properties of the object's tile, which override its own.
+        the ones that are TMX attributes are copied into the slots; the rest
+        are looked up when they are used.
+        """
+        for k, v in p.items():
+            if k in self.slot_names:
+                setattr(self, k, v)
+
+        if any(k in p for k in self.properties):
+            properties = dict((k, v) for k, v in self.properties.items()
+                              if k not in p)
+            object.__setattr__(self, 'properties', properties)
+
+    def __getattr__(self, name):
+        # only called if the attribute is not in a slot
+        if name in self.slot_names or name.startswith('__'):
+            raise AttributeError(name)
+
+        try:
+            return self.properties[name]
+        except KeyError:
+            pass
+
+        if self.gid:
+            p = self.parent.tile_properties.get(self.gid)
+            if p and name in p:
+                return p[name]
+
+        msg = "{0} has no attribute \"{1}\""
+        raise AttributeError(msg.format(self, name))
+
+    def __setattr__(self, name, value):
+        if name in self.slot_names:
+            object.__setattr__(self, name, value)
+        else:
+            properties = dict(self.properties)
+            properties[name] = value
+            object.__setattr__(self, 'properties', properties)
+
+    def __delattr__(self, name):
+        if name in self.slot_names:
+            object.__delattr__(self, name)
+        else:
+            properties = dict(self.properties)
+            try:
+                del properties[name]
+            except KeyError:
+                raise AttributeError(name)
+            object.__setattr__(self, 'properties', properties)
+
+
 class TiledImageLayer(TiledElement):
     reserved = "visible source name width height opacity visible".split()
 
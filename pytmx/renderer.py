@@ -0,0 +1,372 @@
+"""
+Renderers for drawing the tile layers of a map with pygame.
+
+ViewportRenderer keeps the tiles around the camera drawn on a buffer a little
+larger than the screen.  scrolling by less than a tile only blits the buffer
+at another offset.  scrolling by whole tiles scrolls the buffer and draws the
+tiles at the new edges, with one call to Surface.blits.
+
+    renderer = ViewportRenderer(tmxdata, screen.get_size())
+    renderer.draw(screen, (camera_x, camera_y))
+
+ChunkRenderer draws the tile layers into chunks, surfaces of a fixed number
+of tiles, once.  each frame, only the few chunks that can be seen are drawn,
+instead of every tile of every layer.  chunks that have not been seen for a
+while are dropped, and are drawn again if they are needed again.
+
+when tiles are changed, the chunks that show them have to be drawn again.
+change tiles with the renderer's setTileGID, or call invalidate_tile after
+changing them on the map.
+
+    tmxdata = load_pygame("map.tmx")
+    renderer = ChunkRenderer(tmxdata)
+    renderer.draw(screen, (camera_x, camera_y))
+
+tiles are drawn at the top left of their cell, like the demos.  parts of
+tiles that are larger than the map's tiles are cut off at the edge of a chunk,
+or of the cells drawn by the viewport renderer.
+"""
+from collections import OrderedDict
+
+__all__ = ['ChunkRenderer', 'ViewportRenderer']
+
+
+def blit_all(surface, blits):
+    """
+    blit a list of (image, position), with one call if pygame can
+    """
+    if hasattr(surface, 'blits'):
+        surface.blits(blits, False)
+    else:
+        for image, position in blits:
+            surface.blit(image, position)
+
+
+def default_layers(tmxdata):
+    return [i for i, layer in enumerate(tmxdata.tilelayers) if layer.visible]
+
+
+class ChunkRenderer(object):
+    """
+    Draws tile layers from a cache of pre-drawn chunks.
+
+    chunk_size is the width and height of a chunk, in tiles.  at most
+    max_chunks chunks are kept; the least recently used ones are dropped.
+
+    layers is a list of the tile layers to draw, by index.  by default, it is
+    all the visible tile layers.  the layers are drawn together into each
+    chunk, so layers that are drawn between them, like sprites, need a
+    renderer of their own.
+
+    if background is set, the chunks are filled with that color and have no
+    transparency, which makes them faster to draw.  otherwise, the chunks have
+    per-pixel alpha, and the parts with no tiles are transparent.
+    """
+
+    def __init__(self, tmxdata, chunk_size=16, max_chunks=64, layers=None,
+                 background=None):
+        self.tmxdata = tmxdata
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.background = background
+
+        if layers is None:
+            layers = default_layers(tmxdata)
+        self.layers = list(layers)
+
+        self.chunks = OrderedDict()  # (column, row): surface, or None if empty
+
+    @property
+    def chunk_pixels(self):
+        """
+        the (width, height) of a chunk, in pixels
+        """
+        return (self.chunk_size * self.tmxdata.tilewidth,
+                self.chunk_size * self.tmxdata.tileheight)
+
+    def render_chunk(self, column, row):
+        """
+        draw a chunk and return its surface, or None if it has no tiles
+        """
+        import pygame
+
+        tmxdata = self.tmxdata
+        size = self.chunk_size
+        tw, th = tmxdata.tilewidth, tmxdata.tileheight
+        x0, y0 = column * size, row * size
+
+        tiles = tmxdata.getTileImages((x0, y0, size, size), self.layers)
+        blits = [(image, ((x - x0) * tw, (y - y0) * th))
+                 for x, y, l, image in tiles if image]
+
+        if not blits and self.background is None:
+            return None
+
+        if self.background is None:
+            surface = pygame.Surface(self.chunk_pixels, pygame.SRCALPHA)
+        else:
+            surface = pygame.Surface(self.chunk_pixels)
+            surface.fill(self.background)
+
+        blit_all(surface, blits)
+
+        # match the display, if there is one, so the chunk blits quickly
+        if pygame.display.get_surface() is not None:
+            if self.background is None:
+                surface = surface.convert_alpha()
+            else:
+                surface = surface.convert()
+
+        return surface
+
+    def get_chunk(self, column, row):
+        """
+        return the surface of a chunk, drawing it if it is not cached
+        """
+        key = column, row
+        try:
+            surface = self.chunks.pop(key)
+        except KeyError:
+            surface = self.render_chunk(column, row)
+
+        # the most recently used chunks are at the end
+        self.chunks[key] = surface
+        while len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+
+        return surface
+
+    def visible_chunks(self, rect):
+        """
+        return the (column, row) of the chunks that overlap a rect of the map
+        (x, y, width, height), in pixels.  chunks outside the map are skipped,
+        unless the map is infinite.
+        """
+        cw, ch = self.chunk_pixels
+        size = self.chunk_size
+        x, y, w, h = rect
+
+        columns = (self.tmxdata.width + size - 1) // size
+        rows = (self.tmxdata.height + size - 1) // size
+
+        # infinite maps have no edges
+        if self.tmxdata.infinite:
+            return [(column, row)
+                    for row in xrange(y // ch, (y + h - 1) // ch + 1)
+                    for column in xrange(x // cw, (x + w - 1) // cw + 1)]
+
+        return [(column, row)
+                for row in xrange(max(y // ch, 0), min((y + h - 1) // ch + 1, rows))
+                for column in xrange(max(x // cw, 0), min((x + w - 1) // cw + 1, columns))]
+
+    def draw(self, surface, offset=(0, 0)):
+        """
+        draw the layers onto a surface.  offset is the position on the map,
+        in pixels, that is drawn at the top left of the surface.
+        """
+        ox, oy = map(int, offset)
+        sw, sh = surface.get_size()
+        cw, ch = self.chunk_pixels
+
+        blits = []
+        for column, row in self.visible_chunks((ox, oy, sw, sh)):
+            chunk = self.get_chunk(column, row)
+            if chunk is not None:
+                blits.append((chunk, (column * cw - ox, row * ch - oy)))
+
+        blit_all(surface, blits)
+
+    def invalidate_tile(self, x, y):
+        """
+        drop the chunk that shows a tile, so it is drawn again when needed
+        """
+        key = x // self.chunk_size, y // self.chunk_size
+        self.chunks.pop(key, None)
+
+    def invalidate(self, rect=None):
+        """
+        drop the chunks that overlap a rect (x, y, width, height) of tiles,
+        or all of them if rect is None
+        """
+        if rect is None:
+            self.chunks.clear()
+            return
+
+        size = self.chunk_size
+        x, y, w, h = rect
+        for row in xrange(y // size, (y + h - 1) // size + 1):
+            for column in xrange(x // size, (x + w - 1) // size + 1):
+                self.chunks.pop((column, row), None)
+
+    def setTileGID(self, x, y, layer, gid):
+        """
+        set the GID of a tile on the map, and drop the chunk that shows it
+        """
+        self.tmxdata.setTileGID(x, y, layer, gid)
+        self.invalidate_tile(x, y)
+
+
+class ViewportRenderer(object):
+    """
+    Draws tile layers through a buffer that follows the camera.
+
+    size is the (width, height) of the surface that will be drawn on, in
+    pixels.  call resize if it changes.
+
+    layers and background are the same as for ChunkRenderer.  the buffer is
+    redrawn only where new tiles come into view, so tiles changed on the map
+    need invalidate_tile, or the renderer's setTileGID.
+    """
+
+    def __init__(self, tmxdata, size, layers=None, background=None):
+        self.tmxdata = tmxdata
+        self.background = background
+
+        if layers is None:
+            layers = default_layers(tmxdata)
+        self.layers = list(layers)
+
+        # the draw list is kept between frames, so it is not made again
+        self.blits = []
+        self.buffer = None
+        self.view = None  # tile at the top left of the buffer
+        self.resize(size)
+
+    def resize(self, size):
+        """
+        change the size of the surface that will be drawn on
+        """
+        import pygame
+
+        tw, th = self.tmxdata.tilewidth, self.tmxdata.tileheight
+        width, height = size
+
+        # one more tile than fits, for the part of a tile at each edge
+        self.columns = -(-width // tw) + 1
+        self.rows = -(-height // th) + 1
+        buffer_size = self.columns * tw, self.rows * th
+
+        if self.background is None:
+            self.buffer = pygame.Surface(buffer_size, pygame.SRCALPHA)
+        else:
+            self.buffer = pygame.Surface(buffer_size)
+
+        if pygame.display.get_surface() is not None:
+            if self.background is None:
+                self.buffer = self.buffer.convert_alpha()
+            else:
+                self.buffer = self.buffer.convert()
+
+        self.view = None
+
+    def draw_list(self, rects, origin=(0, 0)):
+        """
+        return a list of (image, position) for the tiles in some rects
+        (x, y, width, height) of tiles, in the order they are drawn.
+        the positions are in pixels, relative to the tile origin.
+
+        the list is reused by the next call, so do not keep it.
+        """
+        tw, th = self.tmxdata.tilewidth, self.tmxdata.tileheight
+        ox, oy = origin
+        blits = self.blits
+        del blits[:]
+
+        for rect in rects:
+            tiles = self.tmxdata.getTileImages(rect, self.layers)
+            blits.extend((image, ((x - ox) * tw, (y - oy) * th))
+                         for x, y, l, image in tiles if image)
+
+        return blits
+
+    def redraw(self, rects):
+        """
+        draw the tiles of some rects of tiles onto the buffer
+        """
+        tw, th = self.tmxdata.tilewidth, self.tmxdata.tileheight
+        vx, vy = self.view
+        color = self.background
+        if color is None:
+            color = (0, 0, 0, 0)
+
+        for x, y, w, h in rects:
+            self.buffer.fill(color, ((x - vx) * tw, (y - vy) * th, w * tw, h * th))
+
+        blit_all(self.buffer, self.draw_list(rects, self.view))
+
+    def move(self, tx, ty):
+        """
+        move the buffer so the tile tx, ty is at its top left
+        """
+        columns, rows = self.columns, self.rows
+
+        if self.view is None:
+            self.view = tx, ty
+            self.redraw([(tx, ty, columns, rows)])
+            return
+
+        dx, dy = tx - self.view[0], ty - self.view[1]
+        if not dx and not dy:
+            return
+
+        self.view = tx, ty
+        if abs(dx) >= columns or abs(dy) >= rows:
+            self.redraw([(tx, ty, columns, rows)])
+            return
+
+        tw, th = self.tmxdata.tilewidth, self.tmxdata.tileheight
+        self.buffer.scroll(-dx * tw, -dy * th)
+
+        # the columns that came into view, then the rows, without the
+        # cells that are in both
+        rects = []
+        x, w = tx, columns
+        if dx > 0:
+            rects.append((tx + columns - dx, ty, dx, rows))
+            w = columns - dx
+        elif dx < 0:
+            rects.append((tx, ty, -dx, rows))
+            x, w = tx - dx, columns + dx
+
+        if dy > 0:
+            rects.append((x, ty + rows - dy, w, dy))
+        elif dy < 0:
+            rects.append((x, ty, w, -dy))
+
+        self.redraw(rects)
+
+    def draw(self, surface, offset=(0, 0)):
+        """
+        draw the layers onto a surface.  offset is the position on the map,
+        in pixels, that is drawn at the top left of the surface.
+        """
+        tw, th = self.tmxdata.tilewidth, self.tmxdata.tileheight
+        tx, px = divmod(int(offset[0]), tw)
+        ty, py = divmod(int(offset[1]), th)
+
+        self.move(tx, ty)
+        surface.blit(self.buffer, (-px, -py))
+
+    def invalidate_tile(self, x, y):
+        """
+        draw a tile again, if it is on the buffer
+        """
+        if self.view is None:
+            return
+
+        vx, vy = self.view
+        if vx <= x < vx + self.columns and vy <= y < vy + self.rows:
+            self.redraw([(x, y, 1, 1)])
+
+    def invalidate(self):
+        """
+        draw the whole buffer again the next time it is drawn
+        """
+        self.view = None
+
+    def setTileGID(self, x, y, layer, gid):
+        """
+        set the GID of a tile on the map, and draw it again
+        """
+        self.tmxdata.setTileGID(x, y, layer, gid)
+        self.invalidate_tile(x, y)
@@ -0,0 +1,293 @@
+"""
+Spatial index of map objects, for finding the objects in an area quickly.
+
+The index is a uniform grid.  Each object is kept in every cell that its
+bounds overlap, so a query only looks at the objects in the cells that it
+covers, instead of every object of the map.  Objects that cover very many
+cells, like zones as big as the map, are kept in a separate list that every
+query checks.
+
+The bounds of an object are its x, y, width and height, turned by its
+rotation, or the extent of its points for polygons and polylines.  Tile
+objects, which have a gid, are anchored at their bottom left corner.  All
+coordinates are in pixels, like the objects.
+
+If an object is moved or resized, call update so the index knows.
+"""
+import heapq
+import math
+
+__all__ = ['ObjectIndex', 'object_bounds', 'rect_bounds']
+
+# objects that overlap more cells than this are not kept in the grid
+MAX_CELLS = 64
+
+
+def object_bounds(obj):
+    """
+    return the (left, top, right, bottom) of an object, in pixels
+    """
+    return rect_bounds(obj.x, obj.y, obj.width, obj.height,
+                       getattr(obj, 'rotation', 0), getattr(obj, 'points', None),
+                       bool(getattr(obj, 'gid', 0)))
+
+
+def rect_bounds(x, y, w, h, rotation=0, points=None, tile=False):
+    """
+    return the (left, top, right, bottom) of a rect turned by rotation, or
+    of points, if there are any
+
+    tiled anchors tile objects at their bottom left corner, so if tile is
+    True, the rect is above y.
+    """
+    if not points:
+        top = y - h if tile else y
+        points = ((x, top), (x + w, top), (x, top + h), (x + w, top + h))
+
+        if rotation:
+            # tiled turns objects clockwise around their x, y
+            r = math.radians(rotation)
+            cos, sin = math.cos(r), math.sin(r)
+            points = [(x + (px - x) * cos - (py - y) * sin,
+                       y + (px - x) * sin + (py - y) * cos)
+                      for px, py in points]
+
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class ObjectIndex(object):
+    """
+    Grid of objects.  see the module docstring.
+
+    query results are lists of objects, in the order the objects were added.
+    bounds that only touch the area of a query are counted as overlapping it,
+    so objects without a size are found too.
+    """
+
+    def __init__(self, objects=(), cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}    # (column, row): set of objects
+        self.large = set()
+        self.bounds = {}   # object: (left, top, right, bottom)
+        self.keys = {}     # object: list of cells it is in
+        self.order = {}    # object: order in which it was added
+        self.count = 0
+        self.extent = None  # columns and rows that have ever had objects
+
+        for obj in objects:
+            self.insert(obj)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __contains__(self, obj):
+        return obj in self.bounds
+
+    def __iter__(self):
+        return iter(self.sort(self.bounds))
+
+    def cell_range(self, left, top, right, bottom):
+        """
+        return the columns and rows of the cells that overlap an area
+        """
+        size = self.cell_size
+        return (xrange(int(math.floor(left / size)), int(math.floor(right / size)) + 1),
+                xrange(int(math.floor(top / size)), int(math.floor(bottom / size)) + 1))
+
+    def sort(self, objects):
+        return sorted(objects, key=self.order.__getitem__)
+
+    def insert(self, obj):
+        """
+        add an object to the index
+        """
+        if obj in self.bounds:
+            self.remove(obj)
+
+        bounds = object_bounds(obj)
+        self.bounds[obj] = bounds
+        if obj not in self.order:
+            self.order[obj] = self.count
+            self.count += 1
+
+        columns, rows = self.cell_range(*bounds)
+        if len(columns) * len(rows) > MAX_CELLS:
+            self.large.add(obj)
+            self.keys[obj] = None
+            return
+
+        if self.extent is None:
+            self.extent = [columns[0], rows[0], columns[-1], rows[-1]]
+        else:
+            extent = self.extent
+            extent[0] = min(extent[0], columns[0])
+            extent[1] = min(extent[1], rows[0])
+            extent[2] = max(extent[2], columns[-1])
+            extent[3] = max(extent[3], rows[-1])
+
+        keys = [(cx, cy) for cx in columns for cy in rows]
+        for key in keys:
+            cell = self.cells.get(key)
+            if cell is None:
+                cell = self.cells[key] = set()
+            cell.add(obj)
+        self.keys[obj] = keys
+
+    def remove(self, obj):
+        """
+        remove an object from the index
+        """
+        del self.bounds[obj]
+        keys = self.keys.pop(obj)
+        if keys is None:
+            self.large.discard(obj)
+        else:
+            for key in keys:
+                cell = self.cells[key]
+                cell.discard(obj)
+                if not cell:
+                    del self.cells[key]
+
+    def update(self, obj):
+        """
+        update the index after an object has been moved or resized.
+        it keeps its place in the order of results.
+        """
+        self.insert(obj)
+
+    def discard(self, obj):
+        """
+        remove an object from the index, if it is there
+        """
+        if obj in self.bounds:
+            self.remove(obj)
+            del self.order[obj]
+
+    def candidates(self, left, top, right, bottom):
+        """
+        return a set of the objects in the cells that overlap an area
+        """
+        found = set(self.large)
+        columns, rows = self.cell_range(left, top, right, bottom)
+
+        # a big area has more cells than there are cells with objects
+        if len(columns) * len(rows) > len(self.cells):
+            # "in" would scan the xranges
+            left, right = columns[0], columns[-1]
+            top, bottom = rows[0], rows[-1]
+            for (cx, cy), cell in self.cells.iteritems():
+                if left <= cx <= right and top <= cy <= bottom:
+                    found.update(cell)
+        else:
+            cells = self.cells
+            for cx in columns:
+                for cy in rows:
+                    cell = cells.get((cx, cy))
+                    if cell:
+                        found.update(cell)
+
+        return found
+
+    def query_rect(self, rect):
+        """
+        return the objects that overlap a rect (x, y, width, height)
+        """
+        x, y, w, h = rect
+        x2, y2 = x + w, y + h
+        bounds = self.bounds
+        found = []
+        for obj in self.candidates(x, y, x2, y2):
+            left, top, right, bottom = bounds[obj]
+            if left <= x2 and x <= right and top <= y2 and y <= bottom:
+                found.append(obj)
+
+        return self.sort(found)
+
+    def query_point(self, x, y):
+        """
+        return the objects whose bounds contain a point
+        """
+        return self.query_rect((x, y, 0, 0))
+
+    def distance(self, obj, x, y):
+        """
+        return the distance from a point to the bounds of an object
+        """
+        left, top, right, bottom = self.bounds[obj]
+        dx = max(left - x, 0, x - right)
+        dy = max(top - y, 0, y - bottom)
+        return math.hypot(dx, dy)
+
+    def nearest(self, x, y, count=1, max_distance=None):
+        """
+        return up to count objects nearest to a point, nearest first.
+        objects that contain the point are at distance 0.
+
+        if max_distance is set, objects farther than that are not returned.
+        """
+        if not self.bounds:
+            return []
+
+        size = self.cell_size
+        cx, cy = int(math.floor(x / size)), int(math.floor(y / size))
+
+        # the search stops when it has passed all the cells with objects
+        reach = 0
+        if self.extent is not None:
+            left, top, right, bottom = self.extent
+            reach = max(cx - left, right - cx, cy - top, bottom - cy, 0)
+
+        distances = dict((obj, self.distance(obj, x, y)) for obj in self.large)
+
+        # distances that are not yet known to be within the searched cells,
+        # and how many are
+        pending = list(distances.itervalues())
+        heapq.heapify(pending)
+        within = 0
+
+        scanned = 0
+        ring = 0
+        while True:
+            if ring == 0:
+                keys = [(cx, cy)]
+            else:
+                keys = [(cx + i, cy - ring) for i in xrange(-ring, ring + 1)]
+                keys += [(cx + i, cy + ring) for i in xrange(-ring, ring + 1)]
+                keys += [(cx - ring, cy + i) for i in xrange(-ring + 1, ring)]
+                keys += [(cx + ring, cy + i) for i in xrange(-ring + 1, ring)]
+
+            # when the rings are larger than the cells with objects, it is
+            # quicker to measure all the objects that are left
+            scanned += len(keys)
+            if scanned > len(self.cells):
+                for obj in self.bounds:
+                    if obj not in distances:
+                        distances[obj] = self.distance(obj, x, y)
+                break
+
+            for key in keys:
+                for obj in self.cells.get(key, ()):
+                    if obj not in distances:
+                        distance = distances[obj] = self.distance(obj, x, y)
+                        heapq.heappush(pending, distance)
+
+            # objects that have not been found are outside of the searched
+            # cells, so they are at least this far away
+            edge = min(x - (cx - ring) * size, (cx + ring + 1) * size - x,
+                       y - (cy - ring) * size, (cy + ring + 1) * size - y)
+            while pending and pending[0] <= edge:
+                heapq.heappop(pending)
+                within += 1
+            if within >= count or ring >= reach:
+                break
+            if max_distance is not None and edge > max_distance:
+                break
+            ring += 1
+
+        found = sorted(distances, key=lambda obj: (distances[obj], self.order[obj]))
+        if max_distance is not None:
+            found = [obj for obj in found if distances[obj] <= max_distance]
+
+        return found[:count]
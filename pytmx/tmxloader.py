@@ -1,9 +1,14 @@
-import itertools
 import os
+import sys
+import threading
 import pytmx
+from .cache import opacity_cache
 from .constants import *
+from .imageloader import ImageLoader, iter_load_images, pack_rects
+from .utils import remove_file, replace_file
 
-__all__ = ['load_pygame', 'load_tmx']
+__all__ = ['load_pygame', 'load_tmx', 'load_many', 'load_pygame_async',
+           'AsyncLoader', 'PygameImageLoader']
 
 
 def handle_transformation(tile, flags):
@@ -30,22 +35,27 @@ def handle_transformation(tile, flags):
         return tile
 
 
-def smart_convert(original, colorkey, force_colorkey, pixelalpha):
+def smart_convert(original, colorkey, force_colorkey, pixelalpha, opaque=None):
     """
     this method does several tests on a surface to determine the optimal
     flags and pixel format for each tile surface.
 
     this is done for the best rendering speeds and removes the need to
     convert() the images on your own
+
+    opaque tells if the surface has no transparent pixels.  if None, the
+    pixels are counted.
     """
     import pygame
     tile_size = original.get_size()
 
-    # count the number of pixels in the tile that are not transparent
-    px = pygame.mask.from_surface(original).count()
+    if opaque is None:
+        # count the number of pixels in the tile that are not transparent
+        px = pygame.mask.from_surface(original).count()
+        opaque = px == tile_size[0] * tile_size[1]
 
     # there are no transparent pixels in the image
-    if px == tile_size[0] * tile_size[1]:
+    if opaque:
         tile = original.convert()
 
     # there are transparent pixels, and set to force a colorkey
@@ -71,6 +81,171 @@ def smart_convert(original, colorkey, force_colorkey, pixelalpha):
     return tile
 
 
+def opacity_path(path, cache_dir):
+    """
+    return the path of the opacity file for a tileset image in cache_dir
+    """
+    from .compiled import compiled_path
+    return os.path.splitext(compiled_path(path, cache_dir))[0] + '.opacity'
+
+
+def read_opacity(path, mtime, cache_dir):
+    """
+    return the opacity of the tiles of an image saved in cache_dir, or an
+    empty dict if it was not saved or the image has changed since
+    """
+    import cPickle as pickle
+
+    try:
+        with open(opacity_path(path, cache_dir), 'rb') as fh:
+            saved_path, saved_mtime, opacity = pickle.load(fh)
+    except (EnvironmentError, ValueError, EOFError, pickle.UnpicklingError):
+        return {}
+
+    if (saved_path, saved_mtime) != (path, mtime):
+        return {}
+
+    return opacity
+
+
+def save_opacity(path, mtime, opacity, cache_dir):
+    """
+    save the opacity of the tiles of an image to cache_dir
+    """
+    import cPickle as pickle
+
+    filename = opacity_path(path, cache_dir)
+    temp = "{0}.{1}.tmp".format(filename, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(temp, 'wb') as fh:
+            pickle.dump((path, mtime, opacity), fh, pickle.HIGHEST_PROTOCOL)
+        replace_file(temp, filename)
+    except EnvironmentError:
+        # the cache is only an optimization
+        remove_file(temp)
+
+
+class PygameImageLoader(ImageLoader):
+    """
+    Loads tiles as pygame surfaces.  see _load_images_pygame.
+
+    smart_convert needs to know which tiles are transparent.  this is found
+    once for each tile of a tileset image, and kept for as long as the image
+    is not changed.  if cache_dir is set, it is also saved there, so the
+    pixels do not have to be counted again when the map is loaded later.
+    """
+
+    def __init__(self, pixelalpha=False, force_colorkey=False, cache_dir=None):
+        import pygame
+
+        if force_colorkey:
+            pixelalpha = True
+
+        if force_colorkey:
+            try:
+                force_colorkey = pygame.Color(*force_colorkey)
+            except:
+                msg = 'Cannot understand color: {0}'
+                print msg.format(force_colorkey)
+                raise ValueError
+
+        self.pixelalpha = pixelalpha
+        self.force_colorkey = force_colorkey
+        self.cache_dir = cache_dir
+
+    def cache_key(self):
+        force_colorkey = self.force_colorkey
+        return ('pygame', tuple(force_colorkey) if force_colorkey else None,
+                self.pixelalpha)
+
+    def load(self, path, colorkey=None):
+        import pygame
+        return pygame.image.load(path)
+
+    def get_size(self, image):
+        return image.get_size()
+
+    def get_nbytes(self, image):
+        width, height = image.get_size()
+        return width * height * image.get_bytesize()
+
+    def subimage(self, image, rect):
+        return image.subsurface(rect)
+
+    def transform(self, tile, flags):
+        return handle_transformation(tile, flags)
+
+    def get_opacity(self, path, image, rects):
+        import pygame
+
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        opacity = opacity_cache.get((path, mtime))
+        if opacity is None:
+            # what was known about older versions of the image is dropped
+            for old in [k for k in opacity_cache if k[0] == path]:
+                opacity_cache.pop(old, None)
+            opacity = read_opacity(path, mtime, self.cache_dir) if self.cache_dir else {}
+            opacity_cache[(path, mtime)] = opacity
+
+        missing = [rect for rect in rects if rect not in opacity]
+        if missing:
+            # one mask for the whole image is faster than one for each tile
+            mask = pygame.mask.from_surface(image)
+            solid = {}
+            for x, y, w, h in missing:
+                if (w, h) not in solid:
+                    solid[(w, h)] = pygame.mask.Mask((w, h))
+                    solid[(w, h)].fill()
+                px = mask.overlap_area(solid[(w, h)], (x, y))
+                opacity[(x, y, w, h)] = px == w * h
+
+            if self.cache_dir:
+                save_opacity(path, mtime, opacity, self.cache_dir)
+
+        return opacity
+
+    def convert(self, tile, colorkey=None, opaque=None):
+        import pygame
+        if colorkey:
+            colorkey = pygame.Color('#{0}'.format(colorkey))
+        return smart_convert(tile, colorkey, self.force_colorkey,
+                             self.pixelalpha, opaque)
+
+    def pack(self, tiles, colorkey=None):
+        import pygame
+        size, rects = pack_rects([tile.get_size() for tile in tiles])
+        atlas = pygame.Surface(size, pygame.SRCALPHA, 32)
+
+        if colorkey:
+            colorkey = pygame.Color('#{0}'.format(colorkey))
+
+        # the colorkey is applied before the pixels are counted, as it is for
+        # single tiles.  a forced colorkey replaces it, as in smart_convert
+        keyed = colorkey and not self.force_colorkey
+        if keyed:
+            # pixels of the colorkey are left transparent, but keep its color,
+            # so setting the colorkey on the converted atlas still hides them
+            atlas.fill((colorkey.r, colorkey.g, colorkey.b, 0))
+
+        for tile, rect in zip(tiles, rects):
+            if keyed:
+                tile = tile.convert()
+                tile.set_colorkey(colorkey)
+            atlas.blit(tile, rect[:2])
+
+        # the space between the tiles is transparent, so only the pixels of
+        # the tiles are counted
+        px = pygame.mask.from_surface(atlas).count()
+        opaque = px == sum(w * h for x, y, w, h in rects)
+
+        atlas = smart_convert(atlas, colorkey, self.force_colorkey,
+                              self.pixelalpha, opaque)
+        return atlas, rects
+
+
 def _load_images_pygame(tmxdata, mapping, *args, **kwargs):
     """
     Utility function to load images.
@@ -95,101 +270,316 @@ def _load_images_pygame(tmxdata, mapping, *args, **kwargs):
     will not preserve the transparency of the tile if it uses partial
     transparency (which you shouldn't be doing anyway, this is SDL).
 
+    if "cache_dir" is set, which tiles are transparent is saved there for each
+    tileset image, so it does not have to be worked out again next time.
+
+    with "atlas=True", the tiles of each tileset are packed into one surface,
+    which is converted only once.  the images are subsurfaces of it, and
+    getTileAtlasByGid returns the (surface, rect) of a tile, for blitting
+    with an area or with Surface.blits.
+
+    with "lazy_images=True", each tile is only converted the first time it is
+    used.  "image_budget" limits the bytes used by the tiles; the least
+    recently used tiles are dropped and converted again when needed.
+
     TL;DR:
     Don't attempt to convert() or convert_alpha() the individual tiles.  It is
     already done for you.
     """
-    import pygame
+    for done, total in _iter_load_images_pygame(tmxdata, mapping, *args, **kwargs):
+        pass
 
-    pixelalpha = kwargs.get("pixelalpha", False)
-    force_colorkey = kwargs.get("force_colorkey", False)
 
-    if force_colorkey:
-        pixelalpha = True
+def _iter_load_images_pygame(tmxdata, mapping, *args, **kwargs):
+    """
+    load images like _load_images_pygame, a few at a time.  this is a
+    generator of (done, total); see imageloader.iter_load_images.
+    """
+    import pygame
 
-    if force_colorkey:
-        try:
-            force_colorkey = pygame.Color(*force_colorkey)
-        except:
-            msg = 'Cannot understand color: {0}'
-            print msg.format(force_colorkey)
-            raise ValueError
+    loader = PygameImageLoader(kwargs.get("pixelalpha", False),
+                               kwargs.get("force_colorkey", False),
+                               kwargs.get("cache_dir", None))
 
     # change background color into something nice
     if tmxdata.background_color:
         tmxdata.background_color = pygame.Color(tmxdata.background_color)
 
-    # initialize the array of images
-    tmxdata.images = [0] * tmxdata.maxgid
+    steps = iter_load_images(tmxdata, loader, kwargs.get("atlas", False),
+                             kwargs.get("lazy_images", False),
+                             kwargs.get("image_budget", None))
+    for progress in steps:
+        yield progress
 
-    for ts in tmxdata.tilesets:
-        path = os.path.join(os.path.dirname(tmxdata.filename), ts.source)
-        image = pygame.image.load(path)
-        w, h = image.get_size()
 
-        # margins and spacing
-        tilewidth = ts.tilewidth + ts.spacing
-        tileheight = ts.tileheight + ts.spacing
-        tile_size = ts.tilewidth, ts.tileheight
+def load_pygame(filename, *args, **kwargs):
+    """
+    PYGAME USERS: Use me.
 
-        # some tileset images may be slightly larger than the tile area
-        # ie: may include a banner, copyright, ect.  this compensates for that
-        width = int((((w - ts.margin * 2 + ts.spacing) / tilewidth) * tilewidth) - ts.spacing)
-        height = int((((h - ts.margin * 2 + ts.spacing) / tileheight) * tileheight) - ts.spacing)
+    Load a TMX file, load the images, and return a TiledMap class that is ready to use.
 
-        # trim off any pixels on the right side that isn't a tile
-        # this happens if extra graphics are included on the left, but they are not actually part of the tileset
-        width -= (w - ts.margin) % tilewidth
+    pass layer_storage="numpy" to store the tile layers as numpy arrays.
+    pass cache_dir to keep compiled copies of maps; see load_tmx.
+    pass lazy_layers=True to only decode tile layers when they are used.
+    pass compact_objects=True to use CompactTiledObjects, which use less memory.
+    pass atlas=True to pack each tileset into one surface; see getTileAtlasByGid.
+    pass lazy_images=True and image_budget to convert tiles when they are used.
+    pass region=(x, y, width, height) to only load that part of the map.
+    """
+    layer_storage = kwargs.get("layer_storage", "array")
+    cache_dir = kwargs.get("cache_dir", None)
+    memory_map = kwargs.get("memory_map", False)
+    lazy_layers = kwargs.get("lazy_layers", False)
+    compact_objects = kwargs.get("compact_objects", False)
+    region = kwargs.get("region", None)
+    tmxdata = load_tmx(filename, layer_storage, cache_dir, memory_map,
+                       lazy_layers, compact_objects=compact_objects,
+                       region=region)
+    _load_images_pygame(tmxdata, None, *args, **kwargs)
+    return tmxdata
 
-        # using product avoids the overhead of nested loops
-        p = itertools.product(xrange(ts.margin, height + ts.margin, tileheight),
-                              xrange(ts.margin, width + ts.margin, tilewidth))
 
-        colorkey = getattr(ts, 'trans', None)
-        if colorkey:
-            colorkey = pygame.Color('#{0}'.format(colorkey))
+def load_tmx(filename, layer_storage="array", cache_dir=None, memory_map=False,
+             lazy_layers=False, progress=None, compact_objects=False,
+             region=None):
+    """
+    Load a TMX file and return a TiledMap class, without images.
 
-        for real_gid, (y, x) in enumerate(p, ts.firstgid):
-            if x + ts.tilewidth-ts.spacing > width:
-                continue
+    if cache_dir is set, a compiled copy of the map is saved in that folder.
+    the compiled copy is loaded instead of the TMX file until the TMX file or
+    one of its external tilesets is changed.
 
-            gids = tmxdata.map_gid(real_gid)
+    if memory_map is also set, the layers of the compiled copy are not copied
+    into memory.  they are numpy arrays backed by the memory-mapped file, so
+    processes that load the same map share the memory.  requires numpy.
 
-            if gids:
-                original = image.subsurface(((x, y), tile_size))
+    if lazy_layers is set, tile layers are only decoded when they are used.
+    this has no effect on compiled maps, which are already decoded.
 
-                for gid, flags in gids:
-                    tile = handle_transformation(original, flags)
-                    tile = smart_convert(tile, colorkey, force_colorkey, pixelalpha)
-                    tmxdata.images[gid] = tile
+    progress is passed to TiledMap.  it is not called for compiled maps.
 
-    # load image layer images
-    for layer in tmxdata.all_layers:
-        if isinstance(layer, pytmx.TiledImageLayer):
-            colorkey = getattr(layer, 'trans', None)
-            if colorkey:
-                colorkey = pygame.Color("#{0}".format(colorkey))
+    if compact_objects is set, objects are CompactTiledObjects.
 
-            source = getattr(layer, 'source', None)
-            if source:
-                real_gid = len(tmxdata.images)
-                gid = tmxdata.register_gid(real_gid)
-                layer.gid = gid
-                path = os.path.join(os.path.dirname(tmxdata.filename), source)
-                image = pygame.image.load(path)
-                image = smart_convert(image, colorkey, force_colorkey, pixelalpha)
-                tmxdata.images.append(image)
+    region is passed to TiledMap.  each region of a map is compiled to its own
+    file in cache_dir.
+    """
+    from .compiled import compiled_path, load_compiled
+    import cPickle as pickle
+
+    if not cache_dir:
+        return pytmx.TiledMap(filename, layer_storage, lazy_layers, progress,
+                              compact_objects, region)
+
+    if region is not None:
+        region = tuple(map(int, region))
+
+    path = compiled_path(filename, cache_dir, region)
+    try:
+        tmxdata = load_compiled(path, layer_storage, memory_map=memory_map)
+    except (EnvironmentError, ValueError, EOFError, pickle.UnpicklingError):
+        tmxdata = None
+
+    # compiled with the other kind of objects, or another region
+    if tmxdata is not None and (tmxdata._compact_objects != compact_objects or
+                                tmxdata._region != region):
+        tmxdata = None
+
+    if tmxdata is None:
+        tmxdata = pytmx.TiledMap(filename, layer_storage=layer_storage,
+                                 progress=progress,
+                                 compact_objects=compact_objects,
+                                 region=region)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmxdata.save_compiled(path)
+        except EnvironmentError:
+            # the compiled copy is only an optimization; the parsed map is
+            # still good
+            return tmxdata
+
+        # reopen the map, so the layers are backed by the compiled file
+        if memory_map:
+            tmxdata = load_compiled(path, check=False, memory_map=True)
+            tmxdata.filename = filename
+    else:
+        # tiled stores relative paths, so images are loaded relative to this
+        tmxdata.filename = filename
 
+    return tmxdata
 
-def load_pygame(filename, *args, **kwargs):
+
+class AsyncLoader(object):
     """
-    PYGAME USERS: Use me.
+    Loads a map in a background thread, so the game can keep running.
 
-    Load a TMX file, load the images, and return a TiledMap class that is ready to use.
+    the TMX file is parsed and the layers are decoded in the thread.  images
+    often have to be made in the thread that owns the display, so they are
+    made a few at a time by calling pump, usually once each frame:
+
+        loader = load_pygame_async("map.tmx", progress=show_progress)
+        while not loader.pump():
+            draw_loading_screen()
+        tmxdata = loader.result()
+
+    progress is called as progress(kind, item).  it is called from the
+    background thread for each part of the map that is loaded (see
+    TiledMap.load), then from pump with kind "images" and item (done, total).
     """
-    tmxdata = pytmx.TiledMap(filename)
-    _load_images_pygame(tmxdata, None, *args, **kwargs)
-    return tmxdata
 
+    def __init__(self, filename, progress=None, images=None, **kwargs):
+        """
+        images is a function that takes the loaded TiledMap and returns a
+        generator that loads its images; see iter_load_images.  if None, the
+        map is loaded without images.  kwargs are passed to load_tmx.
+        """
+        self.filename = filename
+        self.progress = progress
+        self.images = images
+        self.tmxdata = None
+        self.error = None
+        self.steps = None
+        self.finished = False
+
+        self.thread = threading.Thread(target=self.run, args=(kwargs,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, kwargs):
+        try:
+            self.tmxdata = load_tmx(self.filename, progress=self.progress,
+                                    **kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def parsed(self):
+        """
+        return True if the background thread has finished
+        """
+        return not self.thread.is_alive()
+
+    def pump(self, count=16):
+        """
+        make up to count images, once the map has been parsed.  call this
+        from the display thread.  return True when the map is ready.
+
+        if the map could not be loaded, the error is raised here.
+        """
+        if self.finished:
+            return True
+
+        if self.thread.is_alive():
+            return False
+
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+        if self.steps is None:
+            self.steps = self.images(self.tmxdata) if self.images else iter(())
+
+        for i in xrange(count):
+            try:
+                done, total = next(self.steps)
+            except StopIteration:
+                self.finished = True
+                return True
+
+            if self.progress:
+                self.progress("images", (done, total))
+
+        return False
+
+    def result(self):
+        """
+        wait for the map to be parsed, make the rest of the images and return
+        the TiledMap.  call this from the display thread.
+        """
+        self.thread.join()
+        while not self.pump(1024):
+            pass
+        return self.tmxdata
+
+
+def load_pygame_async(filename, progress=None, **kwargs):
+    """
+    Load a TMX file and its images like load_pygame, without blocking.
 
-load_tmx = pytmx.TiledMap
\ No newline at end of file
+    returns an AsyncLoader.  call its pump method once each frame until it
+    returns True, then get the map with its result method.
+    """
+    load_kwargs = dict((k, kwargs[k]) for k in kwargs if k in
+                       ("layer_storage", "cache_dir", "memory_map", "lazy_layers",
+                        "compact_objects", "region"))
+
+    def images(tmxdata):
+        return _iter_load_images_pygame(tmxdata, None, **kwargs)
+
+    return AsyncLoader(filename, progress, images, **load_kwargs)
+
+
+def _compile_map((filename, kwargs)):
+    """
+    load a map in a worker process of load_many, and return it compiled
+    """
+    from .compiled import dumps_compiled
+    import traceback
+
+    try:
+        tmxdata = load_tmx(filename, **kwargs)
+
+        # the parent can map the compiled file itself
+        if kwargs.get("cache_dir") and kwargs.get("memory_map"):
+            return True, None
+
+        return True, dumps_compiled(tmxdata)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def load_many(filenames, workers=None, **kwargs):
+    """
+    Load many TMX files in a pool of processes, and return a list of TiledMap
+    classes, without images, in the same order as the filenames.
+
+    workers is the number of processes; by default, one for each cpu.  maps
+    are sent back to this process in the compact, compiled format.
+
+    if a map cannot be loaded, its place in the list holds an Exception with
+    the error, instead of a TiledMap.  the other maps are still loaded.
+
+    other keyword arguments are passed to load_tmx.
+    """
+    from multiprocessing import Pool
+    from .compiled import loads_compiled
+
+    jobs = [(filename, kwargs) for filename in filenames]
+
+    if workers == 1:
+        results = map(_compile_map, jobs)
+    else:
+        pool = Pool(workers)
+        try:
+            results = pool.map(_compile_map, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    layer_storage = kwargs.get("layer_storage", "array")
+    maps = []
+    for filename, (loaded, data) in zip(filenames, results):
+        if not loaded:
+            msg = "Cannot load map: {0}\n{1}"
+            maps.append(Exception(msg.format(filename, data)))
+            continue
+
+        if data is None:
+            # maps the file the worker compiled.  if the worker could not save
+            # it, the map is loaded here instead.
+            tmxdata = load_tmx(filename, **kwargs)
+        else:
+            tmxdata = loads_compiled(data, layer_storage)
+            tmxdata.filename = filename
+
+        maps.append(tmxdata)
+
+    return maps
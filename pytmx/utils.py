@@ -1,8 +1,22 @@
-# from pygame import Rect
 from itertools import tee, islice, izip, product
 from collections import defaultdict
+import array
+import os
+import sys
 from .constants import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# array typecode of an unsigned 32-bit int; 'L' is 64 bits on some platforms
+GID_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# numpy dtypes used to store internal gids, by array typecode
+GID_DTYPES = {'B': 'uint8', 'H': 'uint16', 'L': 'uint32'}
+
 
 def read_points(text):
     return [tuple(map(lambda x: float(x), i.split(',')))
@@ -26,6 +40,15 @@ def parse_properties(node):
     return d
 
 
+def parse_tile_properties(node):
+    """
+    parse the tiles of a tileset node and return a list of (id, properties)
+    """
+
+    return [(int(child.get("id")), parse_properties(child))
+            for child in node.getiterator('tile')]
+
+
 def decode_gid(raw_gid):
     # gids are encoded with extra information
     # as of 0.7.0 it determines if the tile should be flipped when rendered
@@ -40,6 +63,117 @@ def decode_gid(raw_gid):
     return gid, flags
 
 
+def unpack_gids(data):
+    """
+    unpack a string of decoded/decompressed layer data into a sequence of raw
+    (tmx) gids.  the string is read as little-endian, unsigned 32-bit ints in
+    one step, rather than one tile at a time.
+    """
+
+    if len(data) % 4:
+        msg = "Layer data is not a sequence of 32-bit ints ({0} bytes)."
+        raise ValueError, msg.format(len(data))
+
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype='<u4')
+
+    gids = array.array(GID_TYPECODE)
+    gids.fromstring(data)
+    if sys.byteorder == 'big':
+        gids.byteswap()
+
+    return gids
+
+
+def pack_gids(gids):
+    """
+    pack a sequence of raw (tmx) gids into a string of little-endian,
+    unsigned 32-bit ints, the opposite of unpack_gids
+    """
+
+    if numpy is not None:
+        return numpy.asarray(gids, dtype='<u4').tostring()
+
+    gids = array.array(GID_TYPECODE, gids)
+    if sys.byteorder == 'big':
+        gids.byteswap()
+
+    return gids.tostring()
+
+
+def read_csv_gids(text, size=None):
+    """
+    read the raw (tmx) gids from the text of a csv encoded layer in one pass.
+    any whitespace, including newlines and a trailing comma, is accepted.
+
+    raises ValueError if a value is empty or missing, or if size is set and
+    the number of gids is not size.
+    """
+
+    # there is a value before every comma, and after the last one unless the
+    # text ends with a comma
+    count = text.count(',')
+    if not text.rstrip().endswith(','):
+        count += 1
+
+    text = text.replace(',', ' ')
+
+    if numpy is not None:
+        gids = numpy.fromstring(text, dtype=numpy.uint32, sep=' ')
+    else:
+        gids = array.array(GID_TYPECODE, map(int, text.split()))
+
+    if len(gids) != count:
+        msg = "CSV data has {0} values, but {1} gids could be read; a value is empty or invalid."
+        raise ValueError, msg.format(count, len(gids))
+
+    if size is not None and len(gids) != size:
+        msg = "CSV data has {0} gids, expected {1}."
+        raise ValueError, msg.format(len(gids), size)
+
+    return gids
+
+
+def replace_file(source, destination):
+    """
+    rename source to destination, replacing destination if it exists.
+    os.rename cannot replace files on windows, so the old file is removed
+    first when the rename fails.
+    """
+
+    try:
+        os.rename(source, destination)
+    except OSError:
+        if not os.path.exists(destination):
+            raise
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+def remove_file(path):
+    """
+    remove a file, if it exists.  errors are ignored.
+    """
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def gid_typecode(gid):
+    """
+    return the narrowest array typecode that can store internal gids up to gid
+    """
+
+    if gid <= 0xff:
+        return 'B'
+    elif gid <= 0xffff:
+        return 'H'
+    else:
+        return 'L'
+
+
 def handle_bool(text):
     # properly convert strings to a bool
     try:
@@ -86,6 +220,7 @@ types.update({
     "y": float,
     "value": str,
     "rotation": float,
+    "infinite": handle_bool,
 })
 
 
@@ -107,6 +242,8 @@ def buildDistributionRects(tmxmap, layer, tileset=None, real_gid=None):
     of the specified gid.
 
     useful for generating rects for use in collision detection
+
+    returns a list of (x, y, width, height) tuples, in pixels
     """
 
     if isinstance(tileset, int):
@@ -136,7 +273,7 @@ def buildDistributionRects(tmxmap, layer, tileset=None, real_gid=None):
             raise ValueError, msg.format(real_gid)
 
     if isinstance(layer, int):
-        layer_data = tmxmap.getLayerData(layer).data
+        layer_data = tmxmap.getLayerData(layer)
     elif isinstance(layer, str):
         try:
             layer = [l for l in tmxmap.tilelayers if l.name == layer].pop()
@@ -155,16 +292,8 @@ def buildDistributionRects(tmxmap, layer, tileset=None, real_gid=None):
     return rects
 
 
-def simplify(all_points, tilewidth, tileheight):
+def simplify(all_points, tilewidth, tileheight, exact=False):
     """
-    kludge:
-
-    "A kludge (or kluge) is a workaround, a quick-and-dirty solution,
-    a clumsy or inelegant, yet effective, solution to a problem, typically
-    using parts that are cobbled together."
-
-    -- wikipedia
-
     turn a list of points into a rects
     adjacent rects will be combined.
 
@@ -193,51 +322,281 @@ def simplify(all_points, tilewidth, tileheight):
 
         pretty cool, right?
 
-    there may be cases where the number of rectangles is not as low as possible,
-    but I haven't found that it is excessively bad.  certainly much better than
-    making a list of rects, one for each tile on the map!
+    the points are drawn into a grid, which is merged three ways: by rows, by
+    columns, and by the greedy merge of older versions of pytmx.  the way that
+    makes the fewest rects is used, so there are never more rects than
+    before.  the time taken is linear to the area covered by the points, and
+    there is no recursion.
+
+    if exact is True, the fewest rects possible are found instead; see
+    exact_rects.  this takes longer on large areas.
 
+    returns a list of (x, y, width, height) tuples, in pixels
     """
 
-    def pick_rect(points, rects):
-        ox, oy = sorted([(sum(p), p) for p in points])[0][1]
-        x = ox
-        y = oy
-        ex = None
+    if not all_points:
+        return []
+
+    xs, ys = zip(*all_points)
+    left, top = min(xs) - 1, min(ys) - 1
+    width, height = max(xs) - left + 2, max(ys) - top + 2
+
+    def make_grid(transpose=False):
+        # a border of empty tiles keeps every lookup inside the grid
+        if transpose:
+            grid = [bytearray(height) for i in xrange(width)]
+            for x, y in all_points:
+                grid[x - left][y - top] = 1
+        else:
+            grid = [bytearray(width) for i in xrange(height)]
+            for x, y in all_points:
+                grid[y - top][x - left] = 1
+        return grid
+
+    if exact:
+        rect_list = exact_rects(make_grid(), width, height)
+    else:
+        rect_list = min(scanline_rects(make_grid(), width, height),
+                        [(x, y, w, h) for y, x, h, w in
+                         scanline_rects(make_grid(True), height, width)],
+                        greedy_rects(make_grid(), width, height),
+                        key=len)
 
-        while 1:
+    return [((x + left) * tilewidth, (y + top) * tileheight,
+             w * tilewidth, h * tileheight)
+            for x, y, w, h in sorted(rect_list, key=lambda r: (r[1], r[0]))]
+
+
+def scanline_rects(grid, width, height):
+    """
+    merge the solid tiles of a grid into rects, one row at a time.  a rect is
+    extended downwards while the row below is solid under all of it, and the
+    tiles left over in each row start new rects.
+
+    the grid is a list of bytearray rows, with a border of empty tiles, and
+    is changed.  returns a list of (x, y, width, height) tuples, in tiles.
+    """
+
+    rects = []
+    open_rects = {}  # (first column, last column): first row
+    for y, row in enumerate(grid):
+        found = {}
+
+        # extend the rects from the row above, if this row is solid under them
+        for (x1, x2), y1 in open_rects.items():
+            if all(row[x1:x2 + 1]):
+                found[(x1, x2)] = y1
+                row[x1:x2 + 1] = bytearray(x2 - x1 + 1)
+            else:
+                rects.append((x1, y1, x2 - x1 + 1, y - y1))
+
+        # the remaining runs of solid tiles start new rects
+        x = 0
+        while x < width:
+            if row[x]:
+                x1 = x
+                while row[x]:
+                    x += 1
+                found[(x1, x - 1)] = y
             x += 1
-            if not (x, y) in points:
-                if ex is None:
-                    ex = x - 1
 
-                if ((ox, y + 1) in points):
-                    if x == ex + 1:
-                        y += 1
-                        x = ox
+        open_rects = found
+
+    # the last row is empty, so no rects are open
+    return rects
+
+
+def greedy_rects(grid, width, height):
+    """
+    merge the solid tiles of a grid into rects like the merge of older
+    versions of pytmx, which makes the same rects, in linear time.
+
+    the tile nearest the top left corner, by x + y, starts each rect.  the
+    rect is extended to the right up to the first gap, then down over the
+    rows that are solid under it.  the tiles of the rect are then removed.
 
+    the grid is as for scanline_rects, and is changed.
+    """
+
+    rects = []
+
+    # the tiles in order of x + y, then x
+    for s in xrange(2, width + height - 3):
+        for ox in xrange(max(1, s - height + 2), min(width - 1, s)):
+            oy = s - ox
+            if not grid[oy][ox]:
+                continue
+
+            x, y = ox, oy
+            ex = None
+            while 1:
+                x += 1
+                if not grid[y][x]:
+                    if ex is None:
+                        ex = x - 1
+                    if grid[y + 1][ox]:
+                        if x == ex + 1:
+                            y += 1
+                            x = ox
+                        else:
+                            y -= 1
+                            break
                     else:
-                        y -= 1
+                        if x <= ex:
+                            y -= 1
                         break
-                else:
-                    if x <= ex: y -= 1
-                    break
 
-        c_rect = Rect(ox * tilewidth, oy * tileheight, \
-                      (ex - ox + 1) * tilewidth, (y - oy + 1) * tileheight)
+            for row in xrange(oy, y + 1):
+                grid[row][ox:ex + 1] = bytearray(ex - ox + 1)
+            rects.append((ox, oy, ex - ox + 1, y - oy + 1))
+
+    return rects
 
-        rects.append(c_rect)
 
-        rect = Rect(ox, oy, ex - ox + 1, y - oy + 1)
-        kill = [p for p in points if rect.collidepoint(p)]
-        [points.remove(i) for i in kill]
+def exact_rects(grid, width, height):
+    """
+    merge the solid tiles of a grid into the fewest rects possible.
 
-        if points:
-            pick_rect(points, rects)
+    every inside corner of the area needs a cut that starts there; a straight
+    cut between two inside corners (a chord) serves both of them.  the
+    largest set of chords that do not cross is found with a bipartite
+    matching between the horizontal and vertical chords, then the corners
+    left over are cut straight up or down until the cut meets the edge of the
+    area or another cut.  the matching takes more than linear time.
 
-    rect_list = []
-    while all_points:
-        pick_rect(all_points, rect_list)
+    the grid is as for scanline_rects, and is changed.
+    """
 
-    return rect_list
+    # vertex (x, y) is the top left corner of tile (x, y).  these test if the
+    # edge leaving a vertex to the east or south has solid tiles on both sides
+    def east(x, y):
+        return grid[y - 1][x] and grid[y][x]
+
+    def south(x, y):
+        return grid[y][x - 1] and grid[y][x]
+
+    def solid(x, y):
+        return (grid[y - 1][x - 1] + grid[y - 1][x] +
+                grid[y][x - 1] + grid[y][x])
+
+    # inside corners are the vertices with three solid tiles around them
+    corners = [(x, y) for y in xrange(1, height) for x in xrange(1, width)
+               if solid(x, y) == 3]
+
+    # chords are found from their top or left end: (x1, y1, x2, y2)
+    hchords, vchords = [], []
+    for x, y in corners:
+        if east(x, y):
+            x2 = x + 1
+            while solid(x2, y) == 4:
+                x2 += 1
+            if solid(x2, y) == 3:
+                hchords.append((x, y, x2, y))
+        if south(x, y):
+            y2 = y + 1
+            while solid(x, y2) == 4:
+                y2 += 1
+            if solid(x, y2) == 3:
+                vchords.append((x, y, x, y2))
+
+    # a horizontal and a vertical chord conflict if they touch
+    by_row = defaultdict(list)
+    for i, (x1, y, x2, y2) in enumerate(hchords):
+        by_row[y].append(i)
+
+    conflicts = [[] for i in hchords]
+    for j, (x, y1, x2, y2) in enumerate(vchords):
+        for y in xrange(y1, y2 + 1):
+            for i in by_row.get(y, ()):
+                if hchords[i][0] <= x <= hchords[i][2]:
+                    conflicts[i].append(j)
+
+    # maximum matching of horizontal to vertical chords, by augmenting paths
+    match_h = [None] * len(hchords)
+    match_v = [None] * len(vchords)
+    for root in xrange(len(hchords)):
+        parent = {}
+        stack = [root]
+        seen = set()
+        end = None
+        while stack and end is None:
+            i = stack.pop()
+            for j in conflicts[i]:
+                if j in seen:
+                    continue
+                seen.add(j)
+                parent[j] = i
+                if match_v[j] is None:
+                    end = j
+                    break
+                stack.append(match_v[j])
+        while end is not None:
+            i = parent[end]
+            match_v[end] = i
+            match_h[i], end = end, match_h[i]
+
+    # the largest set of chords that do not conflict is the complement of
+    # the smallest vertex cover, which is found from the matching (konig)
+    reach_h = set(i for i, j in enumerate(match_h) if j is None)
+    reach_v = set()
+    stack = list(reach_h)
+    while stack:
+        for j in conflicts[stack.pop()]:
+            if j not in reach_v:
+                reach_v.add(j)
+                i = match_v[j]
+                if i not in reach_h:
+                    reach_h.add(i)
+                    stack.append(i)
+
+    chords = [hchords[i] for i in reach_h]
+    chords.extend(c for j, c in enumerate(vchords) if j not in reach_v)
+
+    # cuts are stored as the vertex where an edge starts; hcuts go east and
+    # vcuts go south
+    hcuts, vcuts = set(), set()
+    done = set()
+    for x1, y1, x2, y2 in chords:
+        if y1 == y2:
+            hcuts.update((x, y1) for x in xrange(x1, x2))
+        else:
+            vcuts.update((x1, y) for y in xrange(y1, y2))
+        done.add((x1, y1))
+        done.add((x2, y2))
+
+    # the other corners are cut up or down, until the cut meets another
+    for x, y in corners:
+        if (x, y) in done:
+            continue
+        step = 1 if south(x, y) else -1
+        while 1:
+            if step > 0:
+                vcuts.add((x, y))
+                y += 1
+            else:
+                y -= 1
+                vcuts.add((x, y))
+            ahead = (x, y) if step > 0 else (x, y - 1)
+            if (solid(x, y) < 4 or ahead in vcuts or
+                    (x, y) in hcuts or (x - 1, y) in hcuts):
+                break
+
+    # every piece is now a rect; each is found from its top left tile
+    rects = []
+    for y in xrange(1, height - 1):
+        row = grid[y]
+        for x in xrange(1, width - 1):
+            if row[x] != 1:
+                continue
+            w = 1
+            while row[x + w] == 1 and (x + w, y) not in vcuts:
+                w += 1
+            h = 1
+            while all(grid[y + h][i] == 1 and (i, y + h) not in hcuts
+                      for i in xrange(x, x + w)):
+                h += 1
+            for i in xrange(y, y + h):
+                grid[i][x:x + w] = bytearray([2]) * w
+            rects.append((x, y, w, h))
 
+    return rects
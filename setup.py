@@ -4,7 +4,7 @@
 from setuptools import setup
 
 setup(name="PyTMX",
-      version='2.16.6',
+      version='2.17.0',
       description='Map loader for TMX Files - Python 2.7',
       author='bitcraft',
       author_email='leif.theden@gmail.com',
@@ -0,0 +1,572 @@
+"""
+Benchmarks for PyTMX.  Does not require a display, or the files in data/.
+
+bitcraft (leif dot theden at gmail.com)
+
+Synthetic maps:
+    A map of any size is generated in a temporary folder, with its tilesets
+    and their images, then timed:
+
+        load          TiledMap(filename)
+        parse         TiledLayer.parse of each tile layer
+        register_gid  registering the gids of a layer one tile at a time,
+                      and in bulk with register_gids
+        simplify      buildDistributionRects and simplify over a layer
+        lookups       getTileGID, getTileImage, getTileProperties and
+                      getTileImages
+        load_images   _load_images_pygame, with the dummy SDL video driver.
+                      skipped if pygame is not installed.
+
+    Each benchmark is run a few times; the best and the median times are
+    reported, in seconds.  Pass --output to save the results as JSON, to
+    compare releases.
+
+    python benchmark.py [width] [height] [--layers 4] [--tilesets 2]
+                        [--objects 1000] [--encoding zlib] [--external]
+                        [--repeat 5] [--output results.json]
+
+    encoding is one of xml, csv, base64, zlib or gzip.  with --external, the
+    tilesets are saved as TSX files.
+
+Layer decoding:
+    A large, synthetic layer is decoded by TiledLayer.parse and compared
+    against the old decoder, which unpacked, decoded and registered the
+    gids one tile at a time.
+
+    python benchmark.py [width] [height] --legacy
+"""
+import sys
+import os
+import argparse
+import gzip
+import json
+import platform
+import random
+import shutil
+import tempfile
+import timeit
+import zlib
+from base64 import encodestring
+from StringIO import StringIO
+from struct import pack, unpack
+from itertools import imap, product
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pygame must not open a window
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pytmx
+from pytmx.utils import decode_gid, group, simplify, buildDistributionRects, numpy
+from pytmx.constants import *
+
+ENCODINGS = ('xml', 'csv', 'base64', 'zlib', 'gzip')
+
+# (encoding, compression) attributes of the <data> element
+DATA_ATTRIBUTES = {
+    'xml': (None, None),
+    'csv': ('csv', None),
+    'base64': ('base64', None),
+    'zlib': ('base64', 'zlib'),
+    'gzip': ('base64', 'gzip'),
+}
+
+
+def random_gids(rand, size, unique, empty=.2, flipped=.1):
+    """
+    return a list of raw gids from 1 to unique, with some empty tiles and
+    some flipped or rotated tiles
+    """
+    flags = (GID_TRANS_FLIPX, GID_TRANS_FLIPY, GID_TRANS_ROT)
+    gids = []
+    for i in xrange(size):
+        if rand.random() < empty:
+            gids.append(0)
+            continue
+
+        gid = rand.randint(1, unique)
+        if rand.random() < flipped:
+            gid |= rand.choice(flags)
+        gids.append(gid)
+
+    return gids
+
+
+def encode_data(data_node, gids, encoding):
+    """
+    fill in a <data> element with gids in an encoding
+    """
+    if encoding == 'xml':
+        for gid in gids:
+            ElementTree.SubElement(data_node, 'tile', gid=str(gid))
+        return
+
+    if encoding == 'csv':
+        data_node.text = ",".join(imap(str, gids))
+        return
+
+    data = pack("<{0}L".format(len(gids)), *gids)
+    if encoding == 'zlib':
+        data = zlib.compress(data)
+    elif encoding == 'gzip':
+        buf = StringIO()
+        fh = gzip.GzipFile(fileobj=buf, mode='wb')
+        fh.write(data)
+        fh.close()
+        data = buf.getvalue()
+
+    data_node.text = encodestring(data)
+
+
+def write_png(path, width, height, seed=0):
+    """
+    save a RGBA image of random, solid tiles with some transparent pixels.
+    only uses the standard library, so pygame or PIL are not needed.
+    """
+    rand = random.Random(seed)
+    rows = []
+    for y in xrange(height):
+        row = ['\0']
+        for x in xrange(width):
+            alpha = 0 if rand.random() < .05 else 255
+            row.append(pack("BBBB", (x * 7) & 255, (y * 5) & 255,
+                            rand.randint(0, 255), alpha))
+        rows.append("".join(row))
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return pack(">I", len(data)) + tag + data + pack(">I", crc)
+
+    header = pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    with open(path, 'wb') as fh:
+        fh.write('\x89PNG\r\n\x1a\n')
+        fh.write(chunk('IHDR', header))
+        fh.write(chunk('IDAT', zlib.compress("".join(rows))))
+        fh.write(chunk('IEND', ''))
+
+
+def make_tileset_node(name, columns, tiles, tilesize, image, seed=0):
+    """
+    return a <tileset> element, where some of the tiles have properties
+    """
+    rand = random.Random(seed)
+    rows = (tiles + columns - 1) // columns
+    node = ElementTree.Element('tileset', name=name, tilewidth=str(tilesize),
+                               tileheight=str(tilesize))
+    ElementTree.SubElement(node, 'image', source=image,
+                           width=str(columns * tilesize),
+                           height=str(rows * tilesize))
+
+    for i in xrange(tiles):
+        if rand.random() < .1:
+            tile_node = ElementTree.SubElement(node, 'tile', id=str(i))
+            props = ElementTree.SubElement(tile_node, 'properties')
+            ElementTree.SubElement(props, 'property', name='solid',
+                                   value=str(rand.randint(0, 1)))
+
+    return node
+
+
+def make_map(directory, width=128, height=128, layers=2, tilesets=1,
+             objects=0, encoding='zlib', external=False, tiles=64,
+             tilesize=16, seed=0):
+    """
+    write a synthetic map, its tilesets and their images into directory,
+    and return the path of the TMX file
+    """
+    if encoding not in ENCODINGS:
+        msg = "Encoding must be one of {0}.  Got {1} instead."
+        raise ValueError, msg.format(", ".join(ENCODINGS), encoding)
+
+    rand = random.Random(seed)
+    columns = 8
+    rows = (tiles + columns - 1) // columns
+
+    root = ElementTree.Element('map', version='1.0', orientation='orthogonal',
+                               width=str(width), height=str(height),
+                               tilewidth=str(tilesize),
+                               tileheight=str(tilesize))
+
+    for i in xrange(tilesets):
+        image = 'tileset{0}.png'.format(i)
+        write_png(os.path.join(directory, image), columns * tilesize,
+                  rows * tilesize, seed + i)
+
+        firstgid = str(i * tiles + 1)
+        node = make_tileset_node('tileset{0}'.format(i), columns, tiles,
+                                 tilesize, image, seed + i)
+        if external:
+            source = 'tileset{0}.tsx'.format(i)
+            ElementTree.ElementTree(node).write(os.path.join(directory, source))
+            ElementTree.SubElement(root, 'tileset', firstgid=firstgid,
+                                   source=source)
+        else:
+            node.set('firstgid', firstgid)
+            root.append(node)
+
+    data_encoding, compression = DATA_ATTRIBUTES[encoding]
+    for i in xrange(layers):
+        layer_node = ElementTree.SubElement(root, 'layer',
+                                            name='layer{0}'.format(i),
+                                            width=str(width),
+                                            height=str(height))
+        data_node = ElementTree.SubElement(layer_node, 'data')
+        if data_encoding:
+            data_node.set('encoding', data_encoding)
+        if compression:
+            data_node.set('compression', compression)
+
+        gids = random_gids(rand, width * height, tilesets * tiles)
+        encode_data(data_node, gids, encoding)
+
+    if objects:
+        group_node = ElementTree.SubElement(root, 'objectgroup', name='objects')
+        map_width, map_height = width * tilesize, height * tilesize
+        for i in xrange(objects):
+            x, y = rand.randint(0, map_width), rand.randint(0, map_height)
+            attrs = dict(id=str(i + 1), name='object{0}'.format(i),
+                         x=str(x), y=str(y))
+            kind = rand.random()
+            if kind < .2:
+                # tile object
+                attrs['gid'] = str(rand.randint(1, tilesets * tiles))
+                ElementTree.SubElement(group_node, 'object', **attrs)
+            elif kind < .3:
+                node = ElementTree.SubElement(group_node, 'object', **attrs)
+                points = " ".join("{0},{1}".format(rand.randint(-64, 64),
+                                                   rand.randint(-64, 64))
+                                  for j in xrange(5))
+                ElementTree.SubElement(node, 'polygon', points=points)
+            else:
+                attrs['width'] = str(rand.randint(1, 128))
+                attrs['height'] = str(rand.randint(1, 128))
+                node = ElementTree.SubElement(group_node, 'object', **attrs)
+                props = ElementTree.SubElement(node, 'properties')
+                ElementTree.SubElement(props, 'property', name='kind',
+                                       value=str(rand.randint(0, 3)))
+
+    path = os.path.join(directory, 'synthetic.tmx')
+    ElementTree.ElementTree(root).write(path, encoding='UTF-8')
+    return path
+
+
+def timed(func, repeat, setup=None):
+    """
+    run func repeat times and return the best and median times, in seconds.
+    setup is called before each run, and is not timed.
+    """
+    times = []
+    for i in xrange(repeat):
+        if setup:
+            setup()
+        t0 = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - t0)
+
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'repeat': repeat}
+
+
+def clear_caches():
+    """
+    drop the caches of tilesets and of tile transparency, so every run
+    starts cold
+    """
+    from pytmx import tmxloader
+
+    pytmx.tileset_cache.invalidate()
+    tmxloader.opacity_cache.clear()
+
+
+def bench_load(path, repeat):
+    return timed(lambda: pytmx.TiledMap(path), repeat, clear_caches)
+
+
+def bench_parse(path, repeat):
+    nodes = ElementTree.parse(path).getroot().findall('layer')
+    tiledmap = pytmx.TiledMap()
+
+    def run():
+        tiledmap.imagemap[(0, 0)] = 0
+        for node in nodes:
+            pytmx.TiledLayer(tiledmap, node)
+
+    result = timed(run, repeat)
+    result['layers'] = len(nodes)
+    return result
+
+
+def bench_register_gid(tmxdata, repeat):
+    layer = tmxdata.tilelayers[0]
+    node = ElementTree.parse(tmxdata.filename).getroot().find('layer')
+    data_node = node.find('data')
+    payload = layer.read_payload(data_node, data_node.get('encoding'))
+    raw_gids = list(layer.read_gids(payload, data_node.get('compression')))
+
+    def fresh_map():
+        tiledmap = pytmx.TiledMap()
+        tiledmap.imagemap[(0, 0)] = 0
+        return tiledmap
+
+    def per_tile():
+        tiledmap = fresh_map()
+        register_gid = tiledmap.register_gid
+        for raw_gid in raw_gids:
+            register_gid(*decode_gid(raw_gid))
+
+    def bulk():
+        fresh_map().register_gids(raw_gids)
+
+    return {'per_tile': timed(per_tile, repeat),
+            'bulk': timed(bulk, repeat),
+            'tiles': len(raw_gids)}
+
+
+def bench_simplify(tmxdata, repeat):
+    layer = tmxdata.tilelayers[0]
+    points = [(x, y) for x, y, gid in layer.iter_tiles() if gid]
+    tw, th = tmxdata.tilewidth, tmxdata.tileheight
+
+    return {'buildDistributionRects': timed(lambda: buildDistributionRects(tmxdata, 0), repeat),
+            'simplify': timed(lambda: simplify(points, tw, th), repeat),
+            'points': len(points)}
+
+
+def bench_lookups(tmxdata, repeat, count=100000, seed=0):
+    # images are not needed to look them up
+    if not tmxdata.images:
+        tmxdata.images = range(tmxdata.maxgid)
+
+    rand = random.Random(seed)
+    layers = len(tmxdata.tilelayers)
+    tiles = [(rand.randrange(tmxdata.width), rand.randrange(tmxdata.height),
+              rand.randrange(layers)) for i in xrange(count)]
+
+    def get_gids():
+        for x, y, l in tiles:
+            tmxdata.getTileGID(x, y, l)
+
+    def get_images():
+        for x, y, l in tiles:
+            tmxdata.getTileImage(x, y, l)
+
+    def get_properties():
+        for tile in tiles:
+            tmxdata.getTileProperties(tile)
+
+    def get_area():
+        rect = (0, 0, tmxdata.width, tmxdata.height)
+        for i in tmxdata.getTileImages(rect, range(layers)):
+            pass
+
+    return {'getTileGID': timed(get_gids, repeat),
+            'getTileImage': timed(get_images, repeat),
+            'getTileProperties': timed(get_properties, repeat),
+            'getTileImages': timed(get_area, repeat),
+            'lookups': count}
+
+
+def bench_load_images(path, repeat):
+    try:
+        import pygame
+    except ImportError:
+        return None
+
+    from pytmx.tmxloader import _load_images_pygame
+
+    pygame.display.init()
+    pygame.display.set_mode((1, 1), 0, 32)
+    tmxdata = pytmx.TiledMap(path)
+
+    result = timed(lambda: _load_images_pygame(tmxdata, None), repeat,
+                   clear_caches)
+    result['images'] = tmxdata.maxgid - 1
+    return result
+
+
+def run_suite(options):
+    """
+    generate a synthetic map and time it.  returns the results as a dict.
+    """
+    directory = tempfile.mkdtemp(prefix='pytmx-benchmark-')
+    try:
+        path = make_map(directory, options.width, options.height,
+                        options.layers, options.tilesets, options.objects,
+                        options.encoding, options.external, options.tiles,
+                        options.tilesize, options.seed)
+
+        repeat = options.repeat
+        tmxdata = pytmx.TiledMap(path)
+        results = {
+            'load': bench_load(path, repeat),
+            'parse': bench_parse(path, repeat),
+            'register_gid': bench_register_gid(tmxdata, repeat),
+            'simplify': bench_simplify(tmxdata, repeat),
+            'lookups': bench_lookups(tmxdata, repeat),
+        }
+
+        load_images = bench_load_images(path, repeat)
+        if load_images is not None:
+            results['load_images'] = load_images
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+def environment():
+    """
+    return the versions of python and of the libraries used
+    """
+    try:
+        import pygame
+        pygame_version = pygame.version.ver
+    except ImportError:
+        pygame_version = None
+
+    return {'pytmx': pytmx.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': numpy.__version__ if numpy is not None else None,
+            'pygame': pygame_version}
+
+
+def print_results(results, indent=""):
+    width = 24 - len(indent)
+    for name in sorted(results):
+        value = results[name]
+        if isinstance(value, dict) and 'min' in value:
+            print "{0}{1:<{2}} {3:9.4f}s  (median {4:.4f}s)".format(
+                indent, name, width, value['min'], value['median'])
+        elif isinstance(value, dict):
+            print "{0}{1}".format(indent, name)
+            print_results(value, indent + "  ")
+        else:
+            print "{0}{1:<{2}} {3:9}".format(indent, name, width, value)
+
+
+def make_layer_node(width, height, unique=64, seed=0):
+    """
+    return a <layer> node with base64 and zlib encoded data.
+    about one in ten tiles are flipped or rotated.
+    """
+    rand = random.Random(seed)
+    flags = (0, GID_TRANS_FLIPX, GID_TRANS_FLIPY, GID_TRANS_ROT)
+    gids = []
+    for i in xrange(width * height):
+        gid = rand.randint(0, unique)
+        if gid and rand.random() < .1:
+            gid |= rand.choice(flags)
+        gids.append(gid)
+
+    data = zlib.compress(pack("<{0}L".format(len(gids)), *gids))
+
+    node = ElementTree.Element('layer', name='benchmark',
+                               width=str(width), height=str(height))
+    data_node = ElementTree.SubElement(node, 'data',
+                                       encoding='base64', compression='zlib')
+    data_node.text = encodestring(data)
+    return node
+
+
+def legacy_decode(tmxmap, node):
+    """
+    the old per-tile decoder, kept to compare against
+    """
+    import array
+    from base64 import decodestring
+
+    width = int(node.get('width'))
+    height = int(node.get('height'))
+    data = zlib.decompress(decodestring(node.find('data').text.strip()))
+    next_gid = imap(lambda i: unpack("<L", "".join(i))[0], group(data, 4))
+
+    rows = [array.array("H") for i in xrange(height)]
+    for (y, x) in product(xrange(height), xrange(width)):
+        rows[y].append(tmxmap.register_gid(*decode_gid(next(next_gid))))
+
+    return rows
+
+
+def bench_layer_decode(width, height, number=3):
+    node = make_layer_node(width, height)
+
+    # both decoders must agree on the data and gid mapping
+    legacy_map = pytmx.TiledMap()
+    legacy_map.imagemap[(0, 0)] = 0
+    legacy = legacy_decode(legacy_map, node)
+
+    tiledmap = pytmx.TiledMap()
+    tiledmap.imagemap[(0, 0)] = 0
+    layer = pytmx.TiledLayer(tiledmap, node)
+    assert layer.data == legacy
+    assert tiledmap.imagemap == legacy_map.imagemap
+    assert tiledmap.gidmap == legacy_map.gidmap
+
+    def run_legacy():
+        legacy_decode(pytmx.TiledMap(), node)
+
+    def run_parse():
+        pytmx.TiledLayer(pytmx.TiledMap(), node)
+
+    t0 = min(timeit.repeat(run_legacy, number=1, repeat=number))
+    t1 = min(timeit.repeat(run_parse, number=1, repeat=number))
+
+    print "Layer decode: {0}x{1} tiles, base64/zlib".format(width, height)
+    print "  per tile: {0:.3f}s".format(t0)
+    print "      bulk: {0:.3f}s".format(t1)
+    print "   speedup: {0:.1f}x".format(t0 / t1)
+
+    return {'per_tile': t0, 'bulk': t1, 'speedup': t0 / t1}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for PyTMX.")
+    parser.add_argument('width', type=int, nargs='?', default=None)
+    parser.add_argument('height', type=int, nargs='?', default=None)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--tilesets', type=int, default=2)
+    parser.add_argument('--tiles', type=int, default=64,
+                        help="tiles in each tileset")
+    parser.add_argument('--tilesize', type=int, default=16)
+    parser.add_argument('--objects', type=int, default=1000)
+    parser.add_argument('--encoding', choices=ENCODINGS, default='zlib')
+    parser.add_argument('--external', action='store_true',
+                        help="save the tilesets as TSX files")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--legacy', action='store_true',
+                        help="compare layer decoding with the old decoder")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+
+    if options.legacy:
+        width, height = options.width or 512, options.height or 512
+        results = {'layer_decode': bench_layer_decode(width, height)}
+    else:
+        options.width = options.width or 256
+        options.height = options.height or options.width
+        print "Synthetic map: {0}x{1} tiles, {2} layers, {3} tilesets, {4} objects, {5}{6}".format(
+            options.width, options.height, options.layers, options.tilesets,
+            options.objects, options.encoding,
+            ", external tilesets" if options.external else "")
+        results = run_suite(options)
+        print_results(results)
+
+    if options.output:
+        params = dict((k, v) for k, v in vars(options).items()
+                      if k != 'output')
+        report = {'environment': environment(), 'params': params,
+                  'results': results}
+        with open(options.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -70,7 +70,6 @@ class ScrollingRenderer(TiledRenderer):
         sw, sh = surface.get_size()
         tw = self.tiledmap.tilewidth
         th = self.tiledmap.tileheight
-        gt = self.tiledmap.getTileImage
 
         stw = int(math.ceil(float(sw) / tw)) + 1
         sth = int(math.ceil(float(sh) / th)) + 1
@@ -78,22 +77,18 @@ class ScrollingRenderer(TiledRenderer):
         txf, pxf = divmod((cx-sw/2), tw)
         tyf, pyf = divmod((cy-sh/2), th)
 
-        if stw + txf > self.mapwidth: stw -= 1
-        if sth + tyf > self.mapheight: sth -= 1
-
-        p = product(xrange(stw), xrange(sth),
-                    xrange(len(self.tiledmap.tilelayers)))
+        # fetch all the visible tiles of all layers at once
+        layers = xrange(len(self.tiledmap.tilelayers))
+        tiles = self.tiledmap.getTileImages((txf, tyf, stw, sth), layers)
 
-        for x, y, l in p:
-            tile = gt(x+txf, y+tyf, l)
-            if tile: surface.blit(tile, (x*tw-pxf, y*th-pyf))
+        for x, y, l, tile in tiles:
+            if tile: surface.blit(tile, ((x-txf)*tw-pxf, (y-tyf)*th-pyf))
 
 
 
 import pygame
 from pygame.locals import *
 import math
-from itertools import product
 
 
 pygame.init()
@@ -0,0 +1,1351 @@
+"""
+Headless tests for PyTMX.  Does not require a display.  tests of the image
+loaders are skipped if pygame or numpy is not installed.
+
+    python test_maps.py
+"""
+import base64
+import gzip
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pytmx
+from pytmx.cache import TilesetCache, opacity_cache
+from pytmx.compiled import (compiled_path, dumps_compiled, load_compiled,
+                            loads_compiled)
+from pytmx.constants import GID_TRANS_FLIPX, GID_TRANS_ROT
+from pytmx.chunks import TileChunks
+from pytmx.pytmx import GID_BLOCK
+from pytmx.spatial import ObjectIndex, object_bounds
+from pytmx.imageloader import NumpyImageLoader, iter_load_images
+from pytmx.tmxloader import PygameImageLoader, opacity_cache, opacity_path
+from pytmx.utils import decode_gid, pack_gids, simplify, numpy, GID_DTYPES
+
+try:
+    import pygame
+except ImportError:
+    pygame = None
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', '0.9.1')
+
+MAP = """<?xml version="1.0" encoding="UTF-8"?>
+<map version="1.0" orientation="orthogonal" width="{width}" height="{height}" tilewidth="16" tileheight="16">
+ <properties>
+{properties}
+ </properties>
+ <tileset firstgid="1" name="tiles" tilewidth="16" tileheight="16">
+  <image source="tiles.png" width="64" height="64"/>
+  <tile id="2">
+   <properties>
+    <property name="kind" value="water"/>
+   </properties>
+  </tile>
+ </tileset>
+{layers}
+</map>
+"""
+
+LAYER = """ <layer name="{name}" width="{width}" height="{height}">
+  <data encoding="csv">
+{data}
+  </data>
+ </layer>"""
+
+TSX_MAP = """<?xml version="1.0" encoding="UTF-8"?>
+<map version="1.0" orientation="orthogonal" width="8" height="8" tilewidth="16" tileheight="16">
+ <tileset firstgid="1" source="tiles.tsx"/>
+{layers}
+</map>
+"""
+
+TSX = """<?xml version="1.0" encoding="UTF-8"?>
+<tileset name="tiles" tilewidth="16" tileheight="16">
+ <properties>
+{properties}
+ </properties>
+ <image source="tiles.png" width="64" height="64"/>
+</tileset>
+"""
+
+INFINITE_MAP = """<?xml version="1.0" encoding="UTF-8"?>
+<map version="1.2" orientation="orthogonal" width="8" height="8" tilewidth="16" tileheight="16" infinite="1">
+ <tileset firstgid="1" name="tiles" tilewidth="16" tileheight="16">
+  <image source="tiles.png" width="64" height="64"/>
+ </tileset>
+ <layer name="csv" width="8" height="8">
+  <data encoding="csv">
+{csv}
+  </data>
+ </layer>
+ <layer name="zlib" width="8" height="8">
+  <data encoding="base64" compression="zlib">
+{zlib}
+  </data>
+ </layer>
+</map>
+"""
+
+CHUNK = """   <chunk x="{x}" y="{y}" width="4" height="4">{data}</chunk>"""
+
+# chunks of the infinite map: (x, y) of their top left tile
+CHUNKS = [(-4, -8), (0, 0), (12, 4), (-8, 8)]
+
+
+def infinite_gid(x, y, layer):
+    """
+    gid of a tile of the infinite map, which is empty outside of CHUNKS
+    """
+    for cx, cy in CHUNKS:
+        if cx <= x < cx + 4 and cy <= y < cy + 4:
+            return (x * 3 + y + layer) % 12 + 1
+    return 0
+
+
+def write_infinite_map(directory):
+    """
+    write an infinite map with a csv and a base64 zlib layer, and return
+    its path
+    """
+    layers = []
+    for layer in (0, 1):
+        chunks = []
+        for cx, cy in CHUNKS:
+            gids = [infinite_gid(x, y, layer) for y in xrange(cy, cy + 4)
+                    for x in xrange(cx, cx + 4)]
+            if layer == 0:
+                data = ",".join(map(str, gids))
+            else:
+                data = base64.b64encode(zlib.compress(pack_gids(gids)))
+            chunks.append(CHUNK.format(x=cx, y=cy, data=data))
+        layers.append("\n".join(chunks))
+
+    path = os.path.join(directory, 'infinite.tmx')
+    with open(path, 'w') as fh:
+        fh.write(INFINITE_MAP.format(csv=layers[0], zlib=layers[1]))
+    return path
+
+
+def write_map(directory, properties=None, width=8, height=8, layers=1):
+    """
+    write a small map where the gid of each tile of layer n is
+    (x + y + n) % 16 + 1, and return its path
+    """
+    nodes = []
+    for n in xrange(layers):
+        data = ",\n".join(",".join(str((x + y + n) % 16 + 1) for x in xrange(width))
+                          for y in xrange(height))
+        nodes.append(LAYER.format(name="layer{0}".format(n), width=width,
+                                  height=height, data=data))
+    props = "\n".join('  <property name="{0}" value="{1}"/>'.format(k, v)
+                      for k, v in sorted((properties or {}).items()))
+    path = os.path.join(directory, 'map.tmx')
+    with open(path, 'w') as fh:
+        fh.write(MAP.format(properties=props, width=width, height=height,
+                            layers="\n".join(nodes)))
+    return path
+
+
+def write_gids_map(directory, layers, width, height, chunked=False):
+    """
+    write a map with a csv layer for each list of raw gids in layers, and
+    return its path.  if chunked is set, the map is infinite and the layers
+    are saved in chunks of 16x16 tiles.
+    """
+    nodes = []
+    for n, gids in enumerate(layers):
+        if chunked:
+            chunks = []
+            for cy in xrange(0, height, 16):
+                for cx in xrange(0, width, 16):
+                    data = ",".join(str(gids[y * width + x])
+                                    for y in xrange(cy, cy + 16)
+                                    for x in xrange(cx, cx + 16))
+                    chunks.append('<chunk x="{0}" y="{1}" width="16" height="16">'
+                                  '{2}</chunk>'.format(cx, cy, data))
+            data = "".join(chunks)
+        else:
+            data = ",".join(map(str, gids))
+        nodes.append(LAYER.format(name="layer{0}".format(n), width=width,
+                                  height=height, data=data))
+
+    text = MAP.format(properties="", width=width, height=height,
+                      layers="\n".join(nodes))
+    if chunked:
+        text = text.replace('<map version="1.0"', '<map version="1.2" infinite="1"', 1)
+    path = os.path.join(directory, 'gids.tmx')
+    with open(path, 'w') as fh:
+        fh.write(text)
+    return path
+
+
+def write_encoded_map(directory, encoding, compression=None, width=8, height=8):
+    """
+    write a map like write_map, with one layer in the given encoding and
+    compression.  encoding None is a tile element for each tile.
+    """
+    path = write_map(directory, width=width, height=height)
+    gids = [(x + y) % 16 + 1 for y in xrange(height) for x in xrange(width)]
+    if encoding == "csv":
+        return path
+
+    if encoding is None:
+        data = "".join('<tile gid="{0}"/>'.format(gid) for gid in gids)
+    else:
+        data = pack_gids(gids)
+        if compression == "zlib":
+            data = zlib.compress(data)
+        elif compression == "gzip":
+            fh = StringIO()
+            with gzip.GzipFile(fileobj=fh, mode='wb') as gz:
+                gz.write(data)
+            data = fh.getvalue()
+        data = base64.b64encode(data)
+
+    attributes = "".join(' {0}="{1}"'.format(k, v) for k, v in
+                         (("encoding", encoding), ("compression", compression)) if v)
+    with open(path) as fh:
+        text = fh.read()
+    start = text.index('<data')
+    end = text.index('</data>') + len('</data>')
+    with open(path, 'w') as fh:
+        fh.write(text[:start] + '<data{0}>{1}</data>'.format(attributes, data) +
+                 text[end:])
+    return path
+
+
+def write_tsx_map(directory, properties=None):
+    """
+    write the map of write_map, with its tileset in an external TSX file,
+    and return the path of the map
+    """
+    props = "\n".join('  <property name="{0}" value="{1}"/>'.format(k, v)
+                      for k, v in sorted((properties or {}).items()))
+    with open(os.path.join(directory, 'tiles.tsx'), 'w') as fh:
+        fh.write(TSX.format(properties=props))
+
+    path = write_map(directory)
+    with open(path) as fh:
+        layers = fh.read().split('</tileset>')[1].replace('</map>', '')
+    with open(path, 'w') as fh:
+        fh.write(TSX_MAP.format(layers=layers.strip('\n')))
+    return path
+
+
+def init_display():
+    """
+    open a small 32 bit display, without a window, so surfaces can be converted
+    """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pygame.display.init()
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((1, 1), 0, 32)
+
+
+def surface_pixels(surface):
+    """
+    return the pixels of a pygame surface as a numpy array, like the tiles of
+    NumpyImageLoader
+    """
+    width, height = surface.get_size()
+    data = pygame.image.tostring(surface, 'RGBA')
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 4)
+
+
+def blit_on_black(surface):
+    """
+    return the pixels of a pygame surface drawn on black, as a string
+    """
+    screen = pygame.Surface(surface.get_size(), 0, 32)
+    screen.fill((0, 0, 0))
+    screen.blit(surface, (0, 0))
+    return pygame.image.tostring(screen, 'RGB')
+
+
+def legacy_simplify(points):
+    """
+    the rect merger of pytmx 2.16, without pygame: return the rects that it
+    makes from a list of points, in tiles
+    """
+    points = list(points)
+    rects = []
+    while points:
+        ox, oy = min((sum(p), p) for p in points)[1]
+        x, y = ox, oy
+        ex = None
+        while 1:
+            x += 1
+            if (x, y) not in points:
+                if ex is None:
+                    ex = x - 1
+                if (ox, y + 1) in points:
+                    if x == ex + 1:
+                        y += 1
+                        x = ox
+                    else:
+                        y -= 1
+                        break
+                else:
+                    if x <= ex:
+                        y -= 1
+                    break
+        rects.append((ox, oy, ex - ox + 1, y - oy + 1))
+        points = [(px, py) for px, py in points
+                  if not (ox <= px <= ex and oy <= py <= y)]
+    return rects
+
+
+def grid_points(rows):
+    return [(x, y) for y, row in enumerate(rows)
+            for x, c in enumerate(row) if c == '#']
+
+
+class MapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def real_gid(self, tmxdata, x, y, layer=0):
+        """
+        return the gid of a tile in the TMX file
+        """
+        gid = tmxdata.getTileGID(x, y, layer)
+        for (real_gid, flags), value in tmxdata.imagemap.items():
+            if value and value[0] == gid:
+                return real_gid
+        return 0
+
+    def assertSameMap(self, a, b):
+        self.assertEqual(a.imagemap, b.imagemap)
+        self.assertEqual(a.maxgid, b.maxgid)
+        self.assertEqual(a.tile_properties, b.tile_properties)
+        self.assertEqual(a.getTileLocation(3), b.getTileLocation(3))
+        for la, lb in zip(a.tilelayers, b.tilelayers):
+            self.assertEqual(la.name, lb.name)
+            self.assertEqual([list(row) for row in la.data],
+                             [list(row) for row in lb.data])
+
+
+class TestLoaderOptions(MapTestCase):
+
+    def test_map_properties_do_not_replace_options(self):
+        properties = {'region': 'north', 'layer_storage': 'disk',
+                      'lazy_layers': 'yes', 'compact_objects': 'no'}
+        path = write_map(self.directory, properties)
+
+        tmxdata = pytmx.TiledMap(path, region=(2, 2, 3, 3))
+        self.assertEqual(tmxdata.region, 'north')
+        self.assertEqual(self.real_gid(tmxdata, 3, 3), 7)
+        self.assertEqual(tmxdata.getTileGID(0, 0, 0), 0)
+
+        tmxdata = pytmx.TiledMap(path)
+        self.assertEqual(self.real_gid(tmxdata, 7, 7), 15)
+
+    def test_csv_values_are_counted(self):
+        path = write_map(self.directory)
+        with open(path) as fh:
+            data = fh.read()
+
+        for bad in ('\n1,,3,', '\n1,2,2,3,', '\n1,2 3,'):
+            with open(path, 'w') as fh:
+                fh.write(data.replace('\n1,2,3,', bad, 1))
+            for lazy_layers in (False, True):
+                with self.assertRaises(ValueError):
+                    pytmx.TiledMap(path, lazy_layers=lazy_layers)
+
+
+class TestCompiled(MapTestCase):
+
+    def test_compiled_map_matches_tmx(self):
+        path = write_map(self.directory, width=24, height=16, layers=2)
+        eager = pytmx.TiledMap(path)
+
+        self.assertSameMap(loads_compiled(dumps_compiled(eager)), eager)
+
+        cache_dir = os.path.join(self.directory, 'cache')
+        pytmx.load_tmx(path, cache_dir=cache_dir)
+        compiled = compiled_path(path, cache_dir)
+        self.assertTrue(os.path.exists(compiled))
+        self.assertSameMap(load_compiled(compiled), eager)
+        self.assertSameMap(pytmx.load_tmx(path, cache_dir=cache_dir), eager)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_memory_mapped_layers_are_copy_on_write(self):
+        path = write_map(self.directory, width=24, height=16, layers=2)
+        eager = pytmx.TiledMap(path)
+        cache_dir = os.path.join(self.directory, 'cache')
+        compiled = compiled_path(path, cache_dir)
+
+        # compiled by the first load, and mapped by both
+        maps = [pytmx.load_tmx(path, cache_dir=cache_dir, memory_map=True)
+                for i in xrange(2)]
+        with open(compiled, 'rb') as fh:
+            saved = fh.read()
+        mtime = os.path.getmtime(compiled)
+
+        for tmxdata in maps:
+            self.assertSameMap(tmxdata, eager)
+            data = tmxdata.tilelayers[1].data
+            self.assertIsInstance(data, numpy.ndarray)
+            self.assertFalse(data.flags.owndata)
+
+        a, b = maps
+        gid = a.getTileGID(1, 0, 0)
+        a.setTileGID(0, 0, 0, gid)
+        a.tilelayers[1].data[:] = 0
+        self.assertEqual(a.getTileGID(0, 0, 0), gid)
+        self.assertEqual(a.getTileGID(5, 5, 1), 0)
+
+        # the changes are private to the map, and never written to the file
+        self.assertSameMap(b, eager)
+        del a, b, maps, data
+        with open(compiled, 'rb') as fh:
+            self.assertEqual(fh.read(), saved)
+        self.assertEqual(os.path.getmtime(compiled), mtime)
+        self.assertSameMap(load_compiled(compiled, memory_map=True), eager)
+
+    def test_unwritable_cache_returns_parsed_map(self):
+        path = write_map(self.directory)
+        eager = pytmx.TiledMap(path)
+
+        # the cache folder cannot be made, as a file has its name
+        cache_dir = os.path.join(self.directory, 'cache')
+        open(cache_dir, 'w').close()
+        self.assertSameMap(pytmx.load_tmx(path, cache_dir=cache_dir), eager)
+
+        # the compiled map cannot replace a folder with its name
+        cache_dir = os.path.join(self.directory, 'other')
+        os.makedirs(compiled_path(path, cache_dir))
+        for memory_map in (False, True):
+            tmxdata = pytmx.load_tmx(path, cache_dir=cache_dir,
+                                     memory_map=memory_map)
+            self.assertSameMap(tmxdata, eager)
+        self.assertEqual(os.listdir(cache_dir),
+                         [os.path.basename(compiled_path(path, cache_dir))])
+
+    def test_changed_sources_are_not_used(self):
+        path = write_tsx_map(self.directory)
+        compiled = os.path.join(self.directory, 'map.tmxc')
+        pytmx.TiledMap(path).save_compiled(compiled)
+        self.assertIsNotNone(load_compiled(compiled))
+
+        # the external tileset has changed
+        write_tsx_map(self.directory, {'kind': 'grass'})
+        self.assertIsNone(load_compiled(compiled))
+        self.assertIsNotNone(load_compiled(compiled, check=False))
+
+        # the map has changed; same size, so its hash is checked
+        pytmx.TiledMap(path).save_compiled(compiled)
+        with open(path) as fh:
+            data = fh.read()
+        with open(path, 'w') as fh:
+            fh.write(data.replace('width="8"', 'width="9"', 1))
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        self.assertIsNone(load_compiled(compiled))
+
+    def test_tileset_property_named_filename(self):
+        path = write_tsx_map(self.directory, {'filename': 'other.tsx'})
+        tmxdata = pytmx.TiledMap(path)
+        tileset = tmxdata.tilesets[0]
+        self.assertEqual(tileset.filename, 'other.tsx')
+        self.assertEqual(tileset._filename,
+                         os.path.join(self.directory, 'tiles.tsx'))
+
+        compiled = os.path.join(self.directory, 'map.tmxc')
+        tmxdata.save_compiled(compiled)
+        self.assertIsNotNone(load_compiled(compiled))
+
+
+class TestLoadMany(MapTestCase):
+
+    def test_load_many_matches_serial_loads(self):
+        paths = [os.path.join(DATA, name) for name in
+                 ('sewers.tmx', 'formosa-base64.tmx', 'frnknstn.tmx')]
+        paths.append(write_map(self.directory, width=20, height=12, layers=3))
+        missing = os.path.join(self.directory, 'missing.tmx')
+        cache_dir = os.path.join(self.directory, 'cache')
+
+        # the workers cannot save compiled maps here
+        unwritable = os.path.join(self.directory, 'file')
+        open(unwritable, 'w').close()
+
+        for kwargs in ({}, {'layer_storage': 'numpy'},
+                       {'cache_dir': cache_dir, 'memory_map': True},
+                       {'cache_dir': unwritable, 'memory_map': True},
+                       {'region': (1, 1, 6, 5), 'compact_objects': True}):
+            if 'numpy' in kwargs.values() or 'memory_map' in kwargs:
+                if numpy is None:
+                    continue
+
+            for workers in (1, 2):
+                maps = pytmx.load_many(paths + [missing], workers, **kwargs)
+                self.assertIsInstance(maps[-1], Exception)
+                self.assertEqual(len(maps), len(paths) + 1)
+
+                for path, tmxdata in zip(paths, maps):
+                    expected = pytmx.load_tmx(path, **kwargs)
+                    self.assertEqual(tmxdata.filename, path)
+                    self.assertSameMap(tmxdata, expected)
+                    self.assertEqual([(o.name, o.type, o.x, o.y, o.gid)
+                                      for o in tmxdata.objects],
+                                     [(o.name, o.type, o.x, o.y, o.gid)
+                                      for o in expected.objects])
+
+
+class TestAsyncLoader(MapTestCase):
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_images_are_made_a_few_at_a_time_by_pump(self):
+        path = os.path.join(DATA, 'formosa-base64.tmx')
+        expected = pytmx.load_tmx(path)
+        expected.loadTileImages(NumpyImageLoader())
+
+        go = threading.Event()
+        calls = []
+
+        def progress(kind, item):
+            if kind == "images":
+                calls.append((kind, item))
+            else:
+                calls.append((kind, threading.current_thread().name))
+                go.wait()
+
+        def images(tmxdata):
+            return iter_load_images(tmxdata, NumpyImageLoader())
+
+        loader = pytmx.AsyncLoader(path, progress, images)
+
+        # the map is still being parsed
+        self.assertFalse(loader.pump())
+        self.assertFalse(loader.parsed())
+        go.set()
+        loader.thread.join()
+        self.assertTrue(loader.parsed())
+
+        pumps = 1
+        while not loader.pump(3):
+            pumps += 1
+            self.assertLessEqual(pumps, expected.maxgid)
+        self.assertTrue(loader.pump())
+
+        parts = [c for c in calls if c[0] != "images"]
+        self.assertIn(("layer", loader.thread.name), parts)
+        self.assertIn(("tileset", loader.thread.name), parts)
+        steps = [item for kind, item in calls if kind == "images"]
+        self.assertEqual(steps, sorted(steps))
+        self.assertEqual(steps[-1][0], steps[-1][1])
+        # up to 3 images each pump
+        self.assertGreaterEqual(pumps * 3, len(steps))
+
+        tmxdata = loader.result()
+        self.assertSameMap(tmxdata, expected)
+        for gid in xrange(1, expected.maxgid):
+            self.assertTrue((tmxdata.images[gid] == expected.images[gid]).all())
+
+    def test_errors_are_raised_by_pump_and_result(self):
+        loader = pytmx.AsyncLoader(os.path.join(self.directory, 'missing.tmx'))
+        loader.thread.join()
+        self.assertRaises(IOError, loader.pump)
+        self.assertRaises(IOError, loader.result)
+
+        path = write_map(self.directory)
+        loader = pytmx.AsyncLoader(path)
+        self.assertSameMap(loader.result(), pytmx.TiledMap(path))
+        self.assertTrue(loader.pump())
+
+    @unittest.skipIf(pygame is None, "requires pygame")
+    def test_load_pygame_async_matches_load_pygame(self):
+        init_display()
+        path = os.path.join(DATA, 'sewers.tmx')
+        expected = pytmx.load_pygame(path, pixelalpha=True)
+        tmxdata = pytmx.load_pygame_async(path, pixelalpha=True).result()
+        self.assertSameMap(tmxdata, expected)
+        for gid in xrange(1, expected.maxgid):
+            self.assertEqual(pygame.image.tostring(tmxdata.images[gid], 'RGBA'),
+                             pygame.image.tostring(expected.images[gid], 'RGBA'))
+
+
+OBJECTS = """ <objectgroup name="things">
+  <object id="1" name="door" type="door" x="10" y="20" width="30" height="40">
+   <properties>
+    <property name="locked" value="1"/>
+    <property name="key" value="red"/>
+   </properties>
+  </object>
+  <object id="2" name="gate" type="door" x="50" y="60" width="8" height="8">
+   <properties>
+    <property name="locked" value="1"/>
+    <property name="key" value="red"/>
+   </properties>
+  </object>
+  <object id="3" x="5" y="5">
+   <polygon points="0,0 10,0 10,10"/>
+  </object>
+  <object id="4" x="5" y="5" rotation="45">
+   <polyline points="0,0 10,5"/>
+  </object>
+  <object id="5" gid="3" x="32" y="48"/>
+  <object id="6" gid="3" x="64" y="48" width="32" height="32">
+   <properties>
+    <property name="kind" value="lava"/>
+    <property name="depth" value="2"/>
+   </properties>
+  </object>
+ </objectgroup>"""
+
+
+class TestCompactObjects(MapTestCase):
+
+    def setUp(self):
+        MapTestCase.setUp(self)
+        path = write_map(self.directory)
+        with open(path) as fh:
+            data = fh.read()
+        with open(path, 'w') as fh:
+            fh.write(data.replace('</map>', OBJECTS + '\n</map>'))
+
+        self.full = pytmx.TiledMap(path)
+        self.compact = pytmx.TiledMap(path, compact_objects=True)
+
+    def test_compact_objects_match_tiled_objects(self):
+        pairs = zip(self.full.objects, self.compact.objects)
+        self.assertEqual(len(pairs), 6)
+        for full, compact in pairs:
+            self.assertIsInstance(compact, pytmx.CompactTiledObject)
+            self.assertIs(compact.parent, self.compact)
+            for name, value in vars(full).items():
+                if name != 'parent':
+                    self.assertEqual(getattr(compact, name), value, name)
+            self.assertRaises(AttributeError, getattr, compact, 'missing')
+
+        # the properties of the tile, unless the object has its own
+        tile_objects = [o for o in self.compact.objects if o.gid]
+        self.assertEqual([o.kind for o in tile_objects], ['water', 'water'])
+        self.assertEqual(tile_objects[1].depth, '2')
+        self.assertEqual((tile_objects[0].width, tile_objects[0].height), (16, 16))
+
+    def test_setting_properties_does_not_change_other_objects(self):
+        door, gate = list(self.compact.objects)[:2]
+        self.assertIs(door.properties, gate.properties)
+
+        door.key = 'blue'
+        door.x = 11
+        self.assertEqual((door.key, gate.key), ('blue', 'red'))
+        self.assertEqual((door.x, gate.x), (11, 50))
+
+        del gate.locked
+        self.assertEqual(door.locked, '1')
+        self.assertRaises(AttributeError, getattr, gate, 'locked')
+        self.assertRaises(AttributeError, delattr, gate, 'locked')
+
+
+class TestChunkedLayers(MapTestCase):
+
+    def real_gids(self, tmxdata):
+        """
+        return a dict of internal gid: real gid of a map
+        """
+        return dict((value[0], real_gid)
+                    for (real_gid, flags), value in tmxdata.imagemap.items()
+                    if value)
+
+    def test_infinite_map_tiles(self):
+        path = write_infinite_map(self.directory)
+        tmxdata = pytmx.TiledMap(path)
+        real = self.real_gids(tmxdata)
+
+        for l, layer in enumerate(tmxdata.tilelayers):
+            # the chunks are only decoded when they are used
+            self.assertEqual(len(layer.data.payloads), len(CHUNKS))
+            self.assertEqual(layer.data.bounds(), (-8, -8, 24, 20))
+
+            for y in xrange(-10, 14):
+                for x in xrange(-10, 18):
+                    gid = tmxdata.getTileGID(x, y, l)
+                    self.assertEqual(real.get(gid, 0), infinite_gid(x, y, l))
+
+            self.assertEqual(len(layer.data.payloads), 0)
+
+    def test_infinite_map_region_only_decodes_its_chunks(self):
+        path = write_infinite_map(self.directory)
+        tmxdata = pytmx.TiledMap(path)
+        real = self.real_gids(tmxdata)
+        chunks = tmxdata.tilelayers[1].data
+
+        area = (-6, -7, 9, 10)
+        found = [(x, y, real[gid]) for x, y, gid in chunks.iter_region(*area)]
+        expected = [(x, y, infinite_gid(x, y, 1))
+                    for y in xrange(-7, 3) for x in xrange(-6, 3)
+                    if infinite_gid(x, y, 1)]
+        self.assertEqual(found, expected)
+        self.assertEqual(sorted(chunks.chunks), [(-1, -2), (0, 0)])
+
+    def test_infinite_map_compiles(self):
+        path = write_infinite_map(self.directory)
+        eager = pytmx.TiledMap(path)
+        eager.getTileGID(0, 0, 0)
+        compiled = loads_compiled(dumps_compiled(eager))
+
+        for l in (0, 1):
+            self.assertEqual(list(compiled.tilelayers[l].data),
+                             list(eager.tilelayers[l].data))
+
+    def test_region_matches_eager_load(self):
+        path = write_map(self.directory, width=40, height=40, layers=2)
+        eager = pytmx.TiledMap(path)
+        region = (5, 18, 20, 30)
+        window = pytmx.TiledMap(path, region=region)
+        real = self.real_gids(window)
+
+        for l in (0, 1):
+            for y in xrange(40):
+                for x in xrange(40):
+                    inside = 5 <= x < 25 and 18 <= y < 48
+                    expected = self.real_gid(eager, x, y, l) if inside else 0
+                    gid = window.getTileGID(x, y, l)
+                    self.assertEqual(real.get(gid, 0), expected)
+
+    def test_region_keeps_tile_objects_above_their_y(self):
+        # the tile object at 96, 128 covers the pixels from 96, 96 to 128, 128
+        path = os.path.join(DATA, 'frnknstn.tmx')
+        for region, found in (((3, 3, 1, 1), True), ((3, 5, 1, 1), False)):
+            tmxdata = pytmx.TiledMap(path, region=region)
+            gids = [o.gid for o in tmxdata.objects if o.gid]
+            self.assertEqual(bool(gids), found)
+
+    def test_map_gid_does_not_register(self):
+        tmxdata = pytmx.TiledMap(os.path.join(DATA, 'frnknstn.tmx'))
+        size = len(tmxdata.gidmap)
+        self.assertEqual(tmxdata.map_gid(999), [])
+        self.assertEqual(len(tmxdata.gidmap), size)
+        self.assertNotIn(999, tmxdata.gidmap)
+
+    def test_set_tile_outside_chunks_after_indexing(self):
+        path = write_map(self.directory, width=64, height=64)
+        tmxdata = pytmx.TiledMap(path, region=(0, 0, 16, 16))
+        tmxdata.build_gid_index()
+
+        gid = tmxdata.getTileGID(1, 1, 0)
+        tmxdata.setTileGID(40, 40, 0, gid)
+        self.assertEqual(tmxdata.getTileGID(40, 40, 0), gid)
+        self.assertIn((40, 40, 0), tmxdata.getTileLocation(gid))
+        self.assertNotIn(0, tmxdata.layer_gids[0])
+
+        tmxdata.setTileGID(40, 40, 0, 0)
+        self.assertEqual(tmxdata.getTileGID(40, 40, 0), 0)
+        self.assertNotIn((40, 40, 0), tmxdata.getTileLocation(gid))
+
+
+class TestWidening(MapTestCase):
+
+    # 256 x 272 tiles, so the last layer has more than 0xffff unique gids
+    width, height = 256, 272
+
+    def layers(self):
+        size = self.width * self.height
+        return [[i % 10 + 1 for i in xrange(size)],
+                [i % 300 + 1 for i in xrange(size)],
+                [i + 1 for i in xrange(size)]]
+
+    def typecode(self, data):
+        if isinstance(data, TileChunks):
+            data = data.get_chunk(0, 0)
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            return [k for k, v in GID_DTYPES.items() if data.dtype == v][0]
+        return data[0].typecode
+
+    def assertWidened(self, chunked=False, **options):
+        layers = self.layers()
+        path = write_gids_map(self.directory, layers, self.width, self.height,
+                              chunked)
+        seen = []
+
+        def progress(kind, item):
+            if kind != "layer":
+                return
+            tmxdata = item.parent
+            first = tmxdata.tilelayers[0]
+            if first.payload is None:
+                # the first layer, already decoded, keeps up with the map
+                self.assertEqual(self.typecode(first.data), tmxdata.layer_typecode)
+            seen.append(tmxdata.layer_typecode)
+
+        tmxdata = pytmx.TiledMap(path, progress=progress, **options)
+        self.assertEqual(seen, ['B', 'H', 'L'])
+
+        real = numpy.zeros(tmxdata.maxgid, dtype=numpy.uint32)
+        for (real_gid, flags), value in tmxdata.imagemap.items():
+            if value:
+                real[value[0]] = real_gid
+
+        for layer, gids in zip(tmxdata.tilelayers, layers):
+            self.assertEqual(self.typecode(layer.data), 'L')
+            if chunked:
+                layer.data.decode()
+                data = numpy.zeros((self.height, self.width), dtype=numpy.uint32)
+                for (column, row), chunk in layer.data.chunks.items():
+                    data[row * 16:row * 16 + 16,
+                         column * 16:column * 16 + 16] = numpy.asarray(chunk)
+            else:
+                data = numpy.asarray(layer.data)
+            self.assertEqual(real[data].ravel().tolist(), gids)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_array_layers_are_widened(self):
+        self.assertWidened()
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_numpy_layers_are_widened(self):
+        self.assertWidened(layer_storage="numpy")
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_lazy_layers_are_widened(self):
+        self.assertWidened(lazy_layers=True)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_chunked_layers_are_widened(self):
+        self.assertWidened(chunked=True)
+        self.assertWidened(chunked=True, layer_storage="numpy")
+
+
+class TestLazyLayers(MapTestCase):
+
+    def test_lazy_layers_match_eager_layers(self):
+        path = write_map(self.directory, width=32, height=32, layers=2)
+        eager = pytmx.TiledMap(path)
+        lazy = pytmx.TiledMap(path, lazy_layers=True)
+
+        self.assertEqual(lazy.imagemap, eager.imagemap)
+        for a, b in zip(lazy.tilelayers, eager.tilelayers):
+            self.assertEqual([list(row) for row in a.data],
+                             [list(row) for row in b.data])
+
+    def test_lazy_load_does_less_work_than_eager_load(self):
+        counts = {}
+
+        def counting(cls, name):
+            method = getattr(cls, name)
+
+            def counted(*args, **kwargs):
+                counts[name] = counts.get(name, 0) + 1
+                return method(*args, **kwargs)
+
+            setattr(cls, name, counted)
+            self.addCleanup(setattr, cls, name, method)
+
+        counting(pytmx.TiledLayer, 'read_gids')
+        counting(pytmx.TiledLayer, 'build_data')
+        counting(pytmx.TiledMap, 'register_gid')
+        counting(zlib, 'compress')
+        counting(gzip.GzipFile, 'write')
+
+        for encoding, compression in (("csv", None), (None, None),
+                                      ("base64", None), ("base64", "zlib"),
+                                      ("base64", "gzip")):
+            path = write_encoded_map(self.directory, encoding, compression,
+                                     width=32, height=24)
+            counts.clear()
+            eager = pytmx.TiledMap(path)
+            expected = dict(counts)
+            self.assertEqual(expected['read_gids'], 1)
+            self.assertEqual(expected['build_data'], 1)
+
+            # the gids are read and registered once, as when loading eagerly,
+            # but they are not mapped, stored or compressed again
+            counts.clear()
+            lazy = pytmx.TiledMap(path, lazy_layers=True)
+            self.assertEqual(counts, {'read_gids': 1,
+                                      'register_gid': expected['register_gid']})
+
+            payload, lazy_compression = lazy.tilelayers[0].payload
+            self.assertEqual(lazy_compression, compression)
+            self.assertEqual(lazy.imagemap, eager.imagemap)
+            self.assertEqual([list(row) for row in lazy.tilelayers[0].data],
+                             [list(row) for row in eager.tilelayers[0].data])
+
+    def test_properties_by_layer_only_decodes_that_layer(self):
+        path = write_map(self.directory, layers=2)
+        eager = pytmx.TiledMap(path)
+        lazy = pytmx.TiledMap(path, lazy_layers=True)
+
+        self.assertEqual(lazy.getTilePropertiesByLayer(1),
+                         eager.getTilePropertiesByLayer(1))
+        self.assertIsNotNone(lazy.tilelayers[0].payload)
+        self.assertIsNone(lazy.layer_gids[0])
+
+        # layers that are not indexed yet are indexed when they are needed
+        gid = lazy.getTileGID(0, 0, 1)
+        lazy.setTileGID(0, 0, 0, gid)
+        eager.setTileGID(0, 0, 0, gid)
+        self.assertEqual(lazy.getTileLocation(gid), eager.getTileLocation(gid))
+
+
+class TestTilesetCache(MapTestCase):
+
+    def touch(self, path):
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+
+    def test_changed_tilesets_are_reloaded(self):
+        path = write_tsx_map(self.directory, {'kind': 'grass'})
+        tsx = os.path.join(self.directory, 'tiles.tsx')
+        self.assertEqual(pytmx.TiledMap(path).tilesets[0].kind, 'grass')
+        entry = pytmx.tileset_cache.get(tsx)
+        self.assertIs(pytmx.tileset_cache.get(tsx), entry)
+
+        write_tsx_map(self.directory, {'kind': 'sand'})
+        self.touch(tsx)
+        self.assertEqual(pytmx.TiledMap(path).tilesets[0].kind, 'sand')
+        self.assertIsNot(pytmx.tileset_cache.get(tsx), entry)
+
+        entry = pytmx.tileset_cache.get(tsx)
+        pytmx.tileset_cache.invalidate(tsx)
+        self.assertIsNot(pytmx.tileset_cache.get(tsx), entry)
+
+        entry = pytmx.tileset_cache.get(tsx)
+        pytmx.tileset_cache.invalidate()
+        self.assertIsNot(pytmx.tileset_cache.get(tsx), entry)
+
+    def test_images_are_dropped_with_their_tileset(self):
+        write_tsx_map(self.directory)
+        tsx = os.path.join(self.directory, 'tiles.tsx')
+        other = os.path.join(self.directory, 'other.tsx')
+        shutil.copy(tsx, other)
+        image = os.path.join(self.directory, 'tiles.png')
+        open(image, 'w').close()
+
+        cache = TilesetCache(maxsize=1)
+
+        def load_image():
+            data = cache.get(tsx).image_data('loader', image)
+            opacity_cache[(image, os.path.getmtime(image))] = {}
+            return data
+
+        # a changed image replaces the old one
+        data = load_image()
+        self.assertIs(load_image(), data)
+        self.touch(image)
+        self.assertIsNot(load_image(), data)
+        self.assertEqual(len(cache.get(tsx).data), 1)
+        self.assertEqual([key for key in opacity_cache if key[0] == image],
+                         [(image, os.path.getmtime(image))])
+
+        # images go with their tileset when it is changed, invalidated or
+        # dropped from the cache
+        for drop in (lambda: (self.touch(tsx), cache.get(tsx)),
+                     lambda: cache.invalidate(tsx),
+                     cache.invalidate,
+                     lambda: cache.get(other)):
+            data = load_image()
+            drop()
+            self.assertNotIn(image, [key[0] for key in opacity_cache])
+            self.assertIsNot(load_image(), data)
+
+
+class TestSimplify(unittest.TestCase):
+
+    def assertCovers(self, rects, points):
+        tiles = [(x + i, y + j) for x, y, w, h in rects
+                 for i in xrange(w) for j in xrange(h)]
+        self.assertEqual(len(tiles), len(set(tiles)))
+        self.assertEqual(sorted(tiles), sorted(points))
+
+    def test_never_more_rects_than_legacy(self):
+        grids = [['.#####', '.#.###', '#####.', '..#.##', '.#####'],
+                 ['#.#.####', '##.#.###', '.####..#', '####.###']]
+        rand = random.Random(0)
+        for i in xrange(300):
+            width, height = rand.randint(1, 10), rand.randint(1, 10)
+            grids.append([''.join(rand.choice('.##') for x in xrange(width))
+                          for y in xrange(height)])
+
+        for rows in grids:
+            points = grid_points(rows)
+            rects = simplify(points, 1, 1)
+            self.assertCovers(rects, points)
+            self.assertLessEqual(len(rects), len(legacy_simplify(points)))
+
+            exact = simplify(points, 1, 1, exact=True)
+            self.assertCovers(exact, points)
+            self.assertLessEqual(len(exact), len(rects))
+
+    def test_large_grid_is_fast(self):
+        # exact=True takes about eight times as long on this grid
+        rand = random.Random(0)
+        points = [(x, y) for y in xrange(768) for x in xrange(768)
+                  if rand.random() < 0.9]
+        start = time.time()
+        rects = simplify(points, 1, 1)
+        self.assertLess(time.time() - start, 6.0)
+        self.assertEqual(sum(w * h for x, y, w, h in rects), len(points))
+
+    def test_rects_are_in_pixels(self):
+        points = grid_points(['.##', '.##', '...', '###'])
+        rects = simplify([(x + 2, y + 1) for x, y in points], 16, 8)
+        self.assertEqual(sorted(rects), [(32, 32, 48, 8), (48, 8, 32, 16)])
+        self.assertEqual(simplify([], 16, 16), [])
+
+
+class Box(object):
+
+    def __init__(self, x, y, width, height, rotation=0, gid=0):
+        self.x, self.y = x, y
+        self.width, self.height = width, height
+        self.rotation = rotation
+        self.gid = gid
+
+
+def box_bounds(box):
+    # tile objects hang above their y, and all objects turn around x, y
+    top = box.y - box.height if box.gid else box.y
+    r = math.radians(box.rotation)
+    xs, ys = [], []
+    for dx, dy in ((0, 0), (box.width, 0), (0, box.height), (box.width, box.height)):
+        dy += top - box.y
+        xs.append(box.x + dx * math.cos(r) - dy * math.sin(r))
+        ys.append(box.y + dx * math.sin(r) + dy * math.cos(r))
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class TestObjectIndex(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.boxes = []
+        for i in xrange(400):
+            size = rand.choice((0, 8, 40, 300, 2000))
+            self.boxes.append(Box(rand.uniform(-500, 1500), rand.uniform(-500, 1500),
+                                  rand.uniform(0, size), rand.uniform(0, size),
+                                  rand.choice((0, 0, 30, 90)),
+                                  rand.choice((0, 0, 1))))
+        self.index = ObjectIndex(self.boxes, 64)
+        self.rand = rand
+
+    def overlapping(self, x, y, w, h):
+        found = []
+        for box in self.boxes:
+            left, top, right, bottom = box_bounds(box)
+            if left <= x + w and x <= right and top <= y + h and y <= bottom:
+                found.append(box)
+        return found
+
+    def by_distance(self, x, y):
+        return sorted(self.boxes, key=lambda box: (self.index.distance(box, x, y),
+                                                   self.boxes.index(box)))
+
+    def test_query_rect_matches_brute_force(self):
+        for i in xrange(200):
+            rect = (self.rand.uniform(-800, 1800), self.rand.uniform(-800, 1800),
+                    self.rand.choice((0, 10, 100, 3000)), self.rand.uniform(0, 500))
+            self.assertEqual(self.index.query_rect(rect), self.overlapping(*rect))
+
+        x, y = 100.5, 200.25
+        self.assertEqual(self.index.query_point(x, y),
+                         self.overlapping(x, y, 0, 0))
+
+    def test_nearest_matches_brute_force(self):
+        for i in xrange(100):
+            x = self.rand.uniform(-3000, 4000)
+            y = self.rand.uniform(-3000, 4000)
+            count = self.rand.choice((1, 5, 50))
+            expected = self.by_distance(x, y)
+            self.assertEqual(self.index.nearest(x, y, count), expected[:count])
+
+            limit = self.rand.uniform(0, 500)
+            expected = [box for box in expected[:count]
+                        if self.index.distance(box, x, y) <= limit]
+            self.assertEqual(self.index.nearest(x, y, count, limit), expected)
+
+    def test_moved_objects_are_found(self):
+        box = self.boxes[10]
+        box.x, box.y, box.width, box.height, box.rotation = 5000, 5000, 4, 4, 0
+        box.gid = 0
+        self.index.update(box)
+        self.assertEqual(self.index.query_point(5002, 5002), [box])
+        self.assertEqual(self.index.nearest(6000, 6000), [box])
+        self.assertEqual(self.index.query_rect((-500, -500, 2000, 2000)),
+                         self.overlapping(-500, -500, 2000, 2000))
+
+    def test_tile_objects_are_above_their_y(self):
+        box = Box(100, 100, 32, 16, gid=1)
+        self.assertEqual(object_bounds(box), (100, 84, 132, 100))
+        box.rotation = 90
+        self.assertEqual([round(n, 6) for n in object_bounds(box)],
+                         [100, 100, 116, 132])
+
+        tmxdata = pytmx.TiledMap(os.path.join(DATA, 'frnknstn.tmx'))
+        obj = [o for o in tmxdata.objects if o.gid][0]
+        index = ObjectIndex(tmxdata.objects)
+        self.assertIn(obj, index.query_point(obj.x + 8, obj.y - 8))
+        self.assertNotIn(obj, index.query_point(obj.x + 8, obj.y + 8))
+
+
+@unittest.skipIf(numpy is None or pygame is None, "requires numpy and pygame")
+class TestImageLoaders(unittest.TestCase):
+
+    def setUp(self):
+        init_display()
+
+    def test_numpy_loader_matches_pygame_loader(self):
+        for name in ('sewers.tmx', 'formosa-base64.tmx'):
+            path = os.path.join(DATA, name)
+            surfaces = pytmx.load_pygame(path, pixelalpha=True)
+            arrays = pytmx.load_tmx(path)
+            arrays.loadTileImages(NumpyImageLoader())
+
+            for gid in xrange(1, surfaces.maxgid):
+                expected = surface_pixels(surfaces.images[gid])
+                tile = arrays.images[gid]
+                visible = tile[:, :, 3] > 0
+
+                # the color of transparent pixels does not matter
+                self.assertTrue((visible == (expected[:, :, 3] > 0)).all())
+                self.assertTrue((tile[visible] == expected[visible]).all())
+
+    def write_overworld_map(self, directory, name, gids):
+        """
+        write a map with one row of tiles of the external overworld tileset
+        """
+        shutil.copy(os.path.join(DATA, '16x16-overworld.tsx'),
+                    os.path.join(directory, 'tiles.tsx'))
+        shutil.copy(os.path.join(DATA, '16x16-overworld.png'), directory)
+
+        layer = LAYER.format(name="ground", width=len(gids), height=1,
+                             data=",".join(map(str, gids)))
+        data = TSX_MAP.format(layers=layer)
+        data = data.replace('width="8"', 'width="{0}"'.format(len(gids)), 1)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as fh:
+            fh.write(data)
+        return path
+
+    def test_maps_share_one_atlas_of_a_tileset(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        loader = NumpyImageLoader()
+        image = loader.load(os.path.join(DATA, '16x16-overworld.png'))
+
+        def tile(tile_id):
+            x, y = tile_id % 16 * 16, tile_id // 16 * 16
+            return image[y:y + 16, x:x + 16]
+
+        paths = [self.write_overworld_map(directory, 'a.tmx', [1, 2, 3]),
+                 self.write_overworld_map(directory, 'b.tmx', [4, 5]),
+                 self.write_overworld_map(directory, 'c.tmx', [2 | GID_TRANS_FLIPX, 6])]
+
+        maps = []
+        for path in paths:
+            tmxdata = pytmx.load_tmx(path)
+            tmxdata.loadTileImages(loader, atlas=True)
+            maps.append(tmxdata)
+
+        a, b, c = [m.getTileAtlasByGid(m.getTileGID(0, 0, 0))[0] for m in maps]
+        self.assertIs(a, b)
+        self.assertIsNot(b, c)
+
+        entry = pytmx.tileset_cache.get(os.path.join(directory, 'tiles.tsx'))
+        atlases = [data['atlas'][0] for data in entry.data.values()]
+        self.assertEqual(len(atlases), 1)
+        self.assertIs(atlases[0], c)
+
+        # the flipped tile is drawn flipped
+        tmxdata = maps[2]
+        flipped = tmxdata.images[tmxdata.getTileGID(0, 0, 0)]
+        self.assertTrue((flipped == tile(1)[:, ::-1]).all())
+        self.assertTrue((tmxdata.images[tmxdata.getTileGID(1, 0, 0)] == tile(5)).all())
+
+    def test_opacity_is_saved_until_the_image_changes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'tiles.png')
+        shutil.copy(os.path.join(DATA, '16x16-overworld.png'), path)
+        image = pygame.image.load(path)
+        rects = [(0, 0, 16, 16), (16, 0, 16, 16), (0, 16, 16, 16)]
+
+        counted = []
+        from_surface = pygame.mask.from_surface
+
+        def counting_from_surface(*args):
+            counted.append(args)
+            return from_surface(*args)
+
+        pygame.mask.from_surface = counting_from_surface
+        self.addCleanup(setattr, pygame.mask, 'from_surface', from_surface)
+
+        cache_dir = os.path.join(directory, 'cache')
+        loader = PygameImageLoader(cache_dir=cache_dir)
+        expected = dict(loader.get_opacity(path, image, rects))
+        self.assertEqual(sorted(expected), sorted(rects))
+        self.assertEqual(len(counted), 1)
+
+        # another process only has the file
+        opacity_cache.clear()
+        self.assertEqual(loader.get_opacity(path, image, rects), expected)
+        self.assertEqual(len(counted), 1)
+
+        # the saved opacity is stale once the image has changed
+        opacity_cache.clear()
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(loader.get_opacity(path, image, rects), expected)
+        self.assertEqual(len(counted), 2)
+
+        # and it is saved again for the changed image
+        opacity_cache.clear()
+        self.assertEqual(loader.get_opacity(path, image, rects), expected)
+        self.assertEqual(len(counted), 2)
+
+        filename = opacity_path(os.path.abspath(path), cache_dir)
+        self.assertEqual(os.listdir(cache_dir), [os.path.basename(filename)])
+
+        # a file that cannot be replaced leaves no temporary file behind
+        opacity_cache.clear()
+        os.remove(filename)
+        os.mkdir(filename)
+        self.assertEqual(loader.get_opacity(path, image, rects), expected)
+        self.assertEqual(os.listdir(cache_dir), [os.path.basename(filename)])
+
+    def test_lazy_images_match_eager_images(self):
+        path = os.path.join(DATA, 'formosa-base64.tmx')
+        eager = pytmx.load_tmx(path)
+        eager.loadTileImages(NumpyImageLoader(copy=True))
+
+        budget = 16 * 16 * 4 * 10
+        lazy = pytmx.load_tmx(path)
+        lazy.loadTileImages(NumpyImageLoader(copy=True), lazy=True, budget=budget)
+        self.assertEqual(lazy.images.nbytes, 0)
+
+        for i in xrange(2):
+            for gid in xrange(1, eager.maxgid):
+                self.assertTrue((lazy.images[gid] == eager.images[gid]).all())
+                self.assertLessEqual(lazy.images.nbytes, budget)
+
+
+@unittest.skipIf(pygame is None, "requires pygame")
+class TestAtlas(unittest.TestCase):
+
+    def setUp(self):
+        init_display()
+
+    def test_atlas_tiles_match_single_tiles(self):
+        # both tilesets have a colorkey
+        for name in ('sewers.tmx', 'testtrack1.tmx'):
+            path = os.path.join(DATA, name)
+            for options in ({}, {'pixelalpha': True}):
+                tiles = pytmx.load_pygame(path, **options)
+                atlas = pytmx.load_pygame(path, atlas=True, **options)
+
+                for gid in xrange(1, tiles.maxgid):
+                    self.assertEqual(blit_on_black(atlas.images[gid]),
+                                     blit_on_black(tiles.images[gid]))
+
+                    image, rect = atlas.getTileAtlasByGid(gid)
+                    self.assertEqual(blit_on_black(image.subsurface(rect)),
+                                     blit_on_black(tiles.images[gid]))
+
+
+@unittest.skipIf(pygame is None, "requires pygame")
+class TestRenderers(unittest.TestCase):
+
+    # offsets of the camera: small and large scrolls, in every direction,
+    # and past the edges of the map
+    offsets = [(0, 0), (5, 3), (30, 3), (30, 50), (29, 49), (-40, -10),
+               (500, 400), (520, 380), (1100, 1100), (12, 700), (12, 650)]
+
+    size = 100, 70
+
+    def setUp(self):
+        init_display()
+        self.path = os.path.join(DATA, 'sewers.tmx')
+
+    def reference(self, offset):
+        """
+        return the pixels of the map at offset, with every tile blitted
+        """
+        tmxdata = self.tmxdata
+        tw, th = tmxdata.tilewidth, tmxdata.tileheight
+        ox, oy = offset
+        screen = pygame.Surface(self.size, 0, 32)
+        screen.fill((0, 0, 0))
+        rect = (ox // tw, oy // th, self.size[0] // tw + 2, self.size[1] // th + 2)
+        layers = [i for i, layer in enumerate(tmxdata.tilelayers) if layer.visible]
+        for x, y, l, image in tmxdata.getTileImages(rect, layers):
+            screen.blit(image, (x * tw - ox, y * th - oy))
+        return pygame.image.tostring(screen, 'RGB')
+
+    def assertMatchesReference(self, renderer):
+        screen = pygame.Surface(self.size, 0, 32)
+        for offset in self.offsets:
+            screen.fill((0, 0, 0))
+            renderer.draw(screen, offset)
+            self.assertEqual(pygame.image.tostring(screen, 'RGB'),
+                             self.reference(offset), offset)
+
+        # a tile on screen, and one that is not
+        tw, th = self.tmxdata.tilewidth, self.tmxdata.tileheight
+        ox, oy = self.offsets[-1]
+        for x, y in ((ox // tw + 1, oy // th + 1), (40, 3)):
+            gid = self.tmxdata.getTileGID(x, y, 0) % (self.tmxdata.maxgid - 1) + 1
+            renderer.setTileGID(x, y, 0, gid)
+
+        for offset in self.offsets[::-1]:
+            screen.fill((0, 0, 0))
+            renderer.draw(screen, offset)
+            self.assertEqual(pygame.image.tostring(screen, 'RGB'),
+                             self.reference(offset), offset)
+
+    def test_chunk_renderer_matches_reference(self):
+        for chunk_size, max_chunks in ((16, 64), (3, 4)):
+            self.tmxdata = pytmx.load_pygame(self.path)
+            renderer = pytmx.ChunkRenderer(self.tmxdata, chunk_size, max_chunks,
+                                           background=(0, 0, 0))
+            self.assertMatchesReference(renderer)
+            self.assertLessEqual(len(renderer.chunks), max_chunks)
+
+    def test_viewport_renderer_matches_reference(self):
+        self.tmxdata = pytmx.load_pygame(self.path)
+        renderer = pytmx.ViewportRenderer(self.tmxdata, self.size,
+                                          background=(0, 0, 0))
+        self.assertMatchesReference(renderer)
+
+        # after a resize, the buffer is drawn again at the new size
+        self.size = 130, 41
+        renderer.resize(self.size)
+        self.assertMatchesReference(renderer)
+
+
+class TestRegisterGids(unittest.TestCase):
+
+    def test_gids_are_registered_in_order_of_appearance(self):
+        flags = (0, GID_TRANS_FLIPX, GID_TRANS_ROT)
+        rand = random.Random(0)
+        raw_gids = [rand.randrange(1, 300) | rand.choice(flags)
+                    for i in xrange(GID_BLOCK * 2 + 5)]
+
+        bulk = pytmx.TiledMap()
+        gids = bulk.register_gids(raw_gids)
+
+        single = pytmx.TiledMap()
+        expected = [single.register_gid(*decode_gid(raw_gid))
+                    for raw_gid in raw_gids]
+
+        self.assertEqual(list(gids), expected)
+        self.assertEqual(bulk.imagemap, single.imagemap)
+
+
+if __name__ == '__main__':
+    unittest.main()